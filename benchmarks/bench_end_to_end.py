@@ -0,0 +1,166 @@
+"""End-to-end throughput and latency of the bot with local stand-ins for every external service.
+
+A synthetic stream of Telegram updates (text, voice, photo, album, PDF, video) is replayed into a
+TelegramBot wired like main.py, against the stub Telegram, OpenAI and Notion servers from test.fakes
+and a LocalFileStorage in a temporary directory instead of GCS. A message is done when the bot edits
+its "Saving..." reply, an album is acknowledged once, from its first update. Reports throughput, p50/p99 latency per message type and peak RSS.
+
+Run from the repository root:
+    python -m benchmarks.bench_end_to_end [--messages 3] [--openai-latency 1.0] [--openai-rate-limit 2] [--notion-rps 3] [--workers 4]
+"""
+import argparse
+import asyncio
+import resource
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from openai import AsyncOpenAI
+from telegram import Update
+
+from document_storage import NotionDocumentsStorage, RecognisingDocumentsStorage
+from file_storage import LocalFileStorage
+from notion_scheduler import NotionRequestScheduler
+from openai_scheduler import OpenAIRequestScheduler
+from recognisers import WhisperAudioRecogniser, VisionGPTImageRecogniser, SoundOnlyVideoRecogniser, \
+    PDFPlumberFileRecogniser, RedirectingFileRecogniser, WebPageRecogniser
+from task_queue import SQLiteTaskQueue
+from test.fakes import FakeNotionServer, FakeOpenAIServer, FakeTelegramServer, make_audio, make_pdf, make_photo, \
+    make_update, make_video
+from tg import TelegramBot
+
+USER_ID = 1
+
+
+def make_inputs(tmp_path: Path, telegram: FakeTelegramServer):
+    """Registers one file of every kind with the stub Telegram server."""
+    voice_path, photo_path, pdf_path, video_path = (
+        tmp_path / "voice.ogg", tmp_path / "photo.jpg", tmp_path / "doc.pdf", tmp_path / "video.mp4")
+    make_audio(voice_path, tones=6, tone_seconds=3)
+    # Telegram recompresses photos to at most 1280px
+    make_photo(photo_path, 1280, 960)
+    make_pdf(pdf_path, page_count=10, images_per_page=1, with_table=True)
+    make_video(video_path, seconds=10)
+    telegram.add_file("voice", "voice/file_1.oga", voice_path.read_bytes())
+    telegram.add_file("photo", "photos/file_2.jpg", photo_path.read_bytes())
+    telegram.add_file("pdf", "documents/file_3.pdf", pdf_path.read_bytes())
+    telegram.add_file("video", "videos/file_4.mp4", video_path.read_bytes())
+
+
+def make_stream(messages: int, album_size: int = 3) -> List[Tuple[str, Dict]]:
+    """`messages` messages of every type, interleaved, as (type, update) pairs; an album is album_size updates."""
+    photo = [{"file_id": "photo", "file_unique_id": "photo", "width": 1280, "height": 960}]
+    stream = []
+    update_id = 0
+
+    def add(message_type: str, **fields):
+        nonlocal update_id
+        update_id += 1
+        stream.append((message_type, make_update(update_id, USER_ID, **fields)))
+
+    for index in range(messages):
+        add("text", text=f"note {index}: " + "some words " * 50)
+        add("voice", voice={"file_id": "voice", "file_unique_id": "voice", "duration": 27})
+        add("photo", photo=photo, caption="a photo")
+        for _ in range(album_size):
+            add("album", photo=photo, media_group_id=f"album {index}")
+        add("pdf", document={"file_id": "pdf", "file_unique_id": "pdf", "file_name": "doc.pdf"})
+        add("video", video={"file_id": "video", "file_unique_id": "video", "width": 320, "height": 240, "duration": 10})
+    return stream
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def peak_rss_mib() -> Tuple[float, float]:
+    """Peak resident memory of this process and of the largest finished child (ffmpeg, pool workers)."""
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+async def main(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            FakeTelegramServer() as telegram, \
+            FakeOpenAIServer(latency=args.openai_latency, rate_limit=args.openai_rate_limit) as openai_server, \
+            FakeNotionServer(latency=args.notion_latency) as notion:
+        tmp_path = Path(tmp_dir)
+        make_inputs(tmp_path, telegram)
+        client = AsyncOpenAI(base_url=f"{openai_server.url}/v1", api_key="test", max_retries=0)
+        openai_scheduler = OpenAIRequestScheduler()
+        audio_recogniser = WhisperAudioRecogniser(client, scheduler=openai_scheduler)
+        image_recogniser = VisionGPTImageRecogniser(client, scheduler=openai_scheduler)
+        video_recogniser = SoundOnlyVideoRecogniser(audio_recogniser)
+        pdf_recogniser = PDFPlumberFileRecogniser(image_recogniser)
+        notion_storage = NotionDocumentsStorage(
+            "token", "parent", LocalFileStorage(tmp_path / "files", "http://files.test"), base_url=notion.url,
+            scheduler=NotionRequestScheduler(requests_per_second=args.notion_rps, burst=max(1, int(args.notion_rps))),
+        )
+        document_storage = RecognisingDocumentsStorage(
+            base_doc_storage=notion_storage,
+            audio_recogniser=audio_recogniser,
+            image_recogniser=image_recogniser,
+            video_recogniser=video_recogniser,
+            handwriting_recogniser=image_recogniser,
+            file_recogniser=RedirectingFileRecogniser(audio_recogniser, image_recogniser, video_recogniser, pdf_recogniser),
+            url_recogniser=WebPageRecogniser(),
+            progressive=not args.no_progressive,
+        )
+        bot = TelegramBot(
+            token="123:benchmark", user_id=USER_ID, doc_storage=document_storage,
+            task_queue=SQLiteTaskQueue(tmp_path / "tasks.sqlite"), workers=args.workers,
+            base_url=telegram.base_url, base_file_url=telegram.base_file_url,
+        )
+        await bot.application.initialize()
+        await bot.application.post_init(bot.application)
+
+        stream = make_stream(args.messages)
+        # updates are handled one by one, so the n-th "Saving..." reply belongs to the n-th acknowledged update
+        acknowledged: List[Tuple[str, float]] = []
+        albums = set()
+        start = time.monotonic()
+        for message_type, update in stream:
+            album = update["message"].get("media_group_id")
+            if album not in albums:
+                acknowledged.append((message_type, time.monotonic()))
+            if album is not None:
+                albums.add(album)
+            await bot.application.process_update(Update.de_json(update, bot.application.bot))
+        while len(telegram.edited_at) < len(acknowledged):
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - start
+
+        await bot.application.post_stop(bot.application)
+        await bot.application.shutdown()
+        bot.task_queue.close()
+        await notion_storage.close()
+
+    latencies: Dict[str, List[float]] = {}
+    for (message_type, message_started_at), reply_id in zip(acknowledged, telegram.sent_message_ids):
+        latencies.setdefault(message_type, []).append(telegram.edited_at[reply_id] - message_started_at)
+    errors = sum(1 for message in telegram.edited_messages if message["text"].startswith("Error"))
+    print(f"{len(stream)} updates ({len(acknowledged)} messages) in {elapsed:.1f} s: "
+          f"{len(acknowledged) / elapsed:.2f} messages/s, {errors} errors")
+    print(f"{'type':<8}{'count':>6}{'p50 s':>9}{'p99 s':>9}")
+    for message_type, values in latencies.items():
+        print(f"{message_type:<8}{len(values):>6}{statistics.median(values):>9.2f}{percentile(values, 0.99):>9.2f}")
+    own_rss, child_rss = peak_rss_mib()
+    print(f"peak RSS: {own_rss:.0f} MiB, largest child process {child_rss:.0f} MiB")
+    print(f"Notion: {len(notion.requests)} requests, {notion.rejected} rate limited")
+    print(f"OpenAI: {len(openai_server.requests)} requests, {openai_server.rejected} rate limited")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=3, help="messages of every type")
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--openai-rate-limit", type=int, default=None, help="OpenAI requests per second")
+    parser.add_argument("--notion-latency", type=float, default=0.2)
+    parser.add_argument("--notion-rps", type=float, default=3.0)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--no-progressive", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,148 @@
+"""Disk I/O and peak memory of saving one file message, per message type.
+
+Each message goes through TelegramBot like in production: download from a stub Telegram server,
+recognition against a stub OpenAI server (with the recognition cache) and a file storage which
+hashes and reads the file like GoogleCloudStorage does. Disk I/O is counted in blocks by the kernel
+for the process and its ffmpeg children, so reads served from the page cache do not show up, but
+every write to a disk-backed file does. Peak memory is the peak of Python allocations (tracemalloc)
+while one message is processed.
+
+Run from the repository root: python -m benchmarks.bench_file_io [--messages 3] [--no-memory]
+"""
+import argparse
+import asyncio
+import resource
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List
+
+from openai import AsyncOpenAI
+from telegram import Update
+
+from document_storage import NotionDocumentsStorage, RecognisingDocumentsStorage
+from file_storage import FileStorage
+from notion_scheduler import NotionRequestScheduler
+from recognition_cache import RecognitionCache
+from recognisers import WhisperAudioRecogniser, VisionGPTImageRecogniser, SoundOnlyVideoRecogniser, \
+    PDFPlumberFileRecogniser, RedirectingFileRecogniser, WebPageRecogniser, CachingFileRecogniser
+from task_queue import SQLiteTaskQueue
+from test.fakes import FakeNotionServer, FakeOpenAIServer, FakeTelegramServer, make_audio, make_pdf, make_photo, \
+    make_update, make_video
+from tg import TelegramBot
+import utils
+from utils import hash_file
+
+USER_ID = 1
+
+
+class ReadingFileStorage(FileStorage):
+    """Names the blob by content hash and reads the whole file in 8MB chunks, like a GCS upload."""
+
+    async def save_and_get_url(self, file_path: Path) -> str:
+        def upload() -> str:
+            name = hash_file(file_path)
+            with open(file_path, "rb") as file:
+                while file.read(8 * 1024 * 1024):
+                    pass
+            return f"https://files.test/{name}"
+
+        return await asyncio.to_thread(upload)
+
+
+def blocks() -> Dict[str, int]:
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"read": own.ru_inblock + children.ru_inblock, "written": own.ru_oublock + children.ru_oublock}
+
+
+async def main(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            FakeTelegramServer() as telegram, \
+            FakeOpenAIServer(latency=0.0) as openai_server, \
+            FakeNotionServer() as notion:
+        tmp_path = Path(tmp_dir)
+        files = {
+            "photo": ("photos/file_1.jpg", tmp_path / "photo.jpg"),
+            "voice": ("voice/file_2.oga", tmp_path / "voice.ogg"),
+            "pdf": ("documents/file_3.pdf", tmp_path / "doc.pdf"),
+            "video": ("videos/file_4.mp4", tmp_path / "video.mp4"),
+        }
+        make_photo(files["photo"][1], 1280, 960)
+        make_audio(files["voice"][1], tones=6, tone_seconds=3)
+        make_pdf(files["pdf"][1], page_count=10, images_per_page=1, with_table=True)
+        make_video(files["video"][1], seconds=10)
+
+        client = AsyncOpenAI(base_url=f"{openai_server.url}/v1", api_key="test", max_retries=0)
+        cache = RecognitionCache(tmp_path / "cache.sqlite")
+        audio_recogniser = CachingFileRecogniser(WhisperAudioRecogniser(client), cache)
+        image_recogniser = CachingFileRecogniser(VisionGPTImageRecogniser(client), cache)
+        video_recogniser = CachingFileRecogniser(SoundOnlyVideoRecogniser(audio_recogniser), cache)
+        pdf_recogniser = CachingFileRecogniser(PDFPlumberFileRecogniser(image_recogniser), cache)
+        notion_storage = NotionDocumentsStorage(
+            "token", "parent", ReadingFileStorage(), base_url=notion.url,
+            scheduler=NotionRequestScheduler(requests_per_second=1000, burst=1000))
+        document_storage = RecognisingDocumentsStorage(
+            notion_storage, audio_recogniser, image_recogniser, video_recogniser, image_recogniser,
+            RedirectingFileRecogniser(audio_recogniser, image_recogniser, video_recogniser, pdf_recogniser),
+            WebPageRecogniser(),
+        )
+        if args.no_memory:
+            utils.MAX_MEMORY_FILE_BYTES = 0
+        bot = TelegramBot(
+            token="123:benchmark", user_id=USER_ID, doc_storage=document_storage,
+            task_queue=SQLiteTaskQueue(tmp_path / "tasks.sqlite"), workers=1,
+            base_url=telegram.base_url, base_file_url=telegram.base_file_url,
+        )
+        await bot.application.initialize()
+        await bot.application.post_init(bot.application)
+
+        results: Dict[str, List[Dict[str, float]]] = {}
+        update_id = 0
+        print(f"{'type':<7}{'size KiB':>9}{'disk read KiB':>15}{'disk written KiB':>18}{'peak alloc MiB':>16}{'s':>7}")
+        for message_type, (telegram_path, file_path) in files.items():
+            for index in range(args.messages):
+                # a new file every time, so that neither the recognition cache nor the upload is skipped
+                data = file_path.read_bytes() + index.to_bytes(4, "big") * (message_type != "pdf")
+                telegram.add_file(f"{message_type}{index}", telegram_path.replace("file", f"file{index}"), data)
+                update_id += 1
+                fields = {"document": {"file_id": f"{message_type}{index}", "file_unique_id": str(update_id)}}
+                edited = len(telegram.edited_messages)
+                before = blocks()
+                tracemalloc.start()
+                start = time.monotonic()
+                await bot.application.process_update(
+                    Update.de_json(make_update(update_id, USER_ID, **fields), bot.application.bot))
+                while len(telegram.edited_messages) == edited:
+                    await asyncio.sleep(0.01)
+                elapsed = time.monotonic() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                after = blocks()
+                if telegram.edited_messages[-1]["text"].startswith("Error"):
+                    raise RuntimeError(telegram.edited_messages[-1]["text"])
+                results.setdefault(message_type, []).append({
+                    "size": len(data) / 1024,
+                    "read": (after["read"] - before["read"]) * 512 / 1024,
+                    "written": (after["written"] - before["written"]) * 512 / 1024,
+                    "peak": peak / 1024 / 1024,
+                    "seconds": elapsed,
+                })
+            row = {key: statistics.median(result[key] for result in results[message_type])
+                   for key in results[message_type][0]}
+            print(f"{message_type:<7}{row['size']:>9.0f}{row['read']:>15.0f}{row['written']:>18.0f}"
+                  f"{row['peak']:>16.1f}{row['seconds']:>7.2f}")
+
+        await bot.application.post_stop(bot.application)
+        await bot.application.shutdown()
+        bot.task_queue.close()
+        cache.close()
+        await notion_storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=3, help="messages of every type")
+    parser.add_argument("--no-memory", action="store_true", help="write downloads and intermediate files to disk")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,79 @@
+"""Bytes and latency saved by media.prepare_image on typical inputs of VisionGPTImageRecogniser.
+
+Upload time is estimated for the given uplink bandwidth; the request time is measured against the
+local stub OpenAI server, so it shows request encoding cost rather than network time.
+
+Run from the repository root: python -m benchmarks.bench_image_preprocessing [--uplink-mbit 10]
+"""
+import argparse
+import asyncio
+import base64
+import tempfile
+import time
+from pathlib import Path
+
+from openai import AsyncOpenAI
+
+from media import prepare_image
+from recognisers import VisionGPTImageRecogniser
+from test.fakes import FakeOpenAIServer, make_photo, make_screenshot
+
+
+async def request_time(client: AsyncOpenAI, images) -> float:
+    start = time.perf_counter()
+    await client.chat.completions.create(
+        model="gpt-4-vision-preview",
+        messages=[{"role": "user", "content": [
+            {"type": "image_url", "image_url": f"data:{mime_type};base64,{base64.b64encode(data).decode()}"}
+            for data, mime_type in images
+        ]}],
+        max_tokens=3000,
+    )
+    return time.perf_counter() - start
+
+
+async def main(uplink_mbit: float):
+    bytes_per_second = uplink_mbit * 1e6 / 8
+    with tempfile.TemporaryDirectory() as tmp_dir, FakeOpenAIServer() as server:
+        tmp_path = Path(tmp_dir)
+        inputs = {
+            "phone photo 4032x3024 jpeg": tmp_path / "photo.jpg",
+            "long screenshot 1080x7000 png": tmp_path / "screenshot.png",
+            "pdf crop 2480x3508 png": tmp_path / "crop.png",
+        }
+        make_photo(inputs["phone photo 4032x3024 jpeg"], 4032, 3024)
+        make_screenshot(inputs["long screenshot 1080x7000 png"], 1080, 7000)
+        make_photo(inputs["pdf crop 2480x3508 png"], 2480, 3508)
+        client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+
+        for name, path in inputs.items():
+            raw = [(path.read_bytes(), "image/jpeg")]
+            start = time.perf_counter()
+            prepared = await asyncio.to_thread(prepare_image, path)
+            prepare_seconds = time.perf_counter() - start
+
+            raw_payload = sum(len(base64.b64encode(data)) for data, _ in raw)
+            prepared_payload = sum(len(base64.b64encode(image.data)) for image in prepared)
+            upload_saved = (raw_payload - prepared_payload) / bytes_per_second
+            raw_request = await request_time(client, raw)
+            prepared_request = await request_time(client, [(image.data, image.mime_type) for image in prepared])
+
+            print(name)
+            print(f"  payload: {raw_payload / 1024:.0f} KiB -> {prepared_payload / 1024:.0f} KiB "
+                  f"in {len(prepared)} image(s) ({prepared[0].mime_type}), "
+                  f"saved {(raw_payload - prepared_payload) / 1024:.0f} KiB")
+            print(f"  preprocessing: {prepare_seconds * 1000:.0f} ms in a worker thread")
+            print(f"  local request: {raw_request * 1000:.0f} ms -> {prepared_request * 1000:.0f} ms")
+            print(f"  upload at {uplink_mbit:g} Mbit/s: saved {upload_saved * 1000:.0f} ms, "
+                  f"net latency saved {(upload_saved - prepare_seconds + raw_request - prepared_request) * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        await VisionGPTImageRecogniser(client).recognise(inputs["phone photo 4032x3024 jpeg"])
+        print(f"VisionGPTImageRecogniser end-to-end against the stub: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uplink-mbit", type=float, default=10.0)
+    args = parser.parse_args()
+    asyncio.run(main(args.uplink_mbit))
@@ -0,0 +1,37 @@
+"""Overhead of instrumentation.stage() per instrumented block, disabled and enabled.
+
+Run from the repository root: python -m benchmarks.bench_instrumentation
+"""
+import time
+
+import instrumentation
+from instrumentation import stage
+
+
+def per_stage_seconds(iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with stage("benchmark") as timed:
+            timed.add_bytes(1)
+    return (time.perf_counter() - start) / iterations
+
+
+def baseline_seconds(iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        pass
+    return (time.perf_counter() - start) / iterations
+
+
+def main(iterations: int = 200_000):
+    baseline = baseline_seconds(iterations)
+    disabled = per_stage_seconds(iterations) - baseline
+    instrumentation.enable()
+    enabled = per_stage_seconds(iterations) - baseline
+    instrumentation.disable()
+    print(f"disabled: {disabled * 1e9:.0f} ns per stage")
+    print(f"enabled (prometheus only): {enabled * 1e9:.0f} ns per stage")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Compares PDF extraction in a single worker thread with the page-range process pool mode.
+
+Run from the repository root: python -m benchmarks.bench_pdf [--pages 200] [--workers 4]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from recognisers import PDFPlumberFileRecogniser, FileRecogniser, format_table
+from test.fakes import make_pdf
+
+
+class NoopImageRecogniser(FileRecogniser):
+    async def recognise(self, file_path: Path) -> str:
+        return "image"
+
+
+async def measure(recogniser: PDFPlumberFileRecogniser, pdf_path: Path):
+    """Returns wall time of recognise and the longest event loop stall observed meanwhile."""
+    max_lag = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal max_lag
+        while not done:
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            max_lag = max(max_lag, time.perf_counter() - before - 0.01)
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await recogniser.recognise(pdf_path)
+    elapsed = time.perf_counter() - start
+    done = True
+    await ticker_task
+    return elapsed, max_lag
+
+
+def bench_table_formatting(repeats: int = 2000):
+    table = [[f"h{column}" for column in range(6)]] + [[f"r{row}c{column}" for column in range(6)] for row in range(20)]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        format_table(table)
+    print(f"format_table: {(time.perf_counter() - start) / repeats * 1e6:.1f} us per table")
+    try:
+        import pandas as pd
+    except ImportError:
+        print("pandas is not installed, skipping DataFrame.to_string comparison")
+        return
+    start = time.perf_counter()
+    for _ in range(repeats):
+        pd.DataFrame(table[1:], columns=table[0]).to_string(index=False)
+    print(f"DataFrame.to_string: {(time.perf_counter() - start) / repeats * 1e6:.1f} us per table")
+
+
+async def main(pages: int, workers: int, pages_per_chunk: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = Path(tmp_dir) / "bench.pdf"
+        make_pdf(pdf_path, page_count=pages, lines_per_page=40, images_per_page=1, with_table=True)
+        print(f"{pages} pages, {pdf_path.stat().st_size / 1024:.0f} KiB")
+
+        elapsed, lag = await measure(PDFPlumberFileRecogniser(NoopImageRecogniser()), pdf_path)
+        print(f"thread: {elapsed:.2f}s, max event loop stall {lag * 1000:.1f}ms")
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            recogniser = PDFPlumberFileRecogniser(
+                NoopImageRecogniser(), process_pool=pool, pages_per_chunk=pages_per_chunk)
+            # the first call pays for worker start-up
+            elapsed, lag = await measure(recogniser, pdf_path)
+            print(f"process pool ({workers} workers, cold): {elapsed:.2f}s, max event loop stall {lag * 1000:.1f}ms")
+            elapsed, lag = await measure(recogniser, pdf_path)
+            print(f"process pool ({workers} workers, warm): {elapsed:.2f}s, max event loop stall {lag * 1000:.1f}ms")
+    bench_table_formatting()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--pages-per-chunk", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.pages, args.workers, args.pages_per_chunk))
@@ -0,0 +1,59 @@
+"""Indexing throughput and /search latency of SearchIndex with synthetic notes.
+
+Run from the repository root: python -m benchmarks.bench_search [--documents 10000]
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from search_index import SearchIndex
+
+
+def make_vocabulary(size: int, seed: int = 0):
+    rng = random.Random(seed)
+    return ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+
+async def main(args: argparse.Namespace):
+    rng = random.Random(1)
+    vocabulary = make_vocabulary(20000)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = SearchIndex(Path(tmp_dir) / "search.sqlite")
+        start = time.perf_counter()
+        # every document arrives in pieces, like pages of a PDF or chunks of a transcript, and its
+        # later pieces are appended to the row written by an earlier batch
+        for _ in range(args.pieces):
+            for document in range(args.documents):
+                text = " ".join(rng.choices(vocabulary, k=args.words // args.pieces))
+                index.add(str(document), f"note {document}", f"https://www.notion.so/{document}", text)
+                # lets scheduled flushes run, as the event loop of the bot would
+                await asyncio.sleep(0)
+        await index.flush()
+        elapsed = time.perf_counter() - start
+        pieces = args.documents * args.pieces
+        print(f"indexed {args.documents} documents ({pieces} pieces, {args.words} words each) in {elapsed:.1f} s: "
+              f"{pieces / elapsed:.0f} pieces/s")
+
+        latencies = []
+        for _ in range(args.queries):
+            query = " ".join(rng.choices(vocabulary, k=2))
+            start = time.perf_counter()
+            await index.search(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        print(f"search over {args.queries} two-word queries: p50 {statistics.median(latencies):.2f} ms, "
+              f"p99 {latencies[int(0.99 * (len(latencies) - 1))]:.2f} ms")
+        index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--pieces", type=int, default=4)
+    parser.add_argument("--words", type=int, default=400)
+    parser.add_argument("--queries", type=int, default=500)
+    asyncio.run(main(parser.parse_args()))
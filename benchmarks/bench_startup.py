@@ -0,0 +1,99 @@
+"""Startup cost of the bot: import time of main.py, time from process start to the first
+getUpdates request, and resident memory at that moment.
+
+main.py is started as it is in production, with every external service replaced by a local stub
+or a placeholder: nothing is sent to OpenAI, Notion or Google Cloud before the first message.
+
+Run from the repository root: python -m benchmarks.bench_startup [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import rsa
+
+from test.fakes import FakeTelegramServer
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_seconds() -> float:
+    """Wall time of importing main, without the interpreter startup."""
+    code = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+    return float(subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True, capture_output=True, text=True).stdout)
+
+
+def write_service_account(path: Path, private_key: str):
+    """A well-formed service account file, credentials are never used."""
+    path.write_text(json.dumps({
+        "type": "service_account", "project_id": "benchmark", "private_key_id": "key", "private_key": private_key,
+        "client_email": "benchmark@benchmark.iam.gserviceaccount.com", "client_id": "1",
+        "token_uri": "https://oauth2.googleapis.com/token",
+    }))
+
+
+def rss_mib(pid: int) -> float:
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) / 1024
+    raise ValueError("no VmRSS")
+
+
+def first_poll(tmp_path: Path, private_key: str):
+    """Seconds from starting main.py until it polls for updates, and its RSS then in MiB."""
+    write_service_account(tmp_path / "credentials.json", private_key)
+    with FakeTelegramServer() as telegram:
+        env = {
+            **os.environ,
+            "TELEGRAM_TOKEN": "123:benchmark",
+            "TELEGRAM_USER_ID": "1",
+            "TELEGRAM_BASE_URL": telegram.base_url,
+            "TELEGRAM_BASE_FILE_URL": telegram.base_file_url,
+            "NOTION_TOKEN": "token",
+            "NOTION_PARENT_DOCUMENT": "parent",
+            "OPENAI_API_KEY": "key",
+            "GOOGLE_APPLICATION_CREDENTIALS": str(tmp_path / "credentials.json"),
+            "TASK_QUEUE_PATH": str(tmp_path / "tasks.sqlite"),
+            "RECOGNITION_CACHE_PATH": str(tmp_path / "cache.sqlite"),
+            "SEARCH_INDEX_PATH": str(tmp_path / "search.sqlite"),
+        }
+        env.pop("WEBHOOK_URL", None)
+        env.pop("METRICS_PORT", None)
+        start = time.monotonic()
+        process = subprocess.Popen(
+            [sys.executable, "main.py"], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            while telegram.polled_at is None:
+                if process.poll() is not None:
+                    raise RuntimeError(process.stderr.read().decode())
+                time.sleep(0.005)
+            return telegram.polled_at - start, rss_mib(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main(args: argparse.Namespace):
+    imports = [import_seconds() for _ in range(args.runs)]
+    private_key = rsa.newkeys(1024)[1].save_pkcs1().decode()
+    polls, rss = [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            poll_seconds, poll_rss = first_poll(Path(tmp_dir), private_key)
+        polls.append(poll_seconds)
+        rss.append(poll_rss)
+    print(f"import main:         median {statistics.median(imports) * 1000:.0f} ms over {args.runs} runs")
+    print(f"time to first poll:  median {statistics.median(polls) * 1000:.0f} ms")
+    print(f"RSS at first poll:   median {statistics.median(rss):.0f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    main(parser.parse_args())
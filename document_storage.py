@@ -1,34 +1,57 @@
+import asyncio
+import inspect
+import logging
 from abc import ABC
+from contextlib import aclosing
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
-from notion_client import Client
+import httpx
+from notion_client import AsyncClient
 
 from file_storage import FileStorage
+from instrumentation import stage
+from notion_blocks import batch_blocks, build_blocks
+from notion_scheduler import NotionRequestScheduler
 from recognisers import FileRecogniser, URLRecogniser
+from search_index import SearchIndex
+from utils import gather_or_cancel
+
+# a description may be still in progress, e.g. a running recognition
+Description = Union[str, Awaitable[str]]
+
+# Notion blocks for files of an album, other files are attached as file blocks
+MEDIA_BLOCK_TYPES = {
+    **dict.fromkeys(['.jpeg', '.jpg', '.png', '.webp', '.gif'], "image"),
+    **dict.fromkeys(['.mp4', '.mov'], "video"),
+    **dict.fromkeys(['.mp3', '.m4a', '.wav', '.ogg', '.oga'], "audio"),
+}
 
 
 class DocumentsStorage(ABC):
+    """save_* methods return the id of the created document, which can be extended with append_text.
+    An awaitable description is awaited by the storage concurrently with the file upload."""
+
     async def save_text(self, name: str, text: str):
         raise NotImplementedError()
 
-    async def save_image(self, name: str, image_path: Path, description: Optional[str] = None):
+    async def save_image(self, name: str, image_path: Path, description: Optional[Description] = None):
         raise NotImplementedError()
 
-    async def save_audio(self, name: str, audio_path: Path, description: Optional[str] = None):
+    async def save_audio(self, name: str, audio_path: Path, description: Optional[Description] = None):
         raise NotImplementedError()
 
-    async def save_video(self, name: str, video_path: Path, description: Optional[str] = None):
+    async def save_video(self, name: str, video_path: Path, description: Optional[Description] = None):
         raise NotImplementedError()
 
-    async def save_handwriting(self, name: str, image_path: Path, description: Optional[str] = None):
+    async def save_handwriting(self, name: str, image_path: Path, description: Optional[Description] = None):
         raise NotImplementedError()
 
-    async def save_link(self, name: str, url: str, description: Optional[str] = None):
+    async def save_link(self, name: str, url: str, description: Optional[Description] = None):
         raise NotImplementedError()
 
-    async def save_file(self, name: str, file_path: Path, description: Optional[str] = None):
+    async def save_file(self, name: str, file_path: Path, description: Optional[Description] = None):
         raise NotImplementedError()
 
     async def save_reminder(self, name: str, content: str, due_date: datetime):
@@ -37,12 +60,51 @@ class DocumentsStorage(ABC):
     async def save_todo(self, name: str, task: str, category: str):
         raise NotImplementedError()
 
+    async def save_album(self, name: str, items: List[Tuple[Path, Optional[Description]]]):
+        """Saves several files with their descriptions as one document."""
+        raise NotImplementedError()
+
+    async def save_links(self, name: str, text: str, links: List[Tuple[str, Optional[Description]]]):
+        """Saves a message as one document: its text, then a bookmark of every link with its description."""
+        raise NotImplementedError()
+
+    async def append_text(self, document_id: str, text: str):
+        raise NotImplementedError()
+
+    async def delete(self, document_id: str):
+        raise NotImplementedError()
+
+    def document_url(self, document_id: str) -> str:
+        raise NotImplementedError()
+
 
 class NotionDocumentsStorage(DocumentsStorage):
-    def __init__(self, token: str, parent_document_id: str, file_storage: FileStorage):
+    def __init__(
+            self,
+            token: str,
+            parent_document_id: str,
+            file_storage: FileStorage,
+            base_url: str = "https://api.notion.com",
+            http_client: Optional[httpx.AsyncClient] = None,
+            max_connections: int = 10,
+            scheduler: Optional[NotionRequestScheduler] = None,
+    ):
+        """All requests go through scheduler, which must be shared by every storage using the same token."""
         self.file_storage = file_storage
         self.parent_document_id = parent_document_id
-        self.notion_client = Client(auth=token)
+        self.token = token
+        # one pooled connection set shared by every save_* call, so concurrent saves overlap
+        self._owns_http_client = http_client is None
+        self.http_client = http_client or httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        # auth is passed per request, so the same http_client may be shared between several storages
+        self.notion_client = AsyncClient(client=self.http_client, base_url=base_url)
+        self.scheduler = scheduler or NotionRequestScheduler()
+
+    async def close(self):
+        if self._owns_http_client:
+            await self.http_client.aclose()
 
     def _build_header(self, name: str) -> Dict:
         return {
@@ -50,24 +112,55 @@ class NotionDocumentsStorage(DocumentsStorage):
             "properties": {"title": {"title": [{"text": {"content": name}}]}}
         }
 
-    @staticmethod
-    def _build_text_block(text: str) -> Dict:
-        return {
-            "object": "block",
-            "type": "paragraph",
-            "paragraph": {
-                "rich_text": [{"text": {"content": text}}]
-            }
-        }
-
-    def _create_page(self, name: str, children: List[Dict]):
-        self.notion_client.pages.create(**self._build_header(name), children=children)
+    async def _append_blocks(self, block_id: str, children: List[Dict]):
+        await self.scheduler.run(
+            lambda: self.notion_client.blocks.children.append(block_id=block_id, children=children, auth=self.token),
+            idempotent=False
+        )
+
+    async def append_text(self, document_id: str, text: str):
+        for batch in batch_blocks(build_blocks(text)):
+            await self._append_blocks(document_id, batch)
+
+    async def delete(self, document_id: str):
+        """Pages are archived, they can be restored from the Notion trash."""
+        await self.scheduler.run(
+            lambda: self.notion_client.pages.update(page_id=document_id, archived=True, auth=self.token)
+        )
+
+    def document_url(self, document_id: str) -> str:
+        return f"https://www.notion.so/{document_id.replace('-', '')}"
+
+    async def _create_page(self, name: str, children: Iterable[Dict]) -> str:
+        """Creates the page with the first batch of children and appends the rest, returns the page id.
+        Notion always appends to the end of the parent, so the batches of one page are sent one by one."""
+        batches = batch_blocks(children)
+        first_batch = next(batches, [])
+        page = await self.scheduler.run(
+            lambda: self.notion_client.pages.create(**self._build_header(name), children=first_batch, auth=self.token),
+            idempotent=False
+        )
+        try:
+            for batch in batches:
+                await self._append_blocks(page["id"], batch)
+        except Exception:
+            # a truncated page would be duplicated when the message is retried
+            await self.delete(page["id"])
+            raise
+        return page["id"]
+
+    async def _upload(self, file_path: Path, description: Optional[Description]) -> Tuple[str, Optional[str]]:
+        """Uploads the file while description is awaited, if either fails the other one is cancelled."""
+        if not inspect.isawaitable(description):
+            return await self.file_storage.save_and_get_url(file_path), description
+        url, description = await gather_or_cancel(self.file_storage.save_and_get_url(file_path), description)
+        return url, description
 
     async def save_text(self, name: str, text: str):
-        self._create_page(name, [self._build_text_block(text)])
+        return await self._create_page(name, build_blocks(text))
 
-    async def save_image(self, name: str, image_path: Path, description: Optional[str] = None):
-        image_url = await self.file_storage.save_and_get_url(image_path)
+    async def save_image(self, name: str, image_path: Path, description: Optional[Description] = None):
+        image_url, description = await self._upload(image_path, description)
         image_block = {
             "object": "block",
             "type": "image",
@@ -78,13 +171,13 @@ class NotionDocumentsStorage(DocumentsStorage):
                 }
             }
         }
-        children = [image_block]
+        children: List[Dict] = [image_block]
         if description:
-            children.append(self._build_text_block(description))
-        self._create_page(name, children)
+            children.extend(build_blocks(description))
+        return await self._create_page(name, children)
 
-    async def save_audio(self, name: str, audio_path: Path, description: Optional[str] = None):
-        audio_url = await self.file_storage.save_and_get_url(audio_path)
+    async def save_audio(self, name: str, audio_path: Path, description: Optional[Description] = None):
+        audio_url, description = await self._upload(audio_path, description)
         audio_block = {
             "object": "block",
             "type": "audio",
@@ -95,13 +188,13 @@ class NotionDocumentsStorage(DocumentsStorage):
                 }
             }
         }
-        children = [audio_block]
+        children: List[Dict] = [audio_block]
         if description:
-            children.append(self._build_text_block(description))
-        self._create_page(name, children)
+            children.extend(build_blocks(description))
+        return await self._create_page(name, children)
 
-    async def save_video(self, name: str, video_path: Path, description: Optional[str] = None):
-        video_url = await self.file_storage.save_and_get_url(video_path)
+    async def save_video(self, name: str, video_path: Path, description: Optional[Description] = None):
+        video_url, description = await self._upload(video_path, description)
         video_block = {
             "object": "block",
             "type": "video",
@@ -112,13 +205,13 @@ class NotionDocumentsStorage(DocumentsStorage):
                 }
             }
         }
-        children = [video_block]
+        children: List[Dict] = [video_block]
         if description:
-            children.append(self._build_text_block(description))
-        self._create_page(name, children)
+            children.extend(build_blocks(description))
+        return await self._create_page(name, children)
 
-    async def save_handwriting(self, name: str, image_path: Path, description: Optional[str] = None):
-        image_url = await self.file_storage.save_and_get_url(image_path)
+    async def save_handwriting(self, name: str, image_path: Path, description: Optional[Description] = None):
+        image_url, description = await self._upload(image_path, description)
         image_block = {
             "object": "block",
             "type": "image",
@@ -129,12 +222,14 @@ class NotionDocumentsStorage(DocumentsStorage):
                 }
             }
         }
-        children = [image_block]
+        children: List[Dict] = [image_block]
         if description:
-            children.append(self._build_text_block(description))
-        self._create_page(name, children)
+            children.extend(build_blocks(description))
+        return await self._create_page(name, children)
 
-    async def save_link(self, name: str, url: str, description: Optional[str] = None):
+    async def save_link(self, name: str, url: str, description: Optional[Description] = None):
+        if inspect.isawaitable(description):
+            description = await description
         link_block = {
             "object": "block",
             "type": "bookmark",
@@ -142,13 +237,13 @@ class NotionDocumentsStorage(DocumentsStorage):
                 "url": url
             }
         }
-        children = [link_block]
+        children: List[Dict] = [link_block]
         if description:
-            children.append(self._build_text_block(description))
-        self._create_page(name, children)
+            children.extend(build_blocks(description))
+        return await self._create_page(name, children)
 
-    async def save_file(self, name: str, file_path: Path, description: Optional[str] = None):
-        file_url = await self.file_storage.save_and_get_url(file_path)
+    async def save_file(self, name: str, file_path: Path, description: Optional[Description] = None):
+        file_url, description = await self._upload(file_path, description)
         file_block = {
             "object": "block",
             "type": "file",
@@ -159,10 +254,55 @@ class NotionDocumentsStorage(DocumentsStorage):
                 }
             }
         }
-        children = [file_block]
+        children: List[Dict] = [file_block]
         if description:
-            children.append(self._build_text_block(description))
-        self._create_page(name, children)
+            children.extend(build_blocks(description))
+        return await self._create_page(name, children)
+
+    async def save_album(self, name: str, items: List[Tuple[Path, Optional[Description]]]):
+        # every file is uploaded while its description is awaited, all files at once
+        uploaded = await gather_or_cancel(*[self._upload(file_path, description) for file_path, description in items])
+        children: List[Dict] = []
+        for (file_path, _), (file_url, description) in zip(items, uploaded):
+            block_type = MEDIA_BLOCK_TYPES.get(file_path.suffix.lower(), "file")
+            children.append({
+                "object": "block",
+                "type": block_type,
+                block_type: {
+                    "type": "external",
+                    "external": {
+                        "url": file_url
+                    }
+                }
+            })
+            if description:
+                children.extend(build_blocks(description))
+        return await self._create_page(name, children)
+
+    async def save_links(self, name: str, text: str, links: List[Tuple[str, Optional[Description]]]):
+        descriptions = await gather_or_cancel(*[
+            description if inspect.isawaitable(description) else _resolved(description) for _, description in links
+        ])
+        children: List[Dict] = list(build_blocks(text))
+        for (url, _), description in zip(links, descriptions):
+            children.append({
+                "object": "block",
+                "type": "bookmark",
+                "bookmark": {
+                    "url": url
+                }
+            })
+            if description:
+                children.extend(build_blocks(description))
+        return await self._create_page(name, children)
+
+
+async def _resolved(value: Optional[str]) -> Optional[str]:
+    return value
+
+
+async def _recognise_whole(recognise: Callable[[], Awaitable[str]]) -> AsyncIterator[str]:
+    yield await recognise()
 
 
 class RecognisingDocumentsStorage(DocumentsStorage):
@@ -175,7 +315,13 @@ class RecognisingDocumentsStorage(DocumentsStorage):
             handwriting_recogniser: FileRecogniser,
             file_recogniser: FileRecogniser,
             url_recogniser: URLRecogniser,
+            progressive: bool = False,
+            search_index: Optional[SearchIndex] = None,
     ):
+        """In progressive mode the document with the media and caption is created while recognition
+        runs, and recognised text is appended as it becomes available (page by page for PDFs,
+        chunk by chunk for long audio).
+        Saved and recognised text is also added to search_index, piece by piece as it is appended."""
         self.video_recogniser = video_recogniser
         self.image_recogniser = image_recogniser
         self.handwriting_recogniser = handwriting_recogniser
@@ -183,42 +329,241 @@ class RecognisingDocumentsStorage(DocumentsStorage):
         self.url_recogniser = url_recogniser
         self.audio_recogniser = audio_recogniser
         self.base_doc_storage = base_doc_storage
+        self.progressive = progressive
+        self.search_index = search_index
 
-    async def save_text(self, name: str, text: str):
-        await self.base_doc_storage.save_text(name, text)
+    def _index(self, document_id: str, name: Optional[str], text: Optional[str]):
+        if self.search_index is not None and text:
+            self.search_index.add(document_id, name, self.base_doc_storage.document_url(document_id), text)
 
-    async def save_image(self, name: str, image_path: Path, description: Optional[str] = None):
-        recognised_description = await self.image_recogniser.recognise(image_path)
+    async def _save_progressively(
+            self,
+            kind: str,
+            name: str,
+            description: Optional[str],
+            save: Callable[[], Awaitable[str]],
+            parts: AsyncIterator[str],
+    ) -> str:
+        document_id = asyncio.get_running_loop().create_future()
+        recognised = asyncio.Queue()
+
+        async def create():
+            document_id.set_result(await save())
+            self._index(document_id.result(), name, description)
+
+        async def recognise():
+            with stage(f"recognise.{kind}"):
+                async with aclosing(parts):
+                    async for part in parts:
+                        recognised.put_nowait(part)
+            recognised.put_nowait(None)
+
+        async def append():
+            finished = False
+            while not finished:
+                texts = [await recognised.get()]
+                page_id = await asyncio.shield(document_id)
+                # parts which arrived while the document was created or the previous part appended are sent in one go
+                while not recognised.empty():
+                    texts.append(recognised.get_nowait())
+                finished = texts[-1] is None
+                text = "".join(texts[:-1] if finished else texts)
+                if text.strip():
+                    await self.base_doc_storage.append_text(page_id, text)
+                    self._index(page_id, name, text)
+
+        try:
+            await gather_or_cancel(create(), recognise(), append())
+        except Exception:
+            # the document is incomplete, and a retry would create it again
+            if document_id.done():
+                await self.delete(document_id.result())
+            raise
+        return document_id.result()
+
+    @staticmethod
+    async def _describe(
+            kind: str, recognition: Awaitable[str], description: Optional[str], described: List[str]) -> str:
+        with stage(f"recognise.{kind}"):
+            recognised_description = await recognition
         if description:
             recognised_description += '\n\n' + description
-        await self.base_doc_storage.save_image(name, image_path, recognised_description)
+        described.append(recognised_description)
+        return recognised_description
+
+    async def _save_described(
+            self,
+            kind: str,
+            name: str,
+            save: Callable[[Description], Awaitable[str]],
+            recognition: Awaitable[str],
+            description: Optional[str],
+    ) -> str:
+        """Saves with the recognised text and caption as the description, which is then indexed."""
+        described: List[str] = []
+        document_id = await save(self._describe(kind, recognition, description, described))
+        self._index(document_id, name, "".join(described))
+        return document_id
+
+    async def save_text(self, name: str, text: str):
+        document_id = await self.base_doc_storage.save_text(name, text)
+        self._index(document_id, name, text)
+        return document_id
+
+    async def save_image(self, name: str, image_path: Path, description: Optional[str] = None):
+        if self.progressive:
+            return await self._save_progressively(
+                "image",
+                name,
+                description,
+                lambda: self.base_doc_storage.save_image(name, image_path, description),
+                self.image_recogniser.recognise_parts(image_path)
+            )
+        return await self._save_described(
+            "image",
+            name,
+            lambda recognised: self.base_doc_storage.save_image(name, image_path, recognised),
+            self.image_recogniser.recognise(image_path),
+            description
+        )
 
     async def save_audio(self, name: str, audio_path: Path, description: Optional[str] = None):
-        recognised_description = await self.audio_recogniser.recognise(audio_path)
-        if description:
-            recognised_description += '\n\n' + description
-        await self.base_doc_storage.save_audio(name, audio_path, recognised_description)
+        if self.progressive:
+            return await self._save_progressively(
+                "audio",
+                name,
+                description,
+                lambda: self.base_doc_storage.save_audio(name, audio_path, description),
+                self.audio_recogniser.recognise_parts(audio_path)
+            )
+        return await self._save_described(
+            "audio",
+            name,
+            lambda recognised: self.base_doc_storage.save_audio(name, audio_path, recognised),
+            self.audio_recogniser.recognise(audio_path),
+            description
+        )
 
     async def save_video(self, name: str, video_path: Path, description: Optional[str] = None):
-        recognised_description = await self.video_recogniser.recognise(video_path)
-        if description:
-            recognised_description += '\n\n' + description
-        await self.base_doc_storage.save_video(name, video_path, recognised_description)
+        if self.progressive:
+            return await self._save_progressively(
+                "video",
+                name,
+                description,
+                lambda: self.base_doc_storage.save_video(name, video_path, description),
+                self.video_recogniser.recognise_parts(video_path)
+            )
+        return await self._save_described(
+            "video",
+            name,
+            lambda recognised: self.base_doc_storage.save_video(name, video_path, recognised),
+            self.video_recogniser.recognise(video_path),
+            description
+        )
 
     async def save_handwriting(self, name: str, image_path: Path, description: Optional[str] = None):
-        recognised_description = await self.handwriting_recogniser.recognise(image_path)
-        if description:
-            recognised_description += '\n\n' + description
-        await self.base_doc_storage.save_handwriting(name, image_path, recognised_description)
+        if self.progressive:
+            return await self._save_progressively(
+                "handwriting",
+                name,
+                description,
+                lambda: self.base_doc_storage.save_handwriting(name, image_path, description),
+                self.handwriting_recogniser.recognise_parts(image_path)
+            )
+        return await self._save_described(
+            "handwriting",
+            name,
+            lambda recognised: self.base_doc_storage.save_handwriting(name, image_path, recognised),
+            self.handwriting_recogniser.recognise(image_path),
+            description
+        )
 
     async def save_link(self, name: str, url: str, description: Optional[str] = None):
-        recognised_description = await self.url_recogniser.recognise(url)
-        if description:
-            recognised_description += '\n\n' + description
-        await self.base_doc_storage.save_link(name, url, recognised_description)
+        if self.progressive:
+            return await self._save_progressively(
+                "link",
+                name,
+                description,
+                lambda: self.base_doc_storage.save_link(name, url, description),
+                _recognise_whole(lambda: self.url_recogniser.recognise(url))
+            )
+        return await self._save_described(
+            "link",
+            name,
+            lambda recognised: self.base_doc_storage.save_link(name, url, recognised),
+            self.url_recogniser.recognise(url),
+            description
+        )
 
     async def save_file(self, name: str, file_path: Path, description: Optional[str] = None):
-        recognised_description = await self.file_recogniser.recognise(file_path)
-        if description:
-            recognised_description += '\n\n' + description
-        await self.base_doc_storage.save_file(name, file_path, recognised_description)
+        if not self.file_recogniser.supports(file_path):
+            # there is nothing to recognise, retrying would not help
+            logging.warning(f"Could not recognise {file_path.name}: unsupported file type")
+            document_id = await self.base_doc_storage.save_file(name, file_path, description)
+            self._index(document_id, name, description)
+            return document_id
+        if self.progressive:
+            return await self._save_progressively(
+                "file",
+                name,
+                description,
+                lambda: self.base_doc_storage.save_file(name, file_path, description),
+                self.file_recogniser.recognise_parts(file_path)
+            )
+        return await self._save_described(
+            "file",
+            name,
+            lambda recognised: self.base_doc_storage.save_file(name, file_path, recognised),
+            self.file_recogniser.recognise(file_path),
+            description
+        )
+
+    def _describe_album_item(self, file_path: Path, description: Optional[str], described: List[str]) -> Optional[Description]:
+        if not self.file_recogniser.supports(file_path):
+            # the file is saved with its caption only, the other items of the album are still recognised
+            logging.warning(f"Could not recognise {file_path.name}: unsupported file type")
+            if description:
+                described.append(description)
+            return description
+        return self._describe("album_item", self.file_recogniser.recognise(file_path), description, described)
+
+    async def save_album(self, name: str, items: List[Tuple[Path, Optional[str]]]):
+        """All files are recognised concurrently, and while they are uploaded. The page is created once,
+        with every file followed by its recognised text and caption, also in progressive mode."""
+        described = [[] for _ in items]
+        document_id = await self.base_doc_storage.save_album(name, [
+            (file_path, self._describe_album_item(file_path, description, item_described))
+            for (file_path, description), item_described in zip(items, described)
+        ])
+        self._index(document_id, name, "\n\n".join("".join(item_described) for item_described in described))
+        return document_id
+
+    async def _recognise_link(self, url: str) -> str:
+        try:
+            return await self.url_recogniser.recognise(url)
+        except Exception as e:  # noqa
+            # an unreachable page is saved as a bookmark only, the message and the other links are kept
+            logging.warning(f"Could not fetch {url}: {e}")
+            return ""
+
+    async def save_links(self, name: str, text: str, links: List[Tuple[str, Optional[str]]]):
+        """All linked pages are fetched concurrently and the page is created once, also in progressive mode."""
+        described = [[] for _ in links]
+        document_id = await self.base_doc_storage.save_links(name, text, [
+            (url, self._describe("link", self._recognise_link(url), description, link_described))
+            for (url, description), link_described in zip(links, described)
+        ])
+        self._index(document_id, name, "\n\n".join([text] + ["".join(link_described) for link_described in described]))
+        return document_id
+
+    async def append_text(self, document_id: str, text: str):
+        await self.base_doc_storage.append_text(document_id, text)
+        self._index(document_id, None, text)
+
+    async def delete(self, document_id: str):
+        await self.base_doc_storage.delete(document_id)
+        if self.search_index is not None:
+            await self.search_index.remove(document_id)
+
+    def document_url(self, document_id: str) -> str:
+        return self.base_doc_storage.document_url(document_id)
@@ -1,12 +1,16 @@
+import asyncio
+import copy
 import os
-import uuid
+import shutil
+import tempfile
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from mimetypes import guess_type
 from pathlib import Path
 
-import aiofiles
-from google.cloud import storage
-from google.oauth2 import service_account
+from instrumentation import stage
+from utils import hash_file
 
 
 class FileStorage(ABC):
@@ -15,21 +19,106 @@ class FileStorage(ABC):
         pass
 
 
-class GoogleCloudStorage(FileStorage):
+class _LazyBucket:
+    """The Google Cloud client is created with the first upload, google-cloud-storage is slow to import."""
+
     def __init__(self, service_account_file_path: Path, bucket_name: str):
-        creds = service_account.Credentials.from_service_account_file(
-            str(service_account_file_path))
-        self.client = storage.Client(credentials=creds)
-        self.bucket = self.client.bucket(bucket_name)
+        self.service_account_file_path = service_account_file_path
+        self.bucket_name = bucket_name
+        self._bucket = None
+        self._lock = threading.Lock()
 
-    async def save_and_get_url(self, file_path: Path) -> str:
-        blob_name = str(uuid.uuid4()) + os.path.splitext(file_path.name)[1]
-        blob = self.bucket.blob(blob_name)
+    def get(self):
+        # uploads run in worker threads
+        with self._lock:
+            if self._bucket is None:
+                from google.cloud import storage
+                from google.oauth2 import service_account
+
+                creds = service_account.Credentials.from_service_account_file(str(self.service_account_file_path))
+                self._bucket = storage.Client(credentials=creds).bucket(self.bucket_name)
+            return self._bucket
+
+
+class GoogleCloudStorage(FileStorage):
+    def __init__(
+            self,
+            service_account_file_path: Path,
+            bucket_name: str,
+            chunk_size: int = 8 * 1024 * 1024,
+            prefix: str = "",
+            max_known_blobs: int = 1024,
+    ):
+        """Blob names start with prefix, e.g. "alice/".
+        URLs of the last max_known_blobs uploaded blobs are remembered, so re-sent media is not looked up in the bucket."""
+        self._bucket = _LazyBucket(service_account_file_path, bucket_name)
+        # files above 8MB go through a resumable upload sent in chunks of this size (multiple of 256KB)
+        self.chunk_size = chunk_size
+        self.prefix = prefix
+        self.max_known_blobs = max_known_blobs
+        self._uploaded: "OrderedDict[str, str]" = OrderedDict()
+        self._uploaded_lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        return self._bucket.get()
+
+    def with_prefix(self, prefix: str) -> "GoogleCloudStorage":
+        """Storage in the same bucket under another prefix, sharing the client and its connections."""
+        storage = copy.copy(self)
+        storage.prefix = prefix
+        return storage
 
-        async with aiofiles.open(file_path, 'rb') as file_data:
-            bytes_data = await file_data.read()
+    def _upload(self, file_path: Path) -> str:
+        from google.api_core.exceptions import PreconditionFailed
 
-        mime_type = guess_type(file_path)[0] or 'application/octet-stream'
-        blob.upload_from_string(bytes_data, content_type=mime_type)
-        blob.make_public()
+        # blobs are content-addressed, so re-sending the same media reuses the existing blob
+        blob_name = self.prefix + hash_file(file_path) + os.path.splitext(file_path.name)[1].lower()
+        with self._uploaded_lock:
+            if blob_name in self._uploaded:
+                self._uploaded.move_to_end(blob_name)
+                return self._uploaded[blob_name]
+        blob = self.bucket.blob(blob_name, chunk_size=self.chunk_size)
+        if not blob.exists():
+            mime_type = guess_type(file_path)[0] or 'application/octet-stream'
+            try:
+                with stage("gcs.upload") as upload:
+                    upload.add_bytes(file_path.stat().st_size)
+                    blob.upload_from_filename(
+                        str(file_path), content_type=mime_type, predefined_acl='publicRead', if_generation_match=0)
+            except PreconditionFailed:
+                pass  # the same content was uploaded concurrently
+        with self._uploaded_lock:
+            self._uploaded[blob_name] = blob.public_url
+            if len(self._uploaded) > self.max_known_blobs:
+                self._uploaded.popitem(last=False)
         return blob.public_url
+
+    async def save_and_get_url(self, file_path: Path) -> str:
+        with stage("file_storage.save"):
+            return await asyncio.to_thread(self._upload, file_path)
+
+
+class LocalFileStorage(FileStorage):
+    """Keeps files in a local directory which is served at base_url (e.g. by a reverse proxy),
+    content-addressed like GoogleCloudStorage."""
+
+    def __init__(self, directory: Path, base_url: str):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _save(self, file_path: Path) -> str:
+        name = hash_file(file_path) + os.path.splitext(file_path.name)[1].lower()
+        target = self.directory / name
+        if not target.exists():
+            # copied under a temporary name first, so a file at the final path is always complete
+            with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as temporary_file:
+                with open(file_path, "rb") as source:
+                    shutil.copyfileobj(source, temporary_file)
+            os.replace(temporary_file.name, target)
+        return f"{self.base_url}/{name}"
+
+    async def save_and_get_url(self, file_path: Path) -> str:
+        with stage("file_storage.save"):
+            return await asyncio.to_thread(self._save, file_path)
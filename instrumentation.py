@@ -0,0 +1,126 @@
+"""Per-stage latency, bytes and error metrics exported for Prometheus, with optional OpenTelemetry spans.
+
+Nothing is recorded until enable() is called: until then stage() returns a shared no-op context manager,
+so instrumented code pays one function call per stage.
+
+    with stage("gcs.upload") as upload:
+        upload.add_bytes(size)
+        ...
+"""
+import asyncio
+import time
+from typing import Optional
+
+# request latencies range from milliseconds (Notion) to minutes (long transcriptions)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+_enabled = False
+_tracer = None
+_server = None
+registry = None
+_stage_seconds = None
+_stage_errors = None
+_stage_bytes = None
+_queue_wait_seconds = None
+# labelled children by stage name, labels() takes a lock and builds a key on every call
+_stage_children = {}
+
+
+class _NoopStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def add_bytes(self, size: int):
+        pass
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+class _Stage:
+    __slots__ = ("name", "start", "span")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        if _tracer is not None:
+            self.span = _tracer.start_as_current_span(self.name)
+            self.span.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        _children(self.name)[0].observe(time.perf_counter() - self.start)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            _stage_errors.labels(self.name, exc_type.__name__).inc()
+        if self.span is not None:
+            self.span.__exit__(exc_type, exc, traceback)
+        return False
+
+    def add_bytes(self, size: int):
+        _children(self.name)[1].inc(size)
+
+
+def _children(name: str):
+    children = _stage_children.get(name)
+    if children is None:
+        children = _stage_children[name] = (_stage_seconds.labels(name), _stage_bytes.labels(name))
+    return children
+
+
+def stage(name: str):
+    """Measures the enclosed block as the stage name, errors are counted by exception type."""
+    return _Stage(name) if _enabled else _NOOP_STAGE
+
+
+def observe_wait(queue: str, seconds: float):
+    """Records how long an item waited in queue before it was processed."""
+    if _enabled:
+        _queue_wait_seconds.labels(queue).observe(seconds)
+
+
+def enable(metrics_port: Optional[int] = None, metrics_address: str = "127.0.0.1", tracing: bool = False) -> Optional[int]:
+    """Starts recording. With metrics_port the metrics are served at http://metrics_address:port/metrics
+    (port 0 picks a free port), the bound port is returned. With tracing every stage is also an
+    OpenTelemetry span of the globally configured tracer provider."""
+    global _enabled, _tracer, _server, registry, _stage_seconds, _stage_errors, _stage_bytes, _queue_wait_seconds
+    from prometheus_client import CollectorRegistry, Counter, Histogram, start_http_server
+
+    registry = CollectorRegistry()
+    _stage_children.clear()
+    _stage_seconds = Histogram(
+        "telegram2notion_stage_seconds", "Duration of a processing stage", ["stage"],
+        buckets=LATENCY_BUCKETS, registry=registry)
+    _stage_errors = Counter(
+        "telegram2notion_stage_errors", "Failed stages by exception type", ["stage", "error"], registry=registry)
+    _stage_bytes = Counter(
+        "telegram2notion_stage_bytes", "Bytes processed by a stage", ["stage"], registry=registry)
+    _queue_wait_seconds = Histogram(
+        "telegram2notion_queue_wait_seconds", "Time items waited in a queue", ["queue"],
+        buckets=LATENCY_BUCKETS, registry=registry)
+    if tracing:
+        from opentelemetry import trace
+        _tracer = trace.get_tracer("telegram2notion")
+    port = None
+    if metrics_port is not None:
+        _server, _ = start_http_server(metrics_port, metrics_address, registry=registry)
+        port = _server.server_port
+    _enabled = True
+    return port
+
+
+def disable():
+    global _enabled, _tracer, _server
+    _enabled = False
+    _tracer = None
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
@@ -1,42 +1,112 @@
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import httpx
 from dotenv import load_dotenv
 
+import instrumentation
 from document_storage import RecognisingDocumentsStorage, NotionDocumentsStorage
 from file_storage import GoogleCloudStorage
+from notion_scheduler import NotionRequestScheduler
+from openai_scheduler import OpenAIRequestScheduler
+from recognition_cache import RecognitionCache
+from search_index import SearchIndex
 from recognisers import WebPageRecogniser, RedirectingFileRecogniser, PDFPlumberFileRecogniser, \
-    SoundOnlyVideoRecogniser, VisionGPTImageRecogniser, WhisperAudioRecogniser
-from tg import TelegramBot
+    SoundOnlyVideoRecogniser, VisionGPTImageRecogniser, WhisperAudioRecogniser, CachingFileRecogniser, \
+    CachingURLRecogniser
+from task_queue import SQLiteTaskQueue
+from tg import BotUser, TelegramBot
+from users import UserConfig, load_users
 
 if __name__ == "__main__":
     load_dotenv()
+    if os.getenv("METRICS_PORT"):
+        instrumentation.enable(metrics_port=int(os.environ["METRICS_PORT"]), tracing=os.getenv("TRACING") == "1")
+    if os.getenv("USERS_CONFIG"):
+        user_configs = load_users(Path(os.environ["USERS_CONFIG"]))
+    else:
+        user_id = int(os.getenv("TELEGRAM_USER_ID"))
+        user_configs = {user_id: UserConfig(user_id, os.environ["NOTION_TOKEN"], os.environ["NOTION_PARENT_DOCUMENT"])}
     file_storage = GoogleCloudStorage(Path(os.environ["GOOGLE_APPLICATION_CREDENTIALS"]), "tg2notion")
-    base_document_storage = NotionDocumentsStorage(
-        token=os.environ["NOTION_TOKEN"],
-        parent_document_id=os.environ["NOTION_PARENT_DOCUMENT"],
-        file_storage=file_storage,
+    # every user shares one process: the Notion connection pool, recognisers and their cache
+    notion_http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=10, max_keepalive_connections=10))
+    # Notion rate limits apply per integration token
+    notion_schedulers = {}
+    recognition_cache = RecognitionCache(Path(os.getenv("RECOGNITION_CACHE_PATH", "recognition_cache.sqlite")))
+    # budgets of every model until the rate limit headers of its responses tell its own limits
+    openai_scheduler = OpenAIRequestScheduler(
+        requests_per_minute=float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500")),
+        tokens_per_minute=float(os.getenv("OPENAI_TOKENS_PER_MINUTE", "30000")),
     )
-    audio_recogniser = WhisperAudioRecogniser()
-    image_recogniser = VisionGPTImageRecogniser()
-    video_recogniser = SoundOnlyVideoRecogniser(audio_recogniser)
-    pdf_recogniser = PDFPlumberFileRecogniser(image_recogniser)
+    audio_recogniser = CachingFileRecogniser(WhisperAudioRecogniser(scheduler=openai_scheduler), recognition_cache)
+    image_recogniser = CachingFileRecogniser(VisionGPTImageRecogniser(scheduler=openai_scheduler), recognition_cache)
+    video_recogniser = CachingFileRecogniser(SoundOnlyVideoRecogniser(audio_recogniser), recognition_cache)
+    pdf_process_pool = ProcessPoolExecutor(
+        max_workers=int(os.getenv("PDF_WORKERS", "2")), mp_context=multiprocessing.get_context("spawn"))
+    pdf_recogniser = CachingFileRecogniser(
+        PDFPlumberFileRecogniser(image_recogniser, process_pool=pdf_process_pool), recognition_cache)
     file_recogniser = RedirectingFileRecogniser(
         audio_recogniser, image_recogniser, video_recogniser, pdf_recogniser
     )
-    url_recogniser = WebPageRecogniser()
-    document_storage = RecognisingDocumentsStorage(
-        base_doc_storage=base_document_storage,
-        audio_recogniser=audio_recogniser,
-        image_recogniser=image_recogniser,
-        video_recogniser=video_recogniser,
-        handwriting_recogniser=image_recogniser,
-        file_recogniser=file_recogniser,
-        url_recogniser=url_recogniser,
+    url_recogniser = CachingURLRecogniser(WebPageRecogniser(), recognition_cache, ttl_seconds=60 * 60)
+    search_index_path = Path(os.getenv("SEARCH_INDEX_PATH", "search_index.sqlite"))
+    users = {}
+    for user in user_configs.values():
+        if user.notion_token not in notion_schedulers:
+            notion_schedulers[user.notion_token] = NotionRequestScheduler(
+                requests_per_second=float(os.getenv("NOTION_REQUESTS_PER_SECOND", "3")))
+        # search results must not leak between users
+        search_index = SearchIndex(search_index_path if len(user_configs) == 1 else search_index_path.with_name(
+            f"{search_index_path.stem}.{user.telegram_user_id}{search_index_path.suffix}"))
+        document_storage = RecognisingDocumentsStorage(
+            base_doc_storage=NotionDocumentsStorage(
+                token=user.notion_token,
+                parent_document_id=user.notion_parent_document,
+                file_storage=file_storage.with_prefix(user.storage_prefix),
+                http_client=notion_http_client,
+                scheduler=notion_schedulers[user.notion_token],
+            ),
+            audio_recogniser=audio_recogniser,
+            image_recogniser=image_recogniser,
+            video_recogniser=video_recogniser,
+            handwriting_recogniser=image_recogniser,
+            file_recogniser=file_recogniser,
+            url_recogniser=url_recogniser,
+            progressive=os.getenv("PROGRESSIVE_PUBLISHING", "1") == "1",
+            search_index=search_index,
+        )
+        users[user.telegram_user_id] = BotUser(document_storage, search_index)
+    task_queue = SQLiteTaskQueue(
+        Path(os.getenv("TASK_QUEUE_PATH", "tasks.sqlite")),
+        max_running_per_owner=int(os.environ["MAX_TASKS_PER_USER"]) if os.getenv("MAX_TASKS_PER_USER") else None,
+        owner_limits={
+            str(user.telegram_user_id): user.max_running_tasks
+            for user in user_configs.values() if user.max_running_tasks is not None
+        },
     )
     bot = TelegramBot(
         token=os.getenv("TELEGRAM_TOKEN"),
-        user_id=int(os.getenv("TELEGRAM_USER_ID")),
-        doc_storage=document_storage
+        user_id=None,
+        doc_storage=None,
+        users=users,
+        task_queue=task_queue,
+        workers=int(os.getenv("WORKERS", "4")),
+        album_window_seconds=float(os.getenv("ALBUM_WINDOW_SECONDS", "1")),
+        text_window_seconds=float(os.getenv("TEXT_WINDOW_SECONDS", "2")),
+        concurrent_updates=int(os.getenv("CONCURRENT_UPDATES", "8")),
+        max_memory_file_bytes=int(os.environ["MAX_MEMORY_FILE_BYTES"]) if os.getenv("MAX_MEMORY_FILE_BYTES") else None,
+        # a self-hosted Bot API server
+        base_url=os.getenv("TELEGRAM_BASE_URL"),
+        base_file_url=os.getenv("TELEGRAM_BASE_FILE_URL"),
     )
-    bot.run_polling()
+    if os.getenv("WEBHOOK_URL"):
+        bot.run_webhook(
+            listen=os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            webhook_url=os.environ["WEBHOOK_URL"],
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+        )
+    else:
+        bot.run_polling()
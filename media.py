@@ -0,0 +1,196 @@
+import asyncio
+import io
+import os
+import re
+from pathlib import Path
+from typing import TYPE_CHECKING, List, NamedTuple, Optional, Tuple
+
+from instrumentation import stage
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+FFMPEG = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+# extensions the transcription API accepts as they are
+TRANSCRIBABLE_AUDIO_EXTENSIONS = {".mp3", ".mpeg", ".mpga", ".m4a", ".ogg", ".oga", ".webm", ".flac"}
+# codecs of audio tracks which can be stream-copied into an accepted container
+STREAM_COPY_CONTAINERS = {"opus": ".ogg", "vorbis": ".ogg", "mp3": ".mp3", "aac": ".m4a", "flac": ".flac"}
+
+
+# image formats the vision API accepts, with their MIME types
+VISION_IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+
+class AudioChunk(NamedTuple):
+    path: Path
+    start: float
+    end: float
+
+
+async def run_ffmpeg(*args: str, check: bool = True) -> str:
+    """Runs ffmpeg without blocking the event loop and returns its log (stderr)."""
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG, "-hide_banner", "-nostdin", *args,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate()
+    log = stderr.decode(errors="replace")
+    if check and process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed with code {process.returncode}: {log[-2000:]}")
+    return log
+
+
+def _parse_duration(log: str) -> float:
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", log)
+    if not match:
+        raise ValueError("Could not find duration in ffmpeg output")
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+async def detect_silences(
+        file_path: Path, noise_db: int = -35, min_silence_seconds: float = 0.4
+) -> Tuple[float, List[Tuple[float, float]]]:
+    """Returns the duration of the audio track and its (start, end) silence intervals."""
+    log = await run_ffmpeg(
+        "-i", str(file_path), "-vn", "-af", f"silencedetect=noise={noise_db}dB:d={min_silence_seconds}",
+        "-f", "null", "-"
+    )
+    duration = _parse_duration(log)
+    starts = [float(value) for value in re.findall(r"silence_start: (-?\d+(?:\.\d+)?)", log)]
+    ends = [float(value) for value in re.findall(r"silence_end: (\d+(?:\.\d+)?)", log)]
+    # a silence lasting until the end of the file has no silence_end
+    ends += [duration] * (len(starts) - len(ends))
+    return duration, [(max(0.0, start), end) for start, end in zip(starts, ends)]
+
+
+def plan_chunks(duration: float, silences: List[Tuple[float, float]], max_chunk_seconds: float) -> List[Tuple[float, float]]:
+    """Cuts [0, duration] into pieces no longer than max_chunk_seconds, preferring the middle of silences."""
+    cut_points = [(start + end) / 2 for start, end in silences]
+    chunks = []
+    chunk_start = 0.0
+    while duration - chunk_start > max_chunk_seconds:
+        limit = chunk_start + max_chunk_seconds
+        candidates = [point for point in cut_points if chunk_start < point <= limit]
+        chunk_end = candidates[-1] if candidates else limit
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    chunks.append((chunk_start, duration))
+    return chunks
+
+
+async def split_audio(file_path: Path, output_dir: Path, max_chunk_bytes: int) -> List[AudioChunk]:
+    """Splits the audio track at silences into stream-copied chunks smaller than max_chunk_bytes."""
+    with stage("audio.split") as split:
+        split.add_bytes(file_path.stat().st_size)
+        duration, silences = await detect_silences(file_path)
+        bytes_per_second = file_path.stat().st_size / max(duration, 0.001)
+        # margin for container overhead and bitrate variation inside the file
+        max_chunk_seconds = max(1.0, 0.9 * max_chunk_bytes / bytes_per_second)
+        chunks = []
+        for index, (start, end) in enumerate(plan_chunks(duration, silences, max_chunk_seconds)):
+            chunks.append(AudioChunk(output_dir / f"chunk_{index:03d}{file_path.suffix}", start, end))
+        await asyncio.gather(*[
+            run_ffmpeg(
+                "-ss", f"{chunk.start:.3f}", "-to", f"{chunk.end:.3f}", "-i", str(file_path),
+                "-vn", "-c:a", "copy", "-y", str(chunk.path)
+            )
+            for chunk in chunks
+        ])
+        return chunks
+
+
+async def probe_audio_codec(file_path: Path) -> Optional[str]:
+    """Codec of the first audio track, None if the file has no audio."""
+    # without an output ffmpeg only prints the input description and exits with an error
+    log = await run_ffmpeg("-i", str(file_path), check=False)
+    match = re.search(r"Stream #\d+:\d+.*?: Audio: (\w+)", log.split("Stream mapping")[0])
+    return match.group(1) if match else None
+
+
+async def prepare_audio(file_path: Path, output_dir: Path) -> Path:
+    """Returns a compact audio-only file the transcription API accepts. Audio files in an accepted format
+    are returned as they are; otherwise the audio track is stream-copied when its codec is accepted, or
+    downmixed and resampled to 16kHz mono opus. Video frames are never decoded."""
+    if file_path.suffix.lower() in TRANSCRIBABLE_AUDIO_EXTENSIONS:
+        return file_path
+    with stage("audio.prepare") as prepare:
+        prepare.add_bytes(file_path.stat().st_size)
+        codec = await probe_audio_codec(file_path)
+        if codec is None:
+            raise ValueError(f"{file_path.name} has no audio track")
+        if codec in STREAM_COPY_CONTAINERS:
+            output_path = output_dir / (file_path.stem + STREAM_COPY_CONTAINERS[codec])
+            codec_args = ["-c:a", "copy"]
+        else:
+            output_path = output_dir / (file_path.stem + ".ogg")
+            codec_args = ["-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", "-application", "voip"]
+        await run_ffmpeg("-i", str(file_path), "-map", "0:a:0", "-vn", "-sn", "-dn", *codec_args, "-y", str(output_path))
+        return output_path
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    mime_type: str
+    # width and height, the vision model is billed by them
+    size: Tuple[int, int]
+
+
+def _fit(image: "Image.Image", max_side: int, max_short_side: int) -> "Image.Image":
+    from PIL import Image
+
+    scale = min(1.0, max_side / max(image.size), max_short_side / min(image.size))
+    if scale == 1.0:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.LANCZOS)
+
+
+def _encode(image: "Image.Image", jpeg_quality: int) -> PreparedImage:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    # transparency and few-colour images (screenshots, diagrams) stay sharp as png
+    if image.mode in ("RGBA", "LA", "P") or image.getcolors(maxcolors=256) is not None:
+        if image.getcolors(maxcolors=256) is not None:
+            # at most 256 colours, so a palette image is lossless and much smaller
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB").quantize(
+                colors=256, method=Image.Quantize.FASTOCTREE)
+        image.save(buffer, format="PNG", optimize=True)
+        return PreparedImage(buffer.getvalue(), "image/png", image.size)
+    image.convert("RGB").save(buffer, format="JPEG", quality=jpeg_quality, optimize=True)
+    return PreparedImage(buffer.getvalue(), "image/jpeg", image.size)
+
+
+def prepare_image(
+        file_path: Path,
+        max_side: int = 2048,
+        max_short_side: int = 768,
+        max_aspect_ratio: float = 3.0,
+        jpeg_quality: int = 85,
+) -> List[PreparedImage]:
+    """Downscales the image to the resolution the vision model actually uses (fits max_side, short side
+    at most max_short_side) and re-encodes it. Images taller than max_aspect_ratio are cut into tiles
+    so text on long screenshots keeps its resolution. Images which need no resizing and are already
+    in an accepted format are returned as they are. CPU-bound, run it in a worker thread."""
+    # Pillow is imported when the first image arrives, not at startup
+    from PIL import Image, ImageOps
+
+    with stage("image.prepare") as prepare:
+        prepare.add_bytes(file_path.stat().st_size)
+        with Image.open(file_path) as image:
+            image_format = image.format
+            animated = getattr(image, "is_animated", False)
+            image = ImageOps.exif_transpose(image)
+            image.load()
+        width, height = image.size
+        if height / width > max_aspect_ratio:
+            tile_height = width * 2
+            tiles = [image.crop((0, top, width, min(height, top + tile_height))) for top in range(0, height, tile_height)]
+        else:
+            tiles = [image]
+        if (len(tiles) == 1 and image_format in VISION_IMAGE_MIME_TYPES and not animated
+                and _fit(image, max_side, max_short_side) is image):
+            return [PreparedImage(file_path.read_bytes(), VISION_IMAGE_MIME_TYPES[image_format], image.size)]
+        return [_encode(_fit(tile, max_side, max_short_side), jpeg_quality) for tile in tiles]
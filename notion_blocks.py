@@ -0,0 +1,140 @@
+import re
+from typing import Dict, Iterable, Iterator, List
+
+# limits of the Notion API
+MAX_RICH_TEXT_CHARS = 2000
+MAX_RICH_TEXT_ITEMS = 100
+MAX_CHILDREN_PER_REQUEST = 100
+MAX_BLOCKS_PER_REQUEST = 1000
+MAX_TABLE_WIDTH = 100
+
+# markdown headings and the page headers written by PDFPlumberFileRecogniser
+_HEADING = re.compile(r"^(#{1,3}) +(.+)$")
+_PDF_PAGE_HEADING = re.compile(r"^Page: \d+$")
+_TABLE_ROW = re.compile(r"^\|.*\|$")
+_TABLE_SEPARATOR = re.compile(r"^\|(\s*:?-+:?\s*\|)+$")
+
+
+def split_text(text: str, max_chars: int = MAX_RICH_TEXT_CHARS) -> List[str]:
+    """Splits text into pieces of at most max_chars, preferring line and then word boundaries."""
+    pieces = []
+    while len(text) > max_chars:
+        cut = text.rfind("\n", 0, max_chars + 1)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, max_chars + 1)
+        if cut <= 0:
+            cut = max_chars
+        else:
+            cut += 1  # the separator stays at the end of the piece, so joining pieces restores the text
+        pieces.append(text[:cut])
+        text = text[cut:]
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def _rich_text(text: str) -> List[Dict]:
+    return [{"type": "text", "text": {"content": piece}} for piece in split_text(text)]
+
+
+def paragraph_blocks(text: str) -> List[Dict]:
+    rich_text = _rich_text(text)
+    return [
+        {"object": "block", "type": "paragraph", "paragraph": {"rich_text": rich_text[i:i + MAX_RICH_TEXT_ITEMS]}}
+        for i in range(0, len(rich_text), MAX_RICH_TEXT_ITEMS)
+    ]
+
+
+def heading_block(text: str, level: int = 2) -> Dict:
+    heading_type = f"heading_{level}"
+    return {"object": "block", "type": heading_type, heading_type: {"rich_text": _rich_text(text)[:MAX_RICH_TEXT_ITEMS]}}
+
+
+def table_blocks(lines: List[str]) -> List[Dict]:
+    """Converts markdown table lines to Notion tables, the header row is repeated in every
+    table when the rows do not fit into one request."""
+    has_header = len(lines) > 1 and bool(_TABLE_SEPARATOR.match(lines[1]))
+    rows = [[cell.strip() for cell in line.strip("|").split("|")] for line in lines if not _TABLE_SEPARATOR.match(line)]
+    width = min(MAX_TABLE_WIDTH, max(len(row) for row in rows))
+    rows = [(row + [""] * width)[:width] for row in rows]
+    header, body = (rows[:1], rows[1:]) if has_header else ([], rows)
+    rows_per_table = MAX_CHILDREN_PER_REQUEST - len(header)
+    blocks = []
+    for i in range(0, max(len(body), 1), rows_per_table):
+        table_rows = header + body[i:i + rows_per_table]
+        blocks.append({
+            "object": "block",
+            "type": "table",
+            "table": {
+                "table_width": width,
+                "has_column_header": has_header,
+                "has_row_header": False,
+                "children": [
+                    {"object": "block", "type": "table_row",
+                     "table_row": {"cells": [_rich_text(cell)[:MAX_RICH_TEXT_ITEMS] for cell in row]}}
+                    for row in table_rows
+                ],
+            },
+        })
+    return blocks
+
+
+def build_blocks(text: str) -> Iterator[Dict]:
+    """Lazily converts recognised text to paragraph, heading and table blocks which fit Notion limits.
+    Paragraphs are separated by blank lines, single line breaks are kept inside paragraphs."""
+    paragraph: List[str] = []
+    table: List[str] = []
+
+    def flush() -> Iterator[Dict]:
+        if paragraph:
+            yield from paragraph_blocks("\n".join(paragraph))
+            paragraph.clear()
+        if table:
+            yield from table_blocks(table)
+            table.clear()
+
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if _TABLE_ROW.match(stripped):
+            if paragraph:
+                yield from flush()
+            table.append(stripped)
+            continue
+        if table:
+            yield from flush()
+        heading = _HEADING.match(stripped)
+        if heading or _PDF_PAGE_HEADING.match(stripped):
+            yield from flush()
+            if heading:
+                yield heading_block(heading.group(2), len(heading.group(1)))
+            else:
+                yield heading_block(stripped)
+        elif not stripped:
+            yield from flush()
+        else:
+            paragraph.append(line)
+    yield from flush()
+
+
+def _size(block: Dict) -> int:
+    return 1 + len(block[block["type"]].get("children", []))
+
+
+def batch_blocks(
+        blocks: Iterable[Dict],
+        max_children: int = MAX_CHILDREN_PER_REQUEST,
+        max_blocks: int = MAX_BLOCKS_PER_REQUEST,
+) -> Iterator[List[Dict]]:
+    """Groups blocks into batches which can be sent in one request: at most max_children top level
+    blocks and max_blocks blocks including nested ones."""
+    batch: List[Dict] = []
+    batch_size = 0
+    for block in blocks:
+        size = _size(block)
+        if batch and (len(batch) >= max_children or batch_size + size > max_blocks):
+            yield batch
+            batch, batch_size = [], 0
+        batch.append(block)
+        batch_size += size
+    if batch:
+        yield batch
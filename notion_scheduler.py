@@ -0,0 +1,127 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Dict, TypeVar
+
+import httpx
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+from instrumentation import observe_wait, stage
+
+T = TypeVar("T")
+
+RETRYABLE_STATUSES = {429, 409, 502, 503, 504}
+# Notion did not apply the request, so it is safe to send again even if it is not idempotent
+REJECTED_STATUSES = {429, 409}
+
+
+class NotionQueueFullError(Exception):
+    pass
+
+
+class NotionRequestScheduler:
+    """Paces all requests of one Notion integration with a token bucket (Notion allows about 3 requests
+    per second on average), waits out Retry-After on 429 for every queued request, and retries
+    transient errors and timeouts with jittered exponential backoff.
+
+    A gateway error or a timeout may come after Notion has applied the request, so requests which
+    are not idempotent (creating a page, appending blocks) are retried only when Notion rejected them."""
+
+    def __init__(
+            self,
+            requests_per_second: float = 3.0,
+            burst: int = 3,
+            max_queue: int = 1000,
+            max_retries: int = 5,
+            base_backoff_seconds: float = 0.5,
+            max_backoff_seconds: float = 30.0,
+    ):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "total_wait_seconds": self.total_wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+            "mean_wait_seconds": self.total_wait_seconds / self.requests if self.requests else 0.0,
+        }
+
+    async def _acquire(self):
+        # the lock makes waiters take tokens in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.requests_per_second)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.requests_per_second)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff_seconds, self.base_backoff_seconds * 2 ** attempt))
+
+    @staticmethod
+    def _retryable(error: Exception, idempotent: bool) -> bool:
+        if isinstance(error, HTTPResponseError):
+            return error.status in (RETRYABLE_STATUSES if idempotent else REJECTED_STATUSES)
+        # the request was never sent if the connection could not be made
+        return idempotent or isinstance(error, httpx.ConnectError)
+
+    async def run(self, request: Callable[[], Awaitable[T]], idempotent: bool = True) -> T:
+        """Sends request() when the rate allows it, retrying rate limited and transient failures.
+        Requests which are not idempotent are not retried after gateway errors and timeouts."""
+        if self.queue_depth >= self.max_queue:
+            raise NotionQueueFullError(f"{self.queue_depth} Notion requests are already waiting")
+        for attempt in range(self.max_retries + 1):
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            queued_at = time.monotonic()
+            try:
+                await self._acquire()
+            finally:
+                self.queue_depth -= 1
+            wait_seconds = time.monotonic() - queued_at
+            self.requests += 1
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            observe_wait("notion", wait_seconds)
+            try:
+                with stage("notion.request"):
+                    return await request()
+            except (HTTPResponseError, RequestTimeoutError, httpx.TransportError) as e:
+                if not self._retryable(e, idempotent) or attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                if isinstance(e, HTTPResponseError) and e.status == 429:
+                    self.rate_limited += 1
+                    retry_after = float(e.headers.get("Retry-After") or self._backoff(attempt))
+                    # every queued request waits, not only the one that was rejected
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+                    self._tokens = 0.0
+                else:
+                    await asyncio.sleep(self._backoff(attempt))
+        raise AssertionError("unreachable")
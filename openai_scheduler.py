@@ -0,0 +1,294 @@
+import asyncio
+import heapq
+import itertools
+import math
+import random
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+
+from instrumentation import observe_wait
+
+if TYPE_CHECKING:
+    from openai._legacy_response import LegacyAPIResponse
+
+# lower is sent first: messages someone is waiting for go before pages of large documents
+INTERACTIVE = 0
+BULK = 1
+_priority: ContextVar[int] = ContextVar("openai_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def bulk_priority():
+    """OpenAI requests made inside the block, and by tasks created in it, yield to interactive ones."""
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def estimate_text_tokens(text: str) -> int:
+    # about 4 characters per token for English, more tokens for other languages, so rounded up
+    return len(text) // 3 + 1
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Tokens of an image at high detail: it is fitted into 2048x2048, its short side into 768 px,
+    and billed per 512 px tile."""
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Seconds in a rate limit header: "20ms", "6m0s", "1.5s" or a plain number of seconds."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+class _ModelBudget:
+    """Rate limit state of one model: OpenAI limits the requests and tokens of every model separately."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, concurrency: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.concurrency = concurrency
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.successes = 0
+        # (priority, arrival) of waiting requests, the smallest is sent next
+        self.waiting: List[Tuple[int, int]] = []
+        self.condition = asyncio.Condition()
+
+    def delay(self, tokens: int) -> float:
+        """Seconds until a request of `tokens` fits both budgets, 0 if it can be sent now."""
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+        self._updated_at = now
+        return max(
+            0.0,
+            self.blocked_until - now,
+            (1 - self._requests) * 60 / self.requests_per_minute,
+            (tokens - self._tokens) * 60 / self.tokens_per_minute,
+        )
+
+    def take(self, tokens: int):
+        self._requests -= 1
+        self._tokens -= tokens
+
+    def refund(self, tokens: float):
+        self._tokens = min(self.tokens_per_minute, self._tokens + tokens)
+
+    def update(self, headers: Mapping[str, str]):
+        """Follows the x-ratelimit headers, models without a token limit (whisper) send none for tokens."""
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        if limit_requests:
+            self.requests_per_minute = float(limit_requests)
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        if limit_tokens:
+            self.tokens_per_minute = float(limit_tokens)
+        # the remaining budget also counts requests of other processes using the same key
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests:
+            self._requests = min(self._requests, float(remaining_requests))
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens:
+            self._tokens = min(self._tokens, float(remaining_tokens))
+
+
+class OpenAIRequestScheduler:
+    """Paces all OpenAI requests of one API key within the requests and tokens per minute budgets of each model.
+
+    Every request states its model and estimated token cost and waits until both budgets of the model
+    allow it; requests which are not billed by tokens (transcriptions) state no tokens and are limited
+    by requests only. Interactive requests are sent before bulk ones of the same model (see bulk_priority),
+    in arrival order within a priority. The budgets follow the x-ratelimit headers of the responses, and
+    the number of concurrent requests of a model grows by one after as many successes as there are slots
+    and halves on every 429, when every queued request of the model also waits out Retry-After.
+    Transient errors are retried with jittered exponential backoff."""
+
+    def __init__(
+            self,
+            requests_per_minute: float = 500.0,
+            tokens_per_minute: float = 30000.0,
+            initial_concurrency: int = 4,
+            max_concurrency: int = 32,
+            max_retries: int = 5,
+            base_backoff_seconds: float = 1.0,
+            max_backoff_seconds: float = 60.0,
+    ):
+        """requests_per_minute and tokens_per_minute are the budgets of every model until its responses tell its limits."""
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.budgets: Dict[str, _ModelBudget] = {}
+        self._arrivals = itertools.count()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.estimated_tokens = 0
+        self.used_tokens = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "estimated_tokens": self.estimated_tokens,
+            "used_tokens": self.used_tokens,
+            "total_wait_seconds": self.total_wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+            "mean_wait_seconds": self.total_wait_seconds / self.requests if self.requests else 0.0,
+        }
+
+    def _budget(self, model: str) -> _ModelBudget:
+        budget = self.budgets.get(model)
+        if budget is None:
+            budget = self.budgets[model] = _ModelBudget(
+                self.requests_per_minute, self.tokens_per_minute, self.initial_concurrency)
+        return budget
+
+    async def _acquire(self, budget: _ModelBudget, tokens: int, priority: int):
+        entry = (priority, next(self._arrivals))
+        async with budget.condition:
+            # queued only once the lock is held, a caller cancelled while waiting for it leaves no entry behind
+            heapq.heappush(budget.waiting, entry)
+            try:
+                while True:
+                    # only the first waiter is timed, the others are woken when it is sent
+                    delay = None
+                    if budget.waiting[0] == entry and budget.in_flight < budget.concurrency:
+                        delay = budget.delay(tokens)
+                        if delay == 0:
+                            break
+                    try:
+                        await asyncio.wait_for(budget.condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                budget.waiting.remove(entry)
+                heapq.heapify(budget.waiting)
+                budget.condition.notify_all()
+                raise
+            heapq.heappop(budget.waiting)
+            budget.take(tokens)
+            budget.in_flight += 1
+            budget.condition.notify_all()
+
+    @staticmethod
+    async def _release(budget: _ModelBudget):
+        async with budget.condition:
+            budget.in_flight -= 1
+            budget.condition.notify_all()
+
+    def _on_success(self, budget: _ModelBudget, headers: Mapping[str, str]):
+        budget.update(headers)
+        budget.successes += 1
+        if budget.successes >= budget.concurrency and budget.concurrency < self.max_concurrency:
+            budget.concurrency += 1
+            budget.successes = 0
+
+    def _on_rate_limited(self, budget: _ModelBudget, headers: Mapping[str, str], attempt: int):
+        self.rate_limited += 1
+        budget.update(headers)
+        budget.concurrency = max(1, budget.concurrency // 2)
+        budget.successes = 0
+        retry_after = None
+        if headers.get("retry-after-ms"):
+            retry_after = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"):
+            retry_after = _parse_duration(headers["retry-after"])
+        if retry_after is None:
+            resets = [_parse_duration(headers[name]) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+                      if headers.get(name)]
+            retry_after = max([reset for reset in resets if reset is not None], default=None)
+        if retry_after is None:
+            retry_after = self._backoff(attempt)
+        # every queued request of the model waits, not only the one that was rejected
+        budget.blocked_until = max(budget.blocked_until, time.monotonic() + retry_after)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff_seconds, self.base_backoff_seconds * 2 ** attempt))
+
+    async def run(
+            self,
+            request: Callable[[], Awaitable["LegacyAPIResponse"]],
+            model: str,
+            tokens: int = 0,
+            priority: Optional[int] = None,
+    ):
+        """Sends request() to model when its budgets allow it and returns the parsed response. request() must
+        return a raw response (client.with_raw_response...) of a client which does not retry by itself.
+        priority defaults to the one set by bulk_priority."""
+        from openai import APIConnectionError, APIStatusError, RateLimitError
+
+        if priority is None:
+            priority = _priority.get()
+        budget = self._budget(model)
+        for attempt in range(self.max_retries + 1):
+            # a request larger than the whole budget is sent when the budget is full
+            attempt_tokens = int(min(tokens, budget.tokens_per_minute))
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            queued_at = time.monotonic()
+            try:
+                await self._acquire(budget, attempt_tokens, priority)
+            finally:
+                self.queue_depth -= 1
+            wait_seconds = time.monotonic() - queued_at
+            self.requests += 1
+            self.estimated_tokens += attempt_tokens
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            observe_wait("openai", wait_seconds)
+            try:
+                response = await request()
+                self._on_success(budget, response.headers)
+            except RateLimitError as e:
+                # an exhausted quota does not recover by waiting
+                if attempt == self.max_retries or e.code == "insufficient_quota":
+                    raise
+                self._on_rate_limited(budget, e.response.headers, attempt)
+                self.retries += 1
+                continue
+            except (APIStatusError, APIConnectionError) as e:
+                if isinstance(e, APIStatusError) and e.status_code < 500 or attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                backoff = self._backoff(attempt)
+            else:
+                result = response.parse()
+                usage = getattr(result, "usage", None)
+                if attempt_tokens and usage is not None and usage.total_tokens is not None:
+                    # unused estimated tokens go back to the budget
+                    self.used_tokens += usage.total_tokens
+                    budget.refund(attempt_tokens - usage.total_tokens)
+                return result
+            finally:
+                await self._release(budget)
+            await asyncio.sleep(backoff)
+        raise AssertionError("unreachable")
@@ -1,17 +1,39 @@
 import asyncio
 import base64
-import tempfile
+import hashlib
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from contextlib import aclosing
 from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
-import pdfplumber
-import pandas as pd
-from moviepy.editor import VideoFileClip
-from openai import AsyncOpenAI
+import httpx
 
-import scrapy
-from scrapy.crawler import CrawlerProcess
-from bs4 import BeautifulSoup
+from instrumentation import stage
+from media import AudioChunk, split_audio, prepare_audio, prepare_image
+from openai_scheduler import OpenAIRequestScheduler, bulk_priority, estimate_image_tokens, estimate_text_tokens
+from recognition_cache import RecognitionCache
+from utils import cancel_and_wait, hash_file, temporary_directory
+
+# openai, pdfplumber and lxml are imported when they are first used, so that the bot starts
+# polling without loading backends for media which may never arrive
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+OPENAI_MAX_CONNECTIONS = 20
+_shared_openai_client: Optional["AsyncOpenAI"] = None
+
+
+def shared_openai_client() -> "AsyncOpenAI":
+    """The pooled client of every recogniser created without its own client, created on first use."""
+    global _shared_openai_client
+    if _shared_openai_client is None:
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        _shared_openai_client = AsyncOpenAI(http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS)))
+    return _shared_openai_client
 
 
 class FileRecogniser(ABC):
@@ -19,50 +41,151 @@ class FileRecogniser(ABC):
     async def recognise(self, file_path: Path) -> str:
         pass
 
+    async def recognise_parts(self, file_path: Path) -> AsyncIterator[str]:
+        """Yields the recognised text in order, part by part as soon as each part is ready.
+        Concatenated parts are equal to the result of recognise()."""
+        yield await self.recognise(file_path)
+
+    def supports(self, file_path: Path) -> bool:
+        """Whether the file can be recognised, judged by its name only."""
+        return True
+
+    @property
+    def identity(self) -> str:
+        """Describes what the recogniser produces (model, prompt), used in cache keys."""
+        return type(self).__name__
+
 
 class WhisperAudioRecogniser(FileRecogniser):
-    def __init__(self):
-        self.client = AsyncOpenAI()
+    def __init__(
+            self,
+            client: Optional["AsyncOpenAI"] = None,
+            max_chunk_bytes: int = 24 * 1024 * 1024,
+            max_concurrent_chunks: int = 4,
+            timestamps: bool = False,
+            scheduler: Optional[OpenAIRequestScheduler] = None,
+    ):
+        """Files larger than max_chunk_bytes (the API upload limit is 25MB) are split at silences
+        and the chunks are transcribed concurrently.
+        Requests go through scheduler, which must be shared by every recogniser using the same API key."""
+        self._client = client
+        self.scheduler = scheduler or OpenAIRequestScheduler()
+        self.model = "whisper-1"
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_concurrent_chunks = max_concurrent_chunks
+        self.timestamps = timestamps
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        return self._client or shared_openai_client()
+
+    @property
+    def identity(self) -> str:
+        return f"{type(self).__name__}({self.model},{self.timestamps})"
+
+    async def _transcribe(self, file_path: Path) -> str:
+        async def request():
+            # opened for every attempt, a retried upload starts from the beginning of the file
+            with stage("openai.transcription") as transcription, open(file_path, "rb") as audio_file:
+                transcription.add_bytes(file_path.stat().st_size)
+                return await self.client.with_options(max_retries=0).audio.transcriptions.with_raw_response.create(
+                    model=self.model,
+                    file=audio_file,
+                    response_format="text"
+                )
+
+        # transcriptions are limited by requests per minute only
+        return await self.scheduler.run(request, self.model)
+
+    @staticmethod
+    def _format_timestamp(seconds: float) -> str:
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+    async def recognise_parts(self, file_path: Path) -> AsyncIterator[str]:
+        """Supported formats .mp3, .mpeg, .mpga, .m4a, .ogg, .oga, .webm, .flac as they are,
+        other audio and video files are converted first. Long files are yielded chunk by chunk."""
+        semaphore = asyncio.Semaphore(self.max_concurrent_chunks)
+
+        async def transcribe_chunk(chunk: AudioChunk) -> str:
+            async with semaphore:
+                return await self._transcribe(chunk.path)
+
+        with temporary_directory(file_path.stat().st_size) as work_dir:
+            audio_path = await prepare_audio(file_path, Path(work_dir))
+            if audio_path.stat().st_size <= self.max_chunk_bytes and not self.timestamps:
+                yield await self._transcribe(audio_path)
+                return
+            chunks = await split_audio(audio_path, Path(work_dir), self.max_chunk_bytes)
+            # all chunks are transcribed concurrently, but yielded in order
+            transcriptions = [asyncio.ensure_future(transcribe_chunk(chunk)) for chunk in chunks]
+            try:
+                for chunk_index, (chunk, transcription) in enumerate(zip(chunks, transcriptions)):
+                    text = (await transcription).strip()
+                    if self.timestamps:
+                        text = f"[{self._format_timestamp(chunk.start)}] {text}"
+                    yield text if chunk_index == 0 else "\n" + text
+            finally:
+                await cancel_and_wait(transcriptions)
 
     async def recognise(self, file_path: Path) -> str:
-        """Supported formats .mp3, .mp4, .mpeg, .mpga, .m4a, .wav, .webm"""
-        with open(file_path, "rb") as audio_file:
-            response = await self.client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                response_format="text"
-            )
-            return response
+        return "".join([part async for part in self.recognise_parts(file_path)])
 
 
 class VisionGPTImageRecogniser(FileRecogniser):
-    def __init__(self):
-        self.client = AsyncOpenAI()
+    def __init__(self, client: Optional["AsyncOpenAI"] = None, scheduler: Optional[OpenAIRequestScheduler] = None):
+        """Requests go through scheduler, which must be shared by every recogniser using the same API key."""
+        self._client = client
+        self.scheduler = scheduler or OpenAIRequestScheduler()
+        self.model = "gpt-4-vision-preview"
+        self.prompt = "You are a helpful assistant that describes images. Describe it very detailed, including every small detail. If there is text on image, transcribe it fully."
+        self.max_tokens = 3000
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        return self._client or shared_openai_client()
+
+    @property
+    def identity(self) -> str:
+        prompt_hash = hashlib.sha256(self.prompt.encode('utf-8')).hexdigest()[:16]
+        return f"{type(self).__name__}({self.model},{prompt_hash},{self.max_tokens})"
 
     async def recognise(self, file_path: Path) -> str:
-        """Supported formats .png .jpeg and .jpg, .webp, .gif"""
-        with open(file_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-        response = await self.client.chat.completions.create(
-            model="gpt-4-vision-preview",
-            temperature=0.0,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant that describes images. Describe it very detailed, including every small detail. If there is text on image, transcribe it fully."
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    ]
-                }
-            ],
-            max_tokens=3000
-        )
+        """Supported formats .png .jpeg and .jpg, .webp, .gif and anything else Pillow can open"""
+        images = await asyncio.to_thread(prepare_image, file_path)
+        # the prompt, every image and the longest possible answer count towards the tokens per minute
+        tokens = (estimate_text_tokens(self.prompt) + sum(estimate_image_tokens(*image.size) for image in images)
+                  + self.max_tokens)
+
+        messages = [
+            {
+                "role": "system",
+                "content": self.prompt
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": f"data:{image.mime_type};base64,{base64.b64encode(image.data).decode('utf-8')}"
+                    }
+                    for image in images
+                ]
+            }
+        ]
+
+        async def request():
+            with stage("openai.vision") as vision:
+                vision.add_bytes(sum(len(image.data) for image in images))
+                return await self.client.with_options(max_retries=0).chat.completions.with_raw_response.create(
+                    model=self.model,
+                    temperature=0.0,
+                    messages=messages,
+                    max_tokens=self.max_tokens
+                )
+
+        response = await self.scheduler.run(request, self.model, tokens)
         description = response.choices[0].message.content
         return description
 
@@ -71,54 +194,163 @@ class SoundOnlyVideoRecogniser(FileRecogniser):
     def __init__(self, audio_recogniser: FileRecogniser):
         self.audio_recogniser = audio_recogniser
 
-    async def recognise(self, file_path: Path) -> str:
-        """Supported video formats include MP4, AVI, and MKV."""
-        temp_audio_path = file_path.with_suffix('.mp3')
-
-        def extract_audio():
-            with VideoFileClip(str(file_path)) as video:
-                video.audio.write_audiofile(str(temp_audio_path))
-
-        await asyncio.get_running_loop().run_in_executor(None, extract_audio)
-        result = await self.audio_recogniser.recognise(temp_audio_path)
-        temp_audio_path.unlink()
+    @property
+    def identity(self) -> str:
+        return f"{type(self).__name__}({self.audio_recogniser.identity})"
 
-        return result
+    async def recognise(self, file_path: Path) -> str:
+        """Supported video formats include MP4, MOV, AVI, and MKV."""
+        with temporary_directory(file_path.stat().st_size) as audio_dir:
+            audio_path = await prepare_audio(file_path, Path(audio_dir))
+            return await self.audio_recogniser.recognise(audio_path)
+
+    async def recognise_parts(self, file_path: Path) -> AsyncIterator[str]:
+        with temporary_directory(file_path.stat().st_size) as audio_dir:
+            audio_path = await prepare_audio(file_path, Path(audio_dir))
+            async with aclosing(self.audio_recogniser.recognise_parts(audio_path)) as parts:
+                async for part in parts:
+                    yield part
+
+
+def format_table(table: List[List[Optional[str]]]) -> str:
+    """Formats an extracted table as a markdown table, without building a DataFrame."""
+    rows = [["" if cell is None else " ".join(str(cell).split()).replace("|", "/") for cell in row] for row in table]
+    if not rows:
+        return ""
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    lines = ["| " + " | ".join(row) + " |" for row in rows]
+    lines.insert(1, "|" + "---|" * width)
+    return "\n".join(lines)
+
+
+def extract_pdf_pages(file_path: Path, images_dir: Path, first_page: int = 0, last_page: Optional[int] = None) -> List[Dict]:
+    """Extracts text, tables and image crops of pages [first_page, last_page).
+    CPU-bound, so it is run in a worker thread or process."""
+    import pdfplumber
+
+    pages = []
+    page_numbers = list(range(first_page + 1, last_page + 1)) if last_page is not None else None
+    with pdfplumber.open(file_path, pages=page_numbers) as pdf:
+        for page in pdf.pages:
+            page_index = page.page_number - 1
+            tables = [format_table(table) for table in page.extract_tables()]
+            image_paths = []
+            if page.images:
+                # the page is rendered once and every embedded image is cropped from the same raster
+                page_image = page.to_image().original
+                scale = page_image.width / float(page.width)
+                page_x0, page_top = page.bbox[0], page.bbox[1]
+                for image_index, image in enumerate(page.images):
+                    box = (
+                        max(0, int((image["x0"] - page_x0) * scale)),
+                        max(0, int((image["top"] - page_top) * scale)),
+                        min(page_image.width, int((image["x1"] - page_x0) * scale)),
+                        min(page_image.height, int((image["bottom"] - page_top) * scale)),
+                    )
+                    if box[2] <= box[0] or box[3] <= box[1]:
+                        continue
+                    image_path = images_dir / f"{page_index}_{image_index}.png"
+                    page_image.crop(box).save(image_path, format="PNG")
+                    image_paths.append(image_path)
+            pages.append({"index": page_index, "text": page.extract_text(), "tables": tables, "images": image_paths})
+    return pages
+
+
+def count_pdf_pages(file_path: Path) -> int:
+    import pdfplumber
+
+    with pdfplumber.open(file_path) as pdf:
+        return len(pdf.pages)
 
 
 class PDFPlumberFileRecogniser(FileRecogniser):
-    def __init__(self, image_recogniser: FileRecogniser):
+    def __init__(
+            self,
+            image_recogniser: FileRecogniser,
+            max_concurrent_images: int = 4,
+            process_pool: Optional[Executor] = None,
+            pages_per_chunk: int = 20,
+    ):
+        """If process_pool is given, the document is split into ranges of pages_per_chunk pages
+        which are extracted in parallel by the pool."""
         self.image_recogniser = image_recogniser
+        self.max_concurrent_images = max_concurrent_images
+        self.process_pool = process_pool
+        self.pages_per_chunk = pages_per_chunk
+
+    @property
+    def identity(self) -> str:
+        return f"{type(self).__name__}({self.image_recogniser.identity})"
+
+    @staticmethod
+    def _format_page(page: Dict, image_descriptions: List[str]) -> str:
+        page_index = page["index"]
+        page_text = "Page: " + str(page_index) + "\n"
+        if page["text"]:
+            page_text += page["text"] + '\n'
+        if len(page["tables"]) > 0:
+            page_text += f'\n\nTables on page {page_index}:\n'
+        for table_index, table in enumerate(page["tables"]):
+            page_text += f"\n{table_index + 1}:\n{table}\n"
+        if len(image_descriptions) > 0:
+            page_text += f'\n\nImages on page {page_index}:\n'
+        for image_index, description in enumerate(image_descriptions):
+            page_text += f"{image_index + 1}: {description}\n"
+        return page_text
+
+    async def _extract_page_ranges(self, file_path: Path, images_dir: Path) -> List[Awaitable[List[Dict]]]:
+        """Starts extraction of all page ranges, returns their results in page order."""
+        if self.process_pool is None:
+            return [asyncio.ensure_future(asyncio.to_thread(extract_pdf_pages, file_path, images_dir))]
+        page_count = await asyncio.to_thread(count_pdf_pages, file_path)
+        loop = asyncio.get_running_loop()
+        return [
+            loop.run_in_executor(
+                self.process_pool, extract_pdf_pages, file_path, images_dir,
+                first_page, min(first_page + self.pages_per_chunk, page_count)
+            )
+            for first_page in range(0, page_count, self.pages_per_chunk)
+        ]
+
+    async def recognise_parts(self, file_path: Path) -> AsyncIterator[str]:
+        """Yields the document page by page."""
+        semaphore = asyncio.Semaphore(self.max_concurrent_images)
+        in_flight: List[asyncio.Future] = []
+
+        async def recognise_image(image_path: Path) -> str:
+            # a document has many images, messages sent meanwhile are described first
+            with bulk_priority():
+                async with semaphore:
+                    return await self.image_recogniser.recognise(image_path)
+
+        async def recognise_page_range(extraction: Awaitable[List[Dict]]) -> List[Tuple[Dict, asyncio.Future]]:
+            with stage("pdf.extract"):
+                pages = await extraction
+            # vision calls start as soon as a range is extracted, so all of them are in flight together
+            descriptions = [
+                asyncio.ensure_future(asyncio.gather(*[recognise_image(image_path) for image_path in page["images"]]))
+                for page in pages
+            ]
+            in_flight.extend(descriptions)
+            return list(zip(pages, descriptions))
+
+        with temporary_directory(file_path.stat().st_size) as images_dir:
+            extractions = await self._extract_page_ranges(file_path, Path(images_dir))
+            in_flight.extend(extractions)
+            page_ranges = [asyncio.ensure_future(recognise_page_range(extraction)) for extraction in extractions]
+            in_flight.extend(page_ranges)
+            try:
+                separator = 'PDF document: ' + file_path.name + '\n'
+                for page_range in page_ranges:
+                    for page, descriptions in await page_range:
+                        yield separator + self._format_page(page, await descriptions)
+                        separator = "\n\n"
+            finally:
+                await cancel_and_wait(in_flight)
 
     async def recognise(self, file_path: Path) -> str:
-        all_text = 'PDF document: ' + file_path.name + '\n'
-        with pdfplumber.open(file_path) as pdf:
-            for page_index, page in enumerate(pdf.pages):
-                if page_index != 0:
-                    all_text += "\n\n"
-                all_text += "Page: " + str(page_index) + "\n"
-                page_text = page.extract_text()
-                page_tables = page.extract_tables()
-                page_images = page.images
-                if page_text:
-                    all_text += page_text + '\n'
-                if len(page_tables) > 0:
-                    all_text += f'\n\nTables on page {page_index}:\n'
-                for table_index, table in enumerate(page_tables):
-                    df = pd.DataFrame(table[1:], columns=table[0])
-                    all_text += f"\n{table_index + 1}: {df.to_string(index=False)}\n"
-
-                if len(page_images) > 0:
-                    all_text += f'\n\nImages on page {page_index}:\n'
-                for image_index, image in enumerate(page_images):
-                    with tempfile.NamedTemporaryFile(delete=True, suffix='.png') as tmp:
-                        image_path = Path(tmp.name)
-                        page.to_image().original.crop((image["x0"], image["top"], image["x1"], image["bottom"])).save(
-                            image_path, format="PNG")
-                        recognized_text = await self.image_recogniser.recognise(image_path)
-                    all_text += f"{image_index + 1}: {recognized_text}\n"
-
-        return all_text
+        return "".join([part async for part in self.recognise_parts(file_path)])
 
 
 class RedirectingFileRecogniser(FileRecogniser):
@@ -128,44 +360,192 @@ class RedirectingFileRecogniser(FileRecogniser):
     @staticmethod
     def create_recogniser_map(audio_recogniser, image_recogniser, video_recogniser, pdf_recogniser):
         return {
-            **dict.fromkeys(['.mp3', '.mpeg', '.mpga', '.m4a', '.wav', '.webm'], audio_recogniser),
-            **dict.fromkeys(['.mp4', '.avi', '.mkv'], video_recogniser),
+            **dict.fromkeys(['.mp3', '.mpeg', '.mpga', '.m4a', '.wav', '.webm', '.ogg', '.oga', '.flac'], audio_recogniser),
+            **dict.fromkeys(['.mp4', '.mov', '.avi', '.mkv'], video_recogniser),
             **dict.fromkeys(['.jpeg', '.jpg', '.png', '.webp', '.gif'], image_recogniser),
             **dict.fromkeys(['.pdf'], pdf_recogniser),
         }
 
-    def recognise(self, file_path: Path) -> str:
+    @property
+    def identity(self) -> str:
+        identities = sorted({recogniser.identity for recogniser in self.recognisers.values()})
+        return f"{type(self).__name__}({','.join(identities)})"
+
+    def supports(self, file_path: Path) -> bool:
+        return file_path.suffix.lower() in self.recognisers
+
+    def _get_recogniser(self, file_path: Path) -> FileRecogniser:
         ext = file_path.suffix.lower()
         if ext in self.recognisers:
-            return self.recognisers[ext].recognise(file_path)
+            return self.recognisers[ext]
         else:
             raise ValueError(f'Unrecognised file extension {ext}')
 
+    def recognise(self, file_path: Path) -> str:
+        return self._get_recogniser(file_path).recognise(file_path)
+
+    def recognise_parts(self, file_path: Path) -> AsyncIterator[str]:
+        return self._get_recogniser(file_path).recognise_parts(file_path)
+
+
+class CachingFileRecogniser(FileRecogniser):
+    """Reuses results of the wrapped recogniser for files with the same content."""
+
+    def __init__(self, recogniser: FileRecogniser, cache: RecognitionCache):
+        self.recogniser = recogniser
+        self.cache = cache
+
+    @property
+    def identity(self) -> str:
+        return self.recogniser.identity
+
+    def supports(self, file_path: Path) -> bool:
+        return self.recogniser.supports(file_path)
+
+    async def _key(self, file_path: Path) -> str:
+        content_hash = await asyncio.to_thread(hash_file, file_path)
+        # the extension is part of the key: the redirecting recogniser picks a backend by it
+        return f"file:{self.identity}:{file_path.suffix.lower()}:{content_hash}"
+
+    async def recognise(self, file_path: Path) -> str:
+        key = await self._key(file_path)
+        result = await self.cache.get(key)
+        if result is None:
+            result = await self.recogniser.recognise(file_path)
+            if result is None:
+                # the vision model may answer without content, another attempt may get text
+                return ""
+            await self.cache.set(key, result)
+        return result
+
+    async def recognise_parts(self, file_path: Path) -> AsyncIterator[str]:
+        key = await self._key(file_path)
+        result = await self.cache.get(key)
+        if result is not None:
+            yield result
+            return
+        parts = []
+        answered = True
+        async with aclosing(self.recogniser.recognise_parts(file_path)) as recognised_parts:
+            async for part in recognised_parts:
+                if part is None:
+                    answered = False
+                    continue
+                parts.append(part)
+                yield part
+        if answered:
+            await self.cache.set(key, "".join(parts))
+
 
 class URLRecogniser(ABC):
     @abstractmethod
     async def recognise(self, url: str) -> str:
         pass
 
+    @property
+    def identity(self) -> str:
+        """Describes what the recogniser produces, used in cache keys."""
+        return type(self).__name__
+
+
+class CachingURLRecogniser(URLRecogniser):
+    """Reuses results of the wrapped recogniser for the same url until ttl expires."""
+
+    def __init__(self, recogniser: URLRecogniser, cache: RecognitionCache, ttl_seconds: float = 24 * 60 * 60):
+        self.recogniser = recogniser
+        self.cache = cache
+        self.ttl_seconds = ttl_seconds
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    @property
+    def identity(self) -> str:
+        return self.recogniser.identity
+
+    async def _recognise(self, key: str, url: str) -> str:
+        result = await self.cache.get(key)
+        if result is None:
+            result = await self.recogniser.recognise(url)
+            await self.cache.set(key, result, ttl_seconds=self.ttl_seconds)
+        return result
 
-class WebPageRecogniser(URLRecogniser):
     async def recognise(self, url: str) -> str:
-        process = CrawlerProcess({'USER_AGENT': 'Mozilla/5.0'})
-        results = []
+        key = f"url:{self.identity}:{url}"
+        # the same link in messages sent together is fetched once
+        in_flight = self._in_flight.get(key)
+        if in_flight is None:
+            in_flight = self._in_flight[key] = asyncio.ensure_future(self._recognise(key, url))
+            in_flight.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # one cancelled caller does not cancel the fetch the others wait for
+        return await asyncio.shield(in_flight)
+
+
+def html_to_text(html: bytes, encoding: Optional[str] = None) -> str:
+    """Visible text of the page, one text node per line."""
+    import lxml.html
 
-        class ContentSpider(scrapy.Spider):
-            name = "content_spider"
+    try:
+        document = lxml.html.document_fromstring(html, parser=lxml.html.HTMLParser(encoding=encoding))
+    except (lxml.etree.ParserError, LookupError):
+        return ''
+    for element in document.xpath('//script|//style|//noscript|//template'):
+        element.drop_tree()
+    return '\n'.join(text.strip() for text in document.itertext() if text.strip())
 
-            def start_requests(self):
-                yield scrapy.Request(url=url, callback=self.parse)
 
-            def parse(self, response):
-                soup = BeautifulSoup(response.body, 'html.parser')
-                for script in soup(["script", "style"]):  # Remove script and style elements
-                    script.extract()
-                text = soup.get_text(separator='\n', strip=True)
-                results.append(text)
+HTML_MEDIA_TYPES = ('text/html', 'application/xhtml+xml')
 
-        process.crawl(ContentSpider)
-        process.start()  # Blocks here until crawling is finished
-        return '\n'.join(results)
+
+class WebPageRecogniser(URLRecogniser):
+    def __init__(
+            self,
+            http_client: Optional[httpx.AsyncClient] = None,
+            max_bytes: int = 5 * 1024 * 1024,
+            timeout: float = 15.0,
+            max_connections: int = 20,
+            max_connections_per_host: int = 4,
+    ):
+        """Pages larger than max_bytes are truncated, the text is extracted from the downloaded part.
+        At most max_connections_per_host pages of one site are fetched at once, so that a message
+        linking many pages of one site is not throttled or blocked by it."""
+        self.max_bytes = max_bytes
+        self.max_connections_per_host = max_connections_per_host
+        # one semaphore for every host ever fetched, they are small and the bot visits few sites
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.http_client = http_client or httpx.AsyncClient(
+            headers={'User-Agent': 'Mozilla/5.0'},
+            follow_redirects=True,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def _fetch(self, url: str) -> Tuple[bytes, Optional[str], str]:
+        """Returns the body, its encoding and media type. Bodies without text (images, PDFs, archives) are not read."""
+        body = bytearray()
+        host = urlparse(url).hostname or ""
+        semaphore = self._host_semaphores.setdefault(host, asyncio.Semaphore(self.max_connections_per_host))
+        async with semaphore:
+            with stage("web.fetch") as fetch:
+                async with self.http_client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    media_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+                    if media_type in HTML_MEDIA_TYPES or media_type == 'text/plain':
+                        async for chunk in response.aiter_bytes():
+                            body += chunk
+                            if len(body) >= self.max_bytes:
+                                del body[self.max_bytes:]
+                                break
+                    fetch.add_bytes(len(body))
+                    return bytes(body), response.charset_encoding, media_type
+
+    async def recognise(self, url: str) -> str:
+        body, encoding, media_type = await self._fetch(url)
+        if media_type == 'text/plain':
+            return body.decode(encoding or 'utf-8', errors='replace')
+        if media_type not in HTML_MEDIA_TYPES:
+            # the link is saved as a bookmark only
+            return ""
+        with stage("web.extract_text"):
+            return await asyncio.to_thread(html_to_text, body, encoding)
+
+    async def close(self):
+        await self.http_client.aclose()
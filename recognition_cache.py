@@ -0,0 +1,76 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+class RecognitionCache:
+    """On-disk key-value store for recognition results with size- and age-based eviction."""
+
+    def __init__(
+            self,
+            db_path: Path,
+            max_size_bytes: int = 256 * 1024 * 1024,
+            max_age_seconds: float = 90 * 24 * 60 * 60,
+    ):
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS recognitions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL, expires_at REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS recognitions_accessed_at ON recognitions (accessed_at)")
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created_at, expires_at FROM recognitions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at, expires_at = row
+            if created_at < now - self.max_age_seconds or (expires_at is not None and expires_at < now):
+                self._connection.execute("DELETE FROM recognitions WHERE key = ?", (key,))
+                return None
+            self._connection.execute("UPDATE recognitions SET accessed_at = ? WHERE key = ?", (now, key))
+            return value
+
+    def _set(self, key: str, value: str, ttl_seconds: Optional[float]):
+        now = time.time()
+        expires_at = now + ttl_seconds if ttl_seconds is not None else None
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO recognitions (key, value, size, created_at, accessed_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, len(value.encode('utf-8')), now, now, expires_at)
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        self._connection.execute(
+            "DELETE FROM recognitions WHERE created_at < ? OR expires_at < ?", (now - self.max_age_seconds, now))
+        total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM recognitions").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        # least recently used entries go first
+        for key, size in self._connection.execute(
+                "SELECT key, size FROM recognitions ORDER BY accessed_at").fetchall():
+            self._connection.execute("DELETE FROM recognitions WHERE key = ?", (key,))
+            total_size -= size
+            if total_size <= self.max_size_bytes:
+                break
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[float] = None):
+        await asyncio.to_thread(self._set, key, value, ttl_seconds)
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass
+class SearchResult:
+    document_id: str
+    name: str
+    url: str
+    snippet: str
+
+
+class SearchIndex:
+    """Local SQLite FTS5 index of recognised text with the documents it was saved to.
+
+    Text is added in pieces as it is recognised and appended to the document's row, so that a query
+    matches words from different pieces. Pieces are buffered: the buffer is written in one
+    transaction when it holds batch_size pieces or flush_interval_seconds after the first one."""
+
+    def __init__(self, db_path: Path, batch_size: int = 100, flush_interval_seconds: float = 1.0):
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5("
+            "name, text, document_id UNINDEXED, url UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        # unindexed columns are scanned, documents are looked up by the rowid stored here
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS document_rows (document_id TEXT PRIMARY KEY, row_id INTEGER NOT NULL)")
+        self._pending: List[Tuple[Optional[str], str, str, str]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _write(self, pieces: List[Tuple[Optional[str], str, str, str]]):
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                # pieces of one document in the batch are written at once
+                documents: Dict[str, List] = {}
+                for name, text, document_id, url in pieces:
+                    if document_id in documents:
+                        documents[document_id][1] += "\n\n" + text
+                    else:
+                        documents[document_id] = [name, text, url]
+                for document_id, (name, text, url) in documents.items():
+                    row = self._connection.execute(
+                        "SELECT documents.rowid, documents.text FROM document_rows "
+                        "JOIN documents ON documents.rowid = document_rows.row_id WHERE document_rows.document_id = ?",
+                        (document_id,)
+                    ).fetchone()
+                    if row is None:
+                        cursor = self._connection.execute(
+                            "INSERT INTO documents (name, text, document_id, url) VALUES (?, ?, ?, ?)",
+                            (name or "", text, document_id, url)
+                        )
+                        self._connection.execute(
+                            "INSERT OR REPLACE INTO document_rows (document_id, row_id) VALUES (?, ?)",
+                            (document_id, cursor.lastrowid)
+                        )
+                    else:
+                        self._connection.execute(
+                            "UPDATE documents SET text = ? WHERE rowid = ?", (row[1] + "\n\n" + text, row[0]))
+            except BaseException:
+                # a half-written batch could leave a row without its document_rows entry
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def _remove(self, document_id: str):
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM documents WHERE rowid IN (SELECT row_id FROM document_rows WHERE document_id = ?)",
+                (document_id,)
+            )
+            self._connection.execute("DELETE FROM document_rows WHERE document_id = ?", (document_id,))
+
+    def _search(self, query: str, limit: int) -> List[SearchResult]:
+        # every word is a quoted phrase, so that user input is never parsed as FTS5 syntax
+        match = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+        if not match:
+            return []
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT document_id, name, url, snippet(documents, 1, '«', '»', '…', 16) FROM documents "
+                "WHERE documents MATCH ? ORDER BY rank LIMIT ?",
+                (match, limit)
+            ).fetchall()
+        return [SearchResult(*row) for row in rows]
+
+    def add(self, document_id: str, name: Optional[str], url: str, text: str):
+        """Buffers a piece of the document's text, it is searchable after the next flush.
+        The name is only needed for the first piece of a document."""
+        if not text.strip():
+            return
+        self._pending.append((name, text, document_id, url))
+        if len(self._pending) >= self.batch_size:
+            self._schedule_flush(0.0)
+        elif self._flush_task is None:
+            self._schedule_flush(self.flush_interval_seconds)
+
+    def _schedule_flush(self, delay_seconds: float):
+        async def flush_later():
+            await asyncio.sleep(delay_seconds)
+            self._flush_task = None
+            try:
+                await self.flush()
+            except Exception:  # noqa
+                # nobody awaits this task, the pieces are lost but the error is reported
+                logging.exception("Could not write to the search index")
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        self._flush_task = asyncio.create_task(flush_later())
+
+    async def flush(self):
+        pieces, self._pending = self._pending, []
+        if pieces:
+            await asyncio.to_thread(self._write, pieces)
+
+    async def remove(self, document_id: str):
+        """Forgets a deleted document."""
+        self._pending = [piece for piece in self._pending if piece[2] != document_id]
+        await asyncio.to_thread(self._remove, document_id)
+
+    async def search(self, query: str, limit: int = 5) -> List[SearchResult]:
+        """Best matching documents first, each with a snippet around the matched words."""
+        await self.flush()
+        return await asyncio.to_thread(self._search, query, limit)
+
+    def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._pending:
+            self._write(self._pending)
+            self._pending = []
+        self._connection.close()
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass
+class Task:
+    id: int
+    kind: str
+    payload: Dict
+    attempts: int
+    reply_message_id: Optional[int] = None
+    available_at: float = 0.0
+    # tasks with the same group key, claimed, acknowledged and retried together with this one
+    group: List["Task"] = field(default_factory=list)
+
+    @property
+    def ids(self) -> List[int]:
+        return [self.id] + [task.id for task in self.group]
+
+
+class SQLiteTaskQueue:
+    """Durable queue of incoming messages (SQLite in WAL mode) with at-least-once delivery:
+    a task is deleted only after it is acknowledged, and tasks which were running when the
+    process stopped are handed out again by recover().
+    Tasks put with the same group_key (e.g. photos of one album) are handed out as one task.
+    Tasks of the owner with the fewest running tasks are handed out first, and an owner never has more
+    than its limit (owner_limits, else max_running_per_owner) running at once."""
+
+    def __init__(
+            self,
+            db_path: Path,
+            max_attempts: int = 3,
+            retry_delay_seconds: float = 10.0,
+            max_running_per_owner: Optional[int] = None,
+            owner_limits: Optional[Dict[str, int]] = None,
+    ):
+        self.max_attempts = max_attempts
+        self.retry_delay_seconds = retry_delay_seconds
+        self.max_running_per_owner = max_running_per_owner
+        self.owner_limits = owner_limits or {}
+        self._lock = threading.Lock()
+        self._new_task = asyncio.Event()
+        self._connection = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "available_at REAL NOT NULL, reply_message_id INTEGER, last_error TEXT)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, available_at)")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(tasks)")]
+        if "group_key" not in columns:
+            self._connection.execute("ALTER TABLE tasks ADD COLUMN group_key TEXT")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS tasks_group_key ON tasks (group_key)")
+        if "owner" not in columns:
+            self._connection.execute("ALTER TABLE tasks ADD COLUMN owner TEXT")
+
+    def _put(
+            self,
+            kind: str,
+            payload: Dict,
+            status: str,
+            group_key: Optional[str],
+            delay_seconds: float,
+            owner: Optional[str],
+    ) -> int:
+        with self._lock:
+            available_at = time.time() + delay_seconds
+            if group_key is not None:
+                # the group becomes available when its first task does
+                row = self._connection.execute(
+                    "SELECT MIN(available_at) FROM tasks WHERE group_key = ? AND status IN ('held', 'pending')",
+                    (group_key,)
+                ).fetchone()
+                if row[0] is not None:
+                    available_at = row[0]
+            cursor = self._connection.execute(
+                "INSERT INTO tasks (kind, payload, status, available_at, group_key, owner) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), status, available_at, group_key, owner)
+            )
+            return cursor.lastrowid
+
+    def _running_per_owner(self) -> Dict[str, int]:
+        # a running group is one task
+        return dict(self._connection.execute(
+            "SELECT owner, COUNT(DISTINCT COALESCE(group_key, id)) FROM tasks "
+            "WHERE status = 'running' AND owner IS NOT NULL GROUP BY owner"
+        ).fetchall())
+
+    def _owners_filter(self, running: Dict[str, int]) -> Tuple[str, List[str]]:
+        """SQL condition excluding tasks of owners which reached their limit, and its parameters."""
+        capped = []
+        for owner, count in running.items():
+            limit = self.owner_limits.get(owner, self.max_running_per_owner)
+            if limit is not None and count >= limit:
+                capped.append(owner)
+        if not capped:
+            return "1", []
+        return f"(owner IS NULL OR owner NOT IN ({', '.join('?' * len(capped))}))", capped
+
+    def _claim(self) -> Optional[Task]:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                owners_filter, owners = self._owners_filter(self._running_per_owner())
+                # owners with fewer running tasks first, so that one owner's backlog does not delay the others
+                row = self._connection.execute(
+                    "SELECT id, kind, payload, attempts, reply_message_id, available_at, group_key FROM tasks "
+                    "LEFT JOIN (SELECT owner AS running_owner, COUNT(DISTINCT COALESCE(group_key, id)) AS running "
+                    "FROM tasks WHERE status = 'running' GROUP BY owner) ON running_owner = owner "
+                    f"WHERE status = 'pending' AND available_at <= ? AND {owners_filter} "
+                    "ORDER BY COALESCE(running, 0), available_at, id LIMIT 1",
+                    (time.time(), *owners)
+                ).fetchone()
+                if row is None:
+                    return None
+                rows = [row]
+                if row[6] is not None:
+                    rows += self._connection.execute(
+                        "SELECT id, kind, payload, attempts, reply_message_id, available_at, group_key FROM tasks "
+                        "WHERE group_key = ? AND id != ? AND status IN ('held', 'pending') ORDER BY id",
+                        (row[6], row[0])
+                    ).fetchall()
+                self._connection.executemany(
+                    "UPDATE tasks SET status = 'running', attempts = attempts + 1 WHERE id = ?",
+                    [(grouped_row[0],) for grouped_row in rows]
+                )
+            except BaseException:
+                # a group must not be left partly claimed
+                self._connection.execute("ROLLBACK")
+                raise
+            finally:
+                if self._connection.in_transaction:
+                    self._connection.execute("COMMIT")
+        tasks = [
+            Task(task_id, kind, json.loads(payload), attempts + 1, reply_message_id, available_at)
+            for task_id, kind, payload, attempts, reply_message_id, available_at, _ in rows
+        ]
+        tasks[0].group = tasks[1:]
+        return tasks[0]
+
+    def _execute(self, query: str, parameters: tuple):
+        with self._lock:
+            self._connection.execute(query, parameters)
+
+    def _execute_many(self, query: str, parameters: List[tuple]):
+        with self._lock:
+            self._connection.executemany(query, parameters)
+
+    def _fail(self, task: Task, error: str, retry: bool) -> bool:
+        if not retry or task.attempts >= self.max_attempts:
+            self._execute_many(
+                "UPDATE tasks SET status = 'failed', last_error = ? WHERE id = ?",
+                [(error, task_id) for task_id in task.ids]
+            )
+            return False
+        # exponential backoff between attempts
+        available_at = time.time() + self.retry_delay_seconds * 2 ** (task.attempts - 1)
+        self._execute_many(
+            "UPDATE tasks SET status = 'pending', available_at = ?, last_error = ? WHERE id = ?",
+            [(available_at, error, task_id) for task_id in task.ids]
+        )
+        return True
+
+    def _next_available_in(self) -> Optional[float]:
+        with self._lock:
+            # tasks of owners at their limit wait for a running task to finish instead
+            owners_filter, owners = self._owners_filter(self._running_per_owner())
+            row = self._connection.execute(
+                f"SELECT MIN(available_at) FROM tasks WHERE status = 'pending' AND {owners_filter}", owners).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    async def put(
+            self,
+            kind: str,
+            payload: Dict,
+            held: bool = False,
+            group_key: Optional[str] = None,
+            delay_seconds: float = 0.0,
+            owner: Optional[str] = None,
+    ) -> int:
+        """A held task is persisted but not handed out until release() (or recover() after a restart).
+        Tasks with the same group_key are handed out together, delay_seconds after the first of them.
+        Tasks are scheduled fairly between owners, e.g. users."""
+        task_id = await asyncio.to_thread(
+            self._put, kind, payload, 'held' if held else 'pending', group_key, delay_seconds, owner)
+        if not held:
+            self._new_task.set()
+        return task_id
+
+    async def release(self, task_id: int, reply_message_id: Optional[int] = None):
+        """Makes a held task available, remembering the acknowledgement message to edit once it is done."""
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE tasks SET status = 'pending', reply_message_id = ? WHERE id = ? AND status = 'held'",
+            (reply_message_id, task_id)
+        )
+        self._new_task.set()
+
+    async def claim(self) -> Optional[Task]:
+        return await asyncio.to_thread(self._claim)
+
+    async def get(self, poll_interval: float = 1.0) -> Task:
+        """Waits for the next available task."""
+        while True:
+            self._new_task.clear()
+            task = await self.claim()
+            if task is not None:
+                return task
+            next_available_in = await asyncio.to_thread(self._next_available_in)
+            timeout = poll_interval if next_available_in is None else min(poll_interval, next_available_in)
+            # waking up on time picks up delayed groups and tasks whose retry delay has passed;
+            # unlike wait_for, wait does not drop a cancellation which comes just as the event is set
+            new_task = asyncio.ensure_future(self._new_task.wait())
+            try:
+                await asyncio.wait([new_task], timeout=timeout)
+            finally:
+                new_task.cancel()
+
+    async def ack(self, task: Task):
+        await asyncio.to_thread(
+            self._execute_many, "DELETE FROM tasks WHERE id = ?", [(task_id,) for task_id in task.ids])
+        # the owner may have been at its limit
+        self._new_task.set()
+
+    async def fail(self, task: Task, error: str, retry: bool = True) -> bool:
+        """Returns True if the task will be retried, False if it ran out of attempts or retry is False."""
+        retry = await asyncio.to_thread(self._fail, task, error, retry)
+        self._new_task.set()
+        return retry
+
+    async def recover(self) -> int:
+        """Makes tasks interrupted by a restart available again, returns their number."""
+        def requeue() -> int:
+            with self._lock:
+                return self._connection.execute(
+                    "UPDATE tasks SET status = 'pending' WHERE status IN ('running', 'held')").rowcount
+
+        return await asyncio.to_thread(requeue)
+
+    async def group_exists(self, group_key: str) -> bool:
+        """Whether tasks of the group are waiting to be handed out."""
+        def exists() -> bool:
+            with self._lock:
+                return self._connection.execute(
+                    "SELECT 1 FROM tasks WHERE group_key = ? AND status IN ('held', 'pending') LIMIT 1", (group_key,)
+                ).fetchone() is not None
+
+        return await asyncio.to_thread(exists)
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN ('held', 'pending', 'running')").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
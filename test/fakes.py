@@ -0,0 +1,496 @@
+import asyncio
+import inspect
+import json
+import random
+import re
+import subprocess
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+from PIL import Image, ImageDraw
+
+from document_storage import DocumentsStorage
+from file_storage import FileStorage
+
+
+class FakeServer:
+    """Local HTTP server running in a background thread, used instead of real external services in tests."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = []
+        self.active_requests = 0
+        self.max_active_requests = 0
+        # with rate_limit set, requests above that many per second are counted as rejected
+        self.rate_limit: Optional[int] = None
+        self.rejected = 0
+        self._accepted_at = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method: str, path: str, headers, body: bytes):
+        """Returns (status, headers, body) for a request."""
+        raise NotImplementedError()
+
+    def _rate_limited(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            self._accepted_at = [accepted_at for accepted_at in self._accepted_at if accepted_at > now - 1]
+            if len(self._accepted_at) >= self.rate_limit:
+                self.rejected += 1
+                return True
+            self._accepted_at.append(now)
+            return False
+
+    def _build_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _dispatch(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                with server._lock:
+                    server.requests.append((self.command, self.path, body))
+                    server.active_requests += 1
+                    server.max_active_requests = max(server.max_active_requests, server.active_requests)
+                try:
+                    if server.latency:
+                        time.sleep(server.latency)
+                    status, headers, payload = server.handle(self.command, self.path, self.headers, body)
+                finally:
+                    with server._lock:
+                        server.active_requests -= 1
+                if isinstance(payload, (dict, list)):
+                    payload = json.dumps(payload).encode()
+                    headers = {"Content-Type": "application/json", **headers}
+                elif isinstance(payload, str):
+                    payload = payload.encode()
+                try:
+                    self.send_response(status)
+                    for key, value in headers.items():
+                        self.send_header(key, value)
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client went away, e.g. a bot process was stopped while polling
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _dispatch
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class FakeNotionServer(FakeServer):
+    """Implements the subset of the Notion API used by NotionDocumentsStorage and keeps created pages in memory.
+    Like Notion it rejects requests with more than 100 children or rich text longer than 2000 characters.
+    With rate_limit set, requests above that many per second are rejected with 429 and Retry-After."""
+
+    def __init__(self, latency: float = 0.0, rate_limit: Optional[int] = None, retry_after: float = 0.5):
+        super().__init__(latency)
+        self.pages = {}
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.appends = 0
+        self.fail_appends_after: Optional[int] = None
+
+    @staticmethod
+    def _validate_children(children) -> Optional[str]:
+        """Checks the request size limits of Notion."""
+        if len(children) > 100:
+            return f"body.children.length should be ≤ 100, instead was {len(children)}"
+        for block in children:
+            content = block[block["type"]]
+            for rich_text in [content.get("rich_text", [])] + content.get("cells", []):
+                for item in rich_text:
+                    if len(item["text"]["content"]) > 2000:
+                        return "rich_text.text.content.length should be ≤ 2000"
+            error = FakeNotionServer._validate_children(content.get("children", []))
+            if error:
+                return error
+        return None
+
+    def handle(self, method: str, path: str, headers, body: bytes):
+        if self.rate_limit is not None and self._rate_limited():
+            return 429, {"Retry-After": str(self.retry_after)}, {
+                "object": "error", "status": 429, "code": "rate_limited", "message": "Rate limited"}
+        data = json.loads(body) if body else {}
+        if method == "POST" and path == "/v1/pages":
+            page_id = str(uuid.uuid4())
+            error = self._validate_children(data.get("children", []))
+            if error:
+                return 400, {}, {"object": "error", "status": 400, "code": "validation_error", "message": error}
+            with self._lock:
+                self.pages[page_id] = {"properties": data["properties"], "children": list(data.get("children", []))}
+            return 200, {}, {"object": "page", "id": page_id, "url": f"https://www.notion.so/{page_id.replace('-', '')}"}
+        match = re.fullmatch(r"/v1/pages/([^/]+)", path)
+        if method == "PATCH" and match:
+            with self._lock:
+                self.pages[match.group(1)]["archived"] = data.get("archived", False)
+            return 200, {}, {"object": "page", "id": match.group(1)}
+        match = re.fullmatch(r"/v1/blocks/([^/]+)/children", path)
+        if method == "PATCH" and match:
+            self.appends += 1
+            if self.fail_appends_after is not None and self.appends > self.fail_appends_after:
+                return 502, {}, {"object": "error", "status": 502, "code": "bad_gateway", "message": "bad gateway"}
+            error = self._validate_children(data["children"])
+            if error:
+                return 400, {}, {"object": "error", "status": 400, "code": "validation_error", "message": error}
+            with self._lock:
+                self.pages[match.group(1)]["children"].extend(data["children"])
+            return 200, {}, {"object": "list", "results": data["children"]}
+        return 404, {}, {"object": "error", "status": 404, "code": "object_not_found", "message": path}
+
+
+class FakeWebServer(FakeServer):
+    """Serves generated HTML pages: /page/<n> has n paragraphs, each one line of text.
+    /image/<n> is an image of n random bytes."""
+
+    def handle(self, method: str, path: str, headers, body: bytes):
+        match = re.fullmatch(r"/image/(\d+)", path)
+        if match:
+            return 200, {"Content-Type": "image/webp"}, random.randbytes(int(match.group(1)))
+        match = re.fullmatch(r"/page/(\d+)", path)
+        if not match:
+            return 404, {}, "not found"
+        paragraphs = "".join(f"<p>paragraph {i}</p>" for i in range(int(match.group(1))))
+        html = f"<html><head><style>p {{}}</style><script>var x;</script></head><body>{paragraphs}</body></html>"
+        return 200, {"Content-Type": "text/html; charset=utf-8"}, html
+
+
+class FakeOpenAIServer(FakeServer):
+    """Stub of the OpenAI transcription and chat endpoints. Transcriptions echo the uploaded file name,
+    so tests can check in which order chunks were stitched; jitter shuffles the completion order.
+    With rate_limit set, requests above that many per second are rejected with 429 and Retry-After,
+    rate_limit_headers are added to every successful response."""
+
+    def __init__(
+            self,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            rate_limit: Optional[int] = None,
+            retry_after: float = 0.5,
+            rate_limit_headers: Optional[Dict[str, str]] = None,
+    ):
+        super().__init__(latency)
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rate_limit_headers = rate_limit_headers or {}
+
+    def handle(self, method: str, path: str, headers, body: bytes):
+        if self.jitter:
+            time.sleep(random.uniform(0, self.jitter))
+        if self.rate_limit is not None and self._rate_limited():
+            return 429, {"retry-after": str(self.retry_after)}, {"error": {
+                "message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}}
+        if method == "POST" and path == "/v1/audio/transcriptions":
+            file_name = re.search(rb'name="file"; filename="([^"]*)"', body).group(1).decode()
+            return 200, {"Content-Type": "text/plain", **self.rate_limit_headers}, f"transcript of {file_name}\n"
+        if method == "POST" and path == "/v1/chat/completions":
+            return 200, dict(self.rate_limit_headers), {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": json.loads(body)["model"],
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "image description"},
+                }],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }
+        return 404, {}, {"error": {"message": path, "type": "invalid_request_error"}}
+
+
+def make_audio(path: Path, tones: int = 4, tone_seconds: float = 2.0, silence_seconds: float = 1.0):
+    """Writes a mono file with `tones` beeps separated by silences, encoded by the extension of path."""
+    period = tone_seconds + silence_seconds
+    subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error", "-y", "-f", "lavfi",
+            "-i", f"aevalsrc='0.5*sin(440*2*PI*t)*lt(mod(t,{period}),{tone_seconds})':s=16000:d={tones * period}",
+            "-b:a", "32k", str(path)
+        ],
+        check=True
+    )
+
+
+def make_video(path: Path, seconds: float = 3.0):
+    """Writes a small test pattern video with an aac sine audio track."""
+    subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error", "-y",
+            "-f", "lavfi", "-i", "testsrc=size=320x240:rate=25", "-f", "lavfi", "-i", "sine=frequency=300",
+            "-t", str(seconds), "-c:v", "libx264", "-c:a", "aac", "-shortest", str(path)
+        ],
+        check=True
+    )
+
+
+def make_photo(path: Path, width: int = 4032, height: int = 3024):
+    """Writes a noisy gradient, which compresses like a camera photo."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 64)
+    Image.merge("RGB", (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT))).save(path, quality=95)
+
+
+def make_screenshot(path: Path, width: int = 1080, height: int = 7000):
+    """Writes a tall two-colour image with text-like stripes, like a long chat screenshot."""
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for top in range(20, height - 20, 40):
+        draw.text((20, top), f"message line {top // 40} " * 4, fill="black")
+    image.save(path)
+
+
+class FakeTelegramServer(FakeServer):
+    """Subset of the Telegram Bot API used by TelegramBot. Files registered with add_file can be
+    fetched with getFile and downloaded; sent and edited messages are recorded."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.files = {}
+        self.sent_messages = []
+        self.edited_messages = []
+        # ids of sent messages in the order they were sent, and times of their last edits
+        self.sent_message_ids = []
+        self.edited_at = {}
+        # when updates were first requested, i.e. the bot started polling
+        self.polled_at: Optional[float] = None
+        self._next_message_id = 1000
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/bot"
+
+    @property
+    def base_file_url(self) -> str:
+        return f"{self.url}/file/bot"
+
+    def add_file(self, file_id: str, file_path: str, data: bytes):
+        self.files[file_id] = (file_path, data)
+
+    def _message(self, chat_id, text) -> Dict:
+        with self._lock:
+            self._next_message_id += 1
+            message_id = self._next_message_id
+        return {
+            "message_id": message_id, "date": int(time.time()), "text": text,
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bot"},
+        }
+
+    def handle(self, method: str, path: str, headers, body: bytes):
+        match = re.fullmatch(r"/file/bot[^/]+/(.+)", path)
+        if match:
+            for file_path, data in self.files.values():
+                if file_path == match.group(1):
+                    return 200, {"Content-Type": "application/octet-stream"}, data
+            return 404, {}, "not found"
+        api_method = path.rsplit("/", 1)[-1]
+        params = {}
+        for key, values in parse_qs(body.decode()).items():
+            try:
+                params[key] = json.loads(values[0])
+            except ValueError:
+                params[key] = values[0]
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bot", "username": "test_bot"}
+        elif api_method == "getFile":
+            file_path, data = self.files[str(params["file_id"])]
+            result = {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_size": len(data),
+                      "file_path": file_path}
+        elif api_method == "sendMessage":
+            result = self._message(params["chat_id"], params["text"])
+            with self._lock:
+                self.sent_messages.append(params)
+                self.sent_message_ids.append(result["message_id"])
+        elif api_method == "editMessageText":
+            result = self._message(params["chat_id"], params["text"])
+            with self._lock:
+                self.edited_messages.append(params)
+                self.edited_at[params["message_id"]] = time.monotonic()
+        elif api_method == "getUpdates":
+            if self.polled_at is None:
+                self.polled_at = time.monotonic()
+            time.sleep(0.1)
+            result = []
+        elif api_method in ("deleteWebhook", "setWebhook"):
+            result = True
+        else:
+            return 404, {}, {"ok": False, "error_code": 404, "description": api_method}
+        return 200, {}, {"ok": True, "result": result}
+
+
+def make_update(update_id: int, user_id: int = 1, **message_fields) -> Dict:
+    """Bot API update with a private message from user_id, e.g. make_update(1, text="hello")."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            **message_fields,
+        },
+    }
+
+
+class RecordingDocumentsStorage(DocumentsStorage):
+    """Keeps what would be saved, with copies of file contents since the files are temporary.
+    Document ids are indexes in saved."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.saved = []
+
+    async def _record(self, kind: str, name: str, text, path: Optional[Path] = None) -> str:
+        await asyncio.sleep(self.latency)
+        if inspect.isawaitable(text):
+            text = await text
+        self.saved.append({
+            "kind": kind, "name": name, "text": text, "data": path.read_bytes() if path else None,
+            "path": path, "appended": [], "deleted": False,
+        })
+        return str(len(self.saved) - 1)
+
+    async def save_text(self, name: str, text: str):
+        return await self._record("text", name, text)
+
+    async def save_image(self, name: str, image_path: Path, description: Optional[str] = None):
+        return await self._record("image", name, description, image_path)
+
+    async def save_audio(self, name: str, audio_path: Path, description: Optional[str] = None):
+        return await self._record("audio", name, description, audio_path)
+
+    async def save_video(self, name: str, video_path: Path, description: Optional[str] = None):
+        return await self._record("video", name, description, video_path)
+
+    async def save_file(self, name: str, file_path: Path, description: Optional[str] = None):
+        return await self._record("file", name, description, file_path)
+
+    async def save_album(self, name: str, items):
+        await asyncio.sleep(self.latency)
+        descriptions = [await description if inspect.isawaitable(description) else description for _, description in items]
+        self.saved.append({
+            "kind": "album", "name": name, "text": None, "data": [file_path.read_bytes() for file_path, _ in items],
+            "descriptions": descriptions, "appended": [], "deleted": False,
+        })
+        return str(len(self.saved) - 1)
+
+    async def save_links(self, name: str, text: str, links):
+        await asyncio.sleep(self.latency)
+        descriptions = [await description if inspect.isawaitable(description) else description for _, description in links]
+        self.saved.append({
+            "kind": "links", "name": name, "text": text, "data": None, "links": [url for url, _ in links],
+            "descriptions": descriptions, "appended": [], "deleted": False,
+        })
+        return str(len(self.saved) - 1)
+
+    async def append_text(self, document_id: str, text: str):
+        await asyncio.sleep(self.latency)
+        self.saved[int(document_id)]["appended"].append(text)
+
+    async def delete(self, document_id: str):
+        self.saved[int(document_id)]["deleted"] = True
+
+    def document_url(self, document_id: str) -> str:
+        return f"https://documents.test/{document_id}"
+
+
+class StubFileStorage(FileStorage):
+    """Pretends to upload for latency seconds, then fails with error if it is set."""
+
+    def __init__(self, latency: float = 0.0, error: Optional[Exception] = None):
+        self.latency = latency
+        self.error = error
+        self.saved = []
+
+    async def save_and_get_url(self, file_path: Path) -> str:
+        await asyncio.sleep(self.latency)
+        if self.error:
+            raise self.error
+        self.saved.append(file_path)
+        return f"https://files.test/{file_path.name}"
+
+
+def make_pdf(path: Path, page_count: int, lines_per_page: int = 20, images_per_page: int = 0, with_table: bool = False):
+    """Writes a minimal PDF with text lines, solid-colour images and an optional ruled table on every page."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_refs = []
+    for page_index in range(page_count):
+        content = [b"BT /F1 10 Tf 50 800 Td 12 TL"]
+        for line_index in range(lines_per_page):
+            content.append(f"(Page {page_index} line {line_index} lorem ipsum dolor sit amet) '".encode())
+        content.append(b"ET")
+        if with_table:
+            rows, columns, x0, y0, width, height = 3, 3, 50, 300, 80, 20
+            for row in range(rows + 1):
+                content.append(f"{x0} {y0 - row * height} m {x0 + columns * width} {y0 - row * height} l S".encode())
+            for column in range(columns + 1):
+                content.append(f"{x0 + column * width} {y0} m {x0 + column * width} {y0 - rows * height} l S".encode())
+            for row in range(rows):
+                for column in range(columns):
+                    text = f"h{column}" if row == 0 else f"r{row}c{column}"
+                    content.append(
+                        f"BT /F1 9 Tf {x0 + column * width + 5} {y0 - (row + 1) * height + 6} Td ({text}) Tj ET".encode())
+        resources = b"/Font << /F1 3 0 R >>"
+        image_refs = []
+        for image_index in range(images_per_page):
+            size = 32
+            colour = bytes([(page_index * 40) % 256, (image_index * 80) % 256, 128])
+            stream = zlib.compress(colour * size * size)
+            objects.append(
+                f"<< /Type /XObject /Subtype /Image /Width {size} /Height {size} /ColorSpace /DeviceRGB "
+                f"/BitsPerComponent 8 /Filter /FlateDecode /Length {len(stream)} >>\nstream\n".encode()
+                + stream + b"\nendstream")
+            image_refs.append(f"/Im{image_index} {len(objects)} 0 R")
+            content.append(f"q 64 0 0 64 {50 + image_index * 80} 150 cm /Im{image_index} Do Q".encode())
+        if image_refs:
+            resources += b" /XObject << " + " ".join(image_refs).encode() + b" >>"
+        stream = b"\n".join(content)
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+        content_ref = len(objects)
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {content_ref} 0 R ".encode()
+            + b"/Resources << " + resources + b" >> >>")
+        page_refs.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(page_refs)}] /Count {page_count} >>".encode()
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for index, obj in enumerate(objects):
+        offsets.append(len(data))
+        data += f"{index + 1} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref_offset = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        data += f"{offset:010d} 00000 n \n".encode()
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+    path.write_bytes(bytes(data))
@@ -0,0 +1,264 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
+
+from document_storage import NotionDocumentsStorage, RecognisingDocumentsStorage
+from notion_scheduler import NotionRequestScheduler
+from recognition_cache import RecognitionCache
+from recognisers import CachingFileRecogniser, FileRecogniser, RedirectingFileRecogniser, URLRecogniser, WebPageRecogniser
+from search_index import SearchIndex
+from test.fakes import FakeNotionServer, FakeWebServer, RecordingDocumentsStorage, StubFileStorage
+
+
+class StubRecogniser(FileRecogniser, URLRecogniser):
+    """Yields each part after its delay, fails after the last part if error is set."""
+
+    def __init__(self, parts: List[str], delay: float, error: Optional[Exception] = None):
+        self.parts = parts
+        self.delay = delay
+        self.error = error
+        self.cancelled = False
+
+    async def recognise_parts(self, file_path) -> AsyncIterator[str]:
+        try:
+            for part in self.parts:
+                await asyncio.sleep(self.delay)
+                yield part
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+
+    async def recognise(self, file_path) -> str:
+        return "".join([part async for part in self.recognise_parts(file_path)])
+
+
+class StubPageRecogniser(URLRecogniser):
+    """Returns the text of a page after delay, URLs missing from pages fail like unreachable pages."""
+
+    def __init__(self, pages: Dict[str, str], delay: float):
+        self.pages = pages
+        self.delay = delay
+
+    async def recognise(self, url: str) -> str:
+        await asyncio.sleep(self.delay)
+        if url not in self.pages:
+            raise ConnectionError(f"{url} is unreachable")
+        return self.pages[url]
+
+
+def page_text(page) -> List[str]:
+    return [
+        "".join(item["text"]["content"] for item in block["paragraph"]["rich_text"])
+        for block in page["children"] if block["type"] == "paragraph"
+    ]
+
+
+class TestProgressivePublishing(unittest.IsolatedAsyncioTestCase):
+    def _storage(self, server: FakeNotionServer, recogniser: StubRecogniser, upload_latency: float = 0.0):
+        self.notion_storage = NotionDocumentsStorage(
+            "token", "parent", StubFileStorage(latency=upload_latency), base_url=server.url,
+            scheduler=NotionRequestScheduler(requests_per_second=100, burst=100, max_retries=0))
+        return RecognisingDocumentsStorage(
+            self.notion_storage, recogniser, recogniser, recogniser, recogniser, recogniser, recogniser,
+            progressive=True,
+        )
+
+    async def asyncTearDown(self):
+        await self.notion_storage.close()
+
+    async def test_page_visible_before_recognition_finishes(self):
+        recogniser = StubRecogniser(["first chunk", "\nsecond chunk", "\nthird chunk"], delay=0.4)
+        with FakeNotionServer() as server:
+            doc_storage = self._storage(server, recogniser, upload_latency=0.1)
+            start = time.perf_counter()
+            save = asyncio.create_task(doc_storage.save_audio("audio", Path("voice.oga"), description="caption"))
+            while not server.pages:
+                await asyncio.sleep(0.01)
+            first_visible = time.perf_counter() - start
+            page_id = await save
+            elapsed = time.perf_counter() - start
+        self.assertLess(first_visible, 0.3)
+        self.assertGreater(elapsed, 1.2)
+        page = server.pages[page_id]
+        self.assertEqual(page["children"][0]["type"], "audio")
+        self.assertEqual(page_text(page), ["caption", "first chunk", "second chunk", "third chunk"])
+        self.assertEqual(server.appends, 3)
+
+    async def test_parts_ready_during_upload_appended_together(self):
+        recogniser = StubRecogniser(["Page: 1\n", "\n\nPage: 2\n"], delay=0.05)
+        with FakeNotionServer() as server:
+            doc_storage = self._storage(server, recogniser, upload_latency=0.5)
+            page_id = await doc_storage.save_file("pdf", Path("doc.pdf"))
+        self.assertEqual(server.appends, 1)
+        self.assertEqual(
+            [block["type"] for block in server.pages[page_id]["children"]], ["file", "heading_2", "heading_2"])
+
+    async def test_link_fetched_while_page_created(self):
+        recogniser = StubRecogniser(["page text"], delay=0.2)
+        with FakeNotionServer() as server:
+            doc_storage = self._storage(server, recogniser)
+            page_id = await doc_storage.save_link("link", "https://example.com")
+        self.assertEqual(server.pages[page_id]["children"][0]["type"], "bookmark")
+        self.assertEqual(page_text(server.pages[page_id]), ["page text"])
+
+    async def test_failed_recognition_deletes_page(self):
+        recogniser = StubRecogniser(["first chunk"], delay=0.1, error=RuntimeError("recognition failed"))
+        with FakeNotionServer() as server:
+            doc_storage = self._storage(server, recogniser)
+            with self.assertRaisesRegex(RuntimeError, "recognition failed"):
+                await doc_storage.save_audio("audio", Path("voice.oga"))
+        page, = server.pages.values()
+        self.assertTrue(page["archived"])
+
+
+class TestConcurrentUploadAndRecognition(unittest.IsolatedAsyncioTestCase):
+    def _storage(self, server: FakeNotionServer, recogniser: StubRecogniser, file_storage: StubFileStorage):
+        self.notion_storage = NotionDocumentsStorage(
+            "token", "parent", file_storage, base_url=server.url,
+            scheduler=NotionRequestScheduler(requests_per_second=100, burst=100, max_retries=0))
+        return RecognisingDocumentsStorage(
+            self.notion_storage, recogniser, recogniser, recogniser, recogniser, recogniser, recogniser)
+
+    async def asyncTearDown(self):
+        await self.notion_storage.close()
+
+    async def test_latency_is_max_of_upload_and_recognition(self):
+        stage_seconds = 0.5
+        recogniser = StubRecogniser(["recognised"], delay=stage_seconds)
+        file_storage = StubFileStorage(latency=stage_seconds)
+        with FakeNotionServer() as server:
+            doc_storage = self._storage(server, recogniser, file_storage)
+            start = time.perf_counter()
+            page_id = await doc_storage.save_image("image", Path("photo.jpg"), description="caption")
+            elapsed = time.perf_counter() - start
+        self.assertLess(elapsed, 1.5 * stage_seconds)
+        self.assertEqual(file_storage.saved, [Path("photo.jpg")])
+        self.assertEqual(page_text(server.pages[page_id]), ["recognised", "caption"])
+
+    async def test_failed_recognition_cancels_upload(self):
+        recogniser = StubRecogniser([], delay=0.0, error=RuntimeError("recognition failed"))
+        file_storage = StubFileStorage(latency=2.0)
+        with FakeNotionServer() as server:
+            doc_storage = self._storage(server, recogniser, file_storage)
+            start = time.perf_counter()
+            with self.assertRaisesRegex(RuntimeError, "recognition failed"):
+                await doc_storage.save_audio("audio", Path("voice.oga"))
+            elapsed = time.perf_counter() - start
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(file_storage.saved, [])
+        self.assertEqual(server.pages, {})
+
+    async def test_failed_upload_cancels_recognition(self):
+        recogniser = StubRecogniser(["recognised"], delay=2.0)
+        file_storage = StubFileStorage(latency=0.1, error=RuntimeError("upload failed"))
+        with FakeNotionServer() as server:
+            doc_storage = self._storage(server, recogniser, file_storage)
+            with self.assertRaisesRegex(RuntimeError, "upload failed"):
+                await doc_storage.save_file("pdf", Path("doc.pdf"))
+        self.assertTrue(recogniser.cancelled)
+        self.assertEqual(server.pages, {})
+
+    async def test_album_items_processed_concurrently(self):
+        stage_seconds = 0.5
+        recogniser = StubRecogniser(["recognised"], delay=stage_seconds)
+        file_storage = StubFileStorage(latency=stage_seconds)
+        with FakeNotionServer() as server:
+            doc_storage = self._storage(server, recogniser, file_storage)
+            start = time.perf_counter()
+            page_id = await doc_storage.save_album("album", [
+                (Path("1.jpg"), "first"), (Path("2.jpg"), None), (Path("3.mp4"), None)])
+            elapsed = time.perf_counter() - start
+        self.assertLess(elapsed, 1.5 * stage_seconds)
+        self.assertEqual(len(server.pages), 1)
+        children = server.pages[page_id]["children"]
+        self.assertEqual([block["type"] for block in children],
+                         ["image", "paragraph", "paragraph", "image", "paragraph", "video", "paragraph"])
+        self.assertEqual(children[0]["image"]["external"]["url"], "https://files.test/1.jpg")
+        self.assertEqual(page_text(server.pages[page_id]), ["recognised", "first", "recognised", "recognised"])
+
+    async def test_links_fetched_concurrently_into_one_page(self):
+        stage_seconds = 0.5
+        recogniser = StubRecogniser([], delay=0.0)
+        pages = {"https://a.test/1": "first page", "https://b.test/2": "second page"}
+        with FakeNotionServer() as server:
+            doc_storage = self._storage(server, recogniser, StubFileStorage())
+            doc_storage.url_recogniser = StubPageRecogniser(pages, delay=stage_seconds)
+            start = time.perf_counter()
+            page_id = await doc_storage.save_links("links", "read these", [
+                ("https://a.test/1", None), ("https://down.test/", None), ("https://b.test/2", None)])
+            elapsed = time.perf_counter() - start
+        self.assertLess(elapsed, 1.5 * stage_seconds)
+        children = server.pages[page_id]["children"]
+        self.assertEqual([block["type"] for block in children],
+                         ["paragraph", "bookmark", "paragraph", "bookmark", "bookmark", "paragraph"])
+        self.assertEqual([block["bookmark"]["url"] for block in children if block["type"] == "bookmark"],
+                         ["https://a.test/1", "https://down.test/", "https://b.test/2"])
+        self.assertEqual(page_text(server.pages[page_id]), ["read these", "first page", "second page"])
+
+    async def test_binary_link_saved_as_bookmark_only(self):
+        with FakeNotionServer() as server, FakeWebServer() as web_server:
+            doc_storage = self._storage(server, StubRecogniser([], delay=0.0), StubFileStorage())
+            doc_storage.url_recogniser = WebPageRecogniser()
+            image_url, page_url = f"{web_server.url}/image/100000", f"{web_server.url}/page/1"
+            page_id = await doc_storage.save_links("links", "look", [(image_url, None), (page_url, None)])
+            await doc_storage.url_recogniser.close()
+        children = server.pages[page_id]["children"]
+        self.assertEqual([block["type"] for block in children], ["paragraph", "bookmark", "bookmark", "paragraph"])
+        self.assertEqual(page_text(server.pages[page_id]), ["look", "paragraph 0"])
+
+    async def test_unsupported_files_saved_with_caption_only(self):
+        recogniser = StubRecogniser(["recognised"], delay=0.0)
+        with FakeNotionServer() as server, tempfile.TemporaryDirectory() as tmp_dir:
+            docx_path, pdf_path = Path(tmp_dir) / "notes.docx", Path(tmp_dir) / "report.pdf"
+            docx_path.write_bytes(b"docx bytes")
+            pdf_path.write_bytes(b"pdf bytes")
+            doc_storage = self._storage(server, recogniser, StubFileStorage())
+            # behind an async wrapper, an unsupported file is only rejected when its recognition is awaited
+            cache = RecognitionCache(Path(tmp_dir) / "cache.sqlite")
+            doc_storage.file_recogniser = CachingFileRecogniser(
+                RedirectingFileRecogniser(recogniser, recogniser, recogniser, recogniser), cache)
+            album_id = await doc_storage.save_album("album", [(docx_path, "draft"), (pdf_path, "final")])
+            file_id = await doc_storage.save_file("file", docx_path, "draft")
+            cache.close()
+        self.assertEqual(page_text(server.pages[album_id]), ["draft", "recognised", "final"])
+        self.assertEqual(page_text(server.pages[file_id]), ["draft"])
+
+
+class TestSearchIndexing(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.search_index = SearchIndex(Path(self.tmp_dir.name) / "search.sqlite")
+
+    def tearDown(self):
+        self.search_index.close()
+        self.tmp_dir.cleanup()
+
+    def _storage(self, recogniser: StubRecogniser, progressive: bool):
+        return RecognisingDocumentsStorage(
+            RecordingDocumentsStorage(), recogniser, recogniser, recogniser, recogniser, recogniser, recogniser,
+            progressive=progressive, search_index=self.search_index)
+
+    async def test_recognised_text_and_caption_indexed(self):
+        for progressive in [False, True]:
+            with self.subTest(progressive=progressive):
+                doc_storage = self._storage(StubRecogniser(["a red ", "bicycle"], delay=0.01), progressive)
+                image_path = Path(self.tmp_dir.name) / "photo.jpg"
+                image_path.write_bytes(b"jpeg bytes")
+                document_id = await doc_storage.save_image("photo", image_path, description="parked outside")
+                results = await self.search_index.search("bicycle outside")
+                self.assertEqual([result.url for result in results], [f"https://documents.test/{document_id}"])
+                self.assertEqual(results[0].name, "photo")
+                await doc_storage.delete(document_id)
+                self.assertEqual(await self.search_index.search("bicycle"), [])
+
+    async def test_appended_text_indexed_under_document_name(self):
+        doc_storage = self._storage(StubRecogniser([], delay=0), progressive=False)
+        document_id = await doc_storage.save_text("notes", "first note")
+        await doc_storage.append_text(document_id, "second note")
+        results = await self.search_index.search("second")
+        self.assertEqual([(result.document_id, result.name) for result in results], [(document_id, "notes")])
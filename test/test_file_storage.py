@@ -1,9 +1,13 @@
+import os
+import tempfile
 import unittest
 from pathlib import Path
+from unittest import mock
 
 from dotenv import load_dotenv
 
-from file_storage import GoogleCloudStorage
+from file_storage import GoogleCloudStorage, LocalFileStorage
+from utils import hash_file
 
 
 class TestFileStorage(unittest.IsolatedAsyncioTestCase):
@@ -26,3 +30,102 @@ class TestFileStorage(unittest.IsolatedAsyncioTestCase):
     async def test_file(self):
         url = await self.file_storage.save_and_get_url(file_path=Path(__file__).parent / 'data' / "test.pdf")
         print("file url:", url)
+
+    async def test_same_content_same_url(self):
+        file_path = Path(__file__).parent / 'data' / "test.webp"
+        first_url = await self.file_storage.save_and_get_url(file_path=file_path)
+        second_url = await self.file_storage.save_and_get_url(file_path=file_path)
+        self.assertEqual(first_url, second_url)
+
+
+class StubBucket:
+    """Keeps blob names in memory, blobs in racing are uploaded by another process while this one uploads them."""
+
+    def __init__(self):
+        self.blobs = set()
+        self.racing = set()
+        self.lookups = 0
+        self.uploads = 0
+
+    def blob(self, name: str, chunk_size: int):
+        return StubBlob(self, name)
+
+
+class StubBlob:
+    def __init__(self, bucket: StubBucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.public_url = f"https://storage.test/{name}"
+
+    def exists(self) -> bool:
+        self.bucket.lookups += 1
+        return self.name in self.bucket.blobs
+
+    def upload_from_filename(self, filename: str, content_type: str, predefined_acl: str, if_generation_match: int):
+        from google.api_core.exceptions import PreconditionFailed
+
+        self.bucket.uploads += 1
+        if self.name in self.bucket.racing:
+            self.bucket.blobs.add(self.name)
+            raise PreconditionFailed("the blob already exists")
+        self.bucket.blobs.add(self.name)
+
+
+class TestGoogleCloudStorageOffline(unittest.IsolatedAsyncioTestCase):
+    async def test_same_content_uploaded_once(self):
+        bucket = StubBucket()
+        file_storage = GoogleCloudStorage(Path("creds.json"), "bucket", max_known_blobs=1)
+        file_storage._bucket = mock.Mock(**{"get.return_value": bucket})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            uploaded, racing = Path(tmp_dir) / "uploaded.jpg", Path(tmp_dir) / "racing.jpg"
+            uploaded.write_bytes(b"uploaded before")
+            racing.write_bytes(b"uploaded concurrently")
+            bucket.blobs.add(hash_file(uploaded) + ".jpg")
+            bucket.racing.add(hash_file(racing) + ".jpg")
+            self.assertEqual(await file_storage.save_and_get_url(uploaded),
+                             f"https://storage.test/{hash_file(uploaded)}.jpg")
+            self.assertEqual(bucket.uploads, 0)
+            self.assertEqual(await file_storage.save_and_get_url(racing),
+                             f"https://storage.test/{hash_file(racing)}.jpg")
+            self.assertEqual(bucket.uploads, 1)
+            # the last blob is remembered, the one before it is looked up again
+            await file_storage.save_and_get_url(racing)
+            self.assertEqual(bucket.lookups, 2)
+            await file_storage.save_and_get_url(uploaded)
+            self.assertEqual(bucket.lookups, 3)
+        self.assertEqual(bucket.uploads, 1)
+        self.assertEqual(len(file_storage._uploaded), 1)
+
+
+class TestLocalFileStorage(unittest.IsolatedAsyncioTestCase):
+    async def test_content_addressed_copy(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = Path(tmp_dir)
+            (tmp_path / "a.JPG").write_bytes(b"same")
+            (tmp_path / "b.jpg").write_bytes(b"same")
+            (tmp_path / "c.jpg").write_bytes(b"other")
+            file_storage = LocalFileStorage(tmp_path / "files", "http://files.test/")
+            first_url = await file_storage.save_and_get_url(tmp_path / "a.JPG")
+            second_url = await file_storage.save_and_get_url(tmp_path / "b.jpg")
+            third_url = await file_storage.save_and_get_url(tmp_path / "c.jpg")
+            stored = sorted(path.name for path in (tmp_path / "files").iterdir())
+            self.assertEqual(first_url, second_url)
+            self.assertNotEqual(first_url, third_url)
+            self.assertTrue(first_url.startswith("http://files.test/") and first_url.endswith(".jpg"))
+            self.assertEqual(stored, sorted(url.rsplit("/", 1)[1] for url in (first_url, third_url)))
+            self.assertEqual((tmp_path / "files" / first_url.rsplit("/", 1)[1]).read_bytes(), b"same")
+
+
+class TestHashFile(unittest.TestCase):
+    def test_hash_reused_until_file_changes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = Path(tmp_dir) / "a.jpg"
+            file_path.write_bytes(b"first")
+            with mock.patch("utils.open", side_effect=open, create=True) as opened:
+                first_hash = hash_file(file_path)
+                self.assertEqual(hash_file(file_path), first_hash)
+                self.assertEqual(opened.call_count, 1)
+                file_path.write_bytes(b"other")
+                os.utime(file_path, ns=(0, 0))
+                self.assertNotEqual(hash_file(file_path), first_hash)
+                self.assertEqual(opened.call_count, 2)
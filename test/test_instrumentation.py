@@ -0,0 +1,67 @@
+import asyncio
+import contextlib
+import importlib.util
+import unittest
+import urllib.request
+from unittest import mock
+
+import instrumentation
+from instrumentation import observe_wait, stage
+from notion_scheduler import NotionRequestScheduler
+
+
+class TestInstrumentation(unittest.IsolatedAsyncioTestCase):
+    def tearDown(self):
+        instrumentation.disable()
+
+    def _scrape(self, port: int) -> str:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            return response.read().decode()
+
+    def test_disabled_stage_is_shared_noop(self):
+        self.assertIs(stage("a"), stage("b"))
+        with stage("a") as timed:
+            timed.add_bytes(10)
+        observe_wait("tasks", 1.0)
+
+    async def test_stages_exported(self):
+        port = instrumentation.enable(metrics_port=0)
+        with stage("gcs.upload") as upload:
+            upload.add_bytes(1024)
+            await asyncio.sleep(0.05)
+        with self.assertRaises(ValueError):
+            with stage("openai.vision"):
+                raise ValueError()
+        observe_wait("tasks", 0.3)
+        metrics = await asyncio.to_thread(self._scrape, port)
+        self.assertIn('telegram2notion_stage_seconds_count{stage="gcs.upload"} 1.0', metrics)
+        self.assertIn('telegram2notion_stage_bytes_total{stage="gcs.upload"} 1024.0', metrics)
+        self.assertIn('telegram2notion_stage_errors_total{error="ValueError",stage="openai.vision"} 1.0', metrics)
+        self.assertIn('telegram2notion_queue_wait_seconds_bucket{le="0.5",queue="tasks"} 1.0', metrics)
+
+    async def test_notion_requests_and_waits_recorded(self):
+        port = instrumentation.enable(metrics_port=0)
+        scheduler = NotionRequestScheduler(requests_per_second=10, burst=1)
+
+        async def request():
+            return "done"
+
+        await asyncio.gather(*[scheduler.run(request) for _ in range(3)])
+        metrics = await asyncio.to_thread(self._scrape, port)
+        self.assertIn('telegram2notion_stage_seconds_count{stage="notion.request"} 3.0', metrics)
+        self.assertIn('telegram2notion_queue_wait_seconds_count{queue="notion"} 3.0', metrics)
+
+    @unittest.skipUnless(importlib.util.find_spec("opentelemetry"), "tracing is optional, opentelemetry is not installed")
+    async def test_spans_created_when_tracing(self):
+        spans = []
+
+        class RecordingTracer:
+            def start_as_current_span(self, name):
+                spans.append(name)
+                return contextlib.nullcontext()
+
+        with mock.patch("opentelemetry.trace.get_tracer", return_value=RecordingTracer()):
+            instrumentation.enable(tracing=True)
+        with stage("notion.request"):
+            pass
+        self.assertEqual(spans, ["notion.request"])
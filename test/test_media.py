@@ -0,0 +1,74 @@
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+from PIL import Image
+
+from media import prepare_audio, probe_audio_codec, prepare_image, PreparedImage
+from test.fakes import make_audio, make_video, make_photo, make_screenshot
+
+
+class TestPrepareAudio(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    async def test_accepted_audio_used_as_is(self):
+        audio_path = self.tmp_path / "voice.mp3"
+        make_audio(audio_path, tones=1)
+        self.assertEqual(await prepare_audio(audio_path, self.tmp_path), audio_path)
+
+    async def test_video_audio_track_stream_copied(self):
+        video_path = self.tmp_path / "video.mp4"
+        make_video(video_path)
+        audio_path = await prepare_audio(video_path, self.tmp_path)
+        self.assertEqual(audio_path.suffix, ".m4a")
+        self.assertEqual(await probe_audio_codec(audio_path), "aac")
+        self.assertLess(audio_path.stat().st_size, video_path.stat().st_size)
+
+    async def test_uncompressed_audio_transcoded(self):
+        wav_path = self.tmp_path / "recording.wav"
+        make_audio(wav_path, tones=2)
+        audio_path = await prepare_audio(wav_path, self.tmp_path)
+        self.assertEqual(audio_path.suffix, ".ogg")
+        self.assertEqual(await probe_audio_codec(audio_path), "opus")
+        self.assertLess(audio_path.stat().st_size * 5, wav_path.stat().st_size)
+
+
+class TestPrepareImage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_photo_downscaled_to_jpeg(self):
+        photo_path = self.tmp_path / "photo.jpg"
+        make_photo(photo_path, 3000, 2250)
+        images = prepare_image(photo_path)
+        self.assertEqual(len(images), 1)
+        self.assertEqual(images[0].mime_type, "image/jpeg")
+        with Image.open(io.BytesIO(images[0].data)) as image:
+            self.assertEqual(image.size, (1024, 768))
+        self.assertLess(len(images[0].data), photo_path.stat().st_size)
+
+    def test_tall_screenshot_tiled(self):
+        screenshot_path = self.tmp_path / "screenshot.png"
+        make_screenshot(screenshot_path, 1080, 7000)
+        images = prepare_image(screenshot_path)
+        self.assertEqual(len(images), 4)
+        for prepared in images:
+            self.assertEqual(prepared.mime_type, "image/png")
+            with Image.open(io.BytesIO(prepared.data)) as image:
+                self.assertLessEqual(min(image.size), 768)
+
+    def test_small_image_kept_with_its_mime_type(self):
+        image_path = self.tmp_path / "small.webp"
+        Image.new("RGB", (300, 200), "red").save(image_path)
+        images = prepare_image(image_path)
+        self.assertEqual(images, [PreparedImage(image_path.read_bytes(), "image/webp", (300, 200))])
@@ -0,0 +1,59 @@
+import unittest
+
+from notion_blocks import batch_blocks, build_blocks, split_text
+from recognisers import format_table
+
+
+def block_text(block) -> str:
+    return "".join(item["text"]["content"] for item in block[block["type"]]["rich_text"])
+
+
+class TestBuildBlocks(unittest.TestCase):
+    def test_split_text_keeps_content(self):
+        text = "\n".join(f"line {i} " + "word " * 50 for i in range(200))
+        pieces = split_text(text)
+        self.assertEqual("".join(pieces), text)
+        self.assertTrue(all(len(piece) <= 2000 for piece in pieces))
+        self.assertTrue(all(piece.endswith("\n") for piece in pieces[:-1]))
+        self.assertEqual(split_text("x" * 4500), ["x" * 2000, "x" * 2000, "x" * 500])
+
+    def test_long_paragraph_split_into_rich_text(self):
+        text = "word " * 100000
+        blocks = list(build_blocks(text))
+        self.assertEqual([block["type"] for block in blocks], ["paragraph"] * len(blocks))
+        self.assertGreater(len(blocks), 1)
+        self.assertTrue(all(len(block["paragraph"]["rich_text"]) <= 100 for block in blocks))
+        self.assertEqual("".join(block_text(block) for block in blocks), text)
+
+    def test_headings_paragraphs_and_tables(self):
+        table = format_table([["name", "value"], ["a", "1"], ["b", None]])
+        text = f"PDF document: test.pdf\nPage: 1\nfirst line\nsecond line\n\n## Summary\n{table}\nafter"
+        blocks = list(build_blocks(text))
+        self.assertEqual(
+            [block["type"] for block in blocks],
+            ["paragraph", "heading_2", "paragraph", "heading_2", "table", "paragraph"]
+        )
+        self.assertEqual(block_text(blocks[1]), "Page: 1")
+        self.assertEqual(block_text(blocks[2]), "first line\nsecond line")
+        self.assertEqual(block_text(blocks[3]), "Summary")
+        rows = blocks[4]["table"]["children"]
+        self.assertEqual(blocks[4]["table"]["table_width"], 2)
+        self.assertTrue(blocks[4]["table"]["has_column_header"])
+        self.assertEqual([[cell[0]["text"]["content"] if cell else "" for cell in row["table_row"]["cells"]]
+                          for row in rows], [["name", "value"], ["a", "1"], ["b", ""]])
+
+    def test_long_table_repeats_header(self):
+        table = format_table([["n"]] + [[str(i)] for i in range(250)])
+        blocks = list(build_blocks(table))
+        self.assertEqual(len(blocks), 3)
+        for block in blocks:
+            self.assertLessEqual(len(block["table"]["children"]), 100)
+            self.assertEqual(block["table"]["children"][0]["table_row"]["cells"][0][0]["text"]["content"], "n")
+
+    def test_batches_respect_limits(self):
+        text = "\n\n".join(f"paragraph {i}" for i in range(250))
+        batches = list(batch_blocks(build_blocks(text)))
+        self.assertEqual([len(batch) for batch in batches], [100, 100, 50])
+        tables = "\n\n".join(format_table([[str(i)] for i in range(50)]) for _ in range(30))
+        for batch in batch_blocks(build_blocks(tables)):
+            self.assertLessEqual(sum(1 + len(block["table"]["children"]) for block in batch), 1000)
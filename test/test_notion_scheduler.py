@@ -0,0 +1,80 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+from notion_client.errors import APIResponseError, HTTPResponseError, RequestTimeoutError
+
+from document_storage import NotionDocumentsStorage
+from notion_scheduler import NotionRequestScheduler, NotionQueueFullError
+from test.fakes import FakeNotionServer, StubFileStorage
+
+
+class TestNotionRequestScheduler(unittest.IsolatedAsyncioTestCase):
+    async def test_burst_paced_without_errors(self):
+        # a token bucket lets through at most burst + rate requests in any second
+        with FakeNotionServer(rate_limit=20) as server:
+            scheduler = NotionRequestScheduler(requests_per_second=9, burst=9)
+            doc_storage = NotionDocumentsStorage(
+                "token", "parent", StubFileStorage(), base_url=server.url, scheduler=scheduler)
+            start = time.perf_counter()
+            await asyncio.gather(*[doc_storage.save_text(name=f"note {i}", text="text") for i in range(27)])
+            elapsed = time.perf_counter() - start
+            await doc_storage.close()
+        self.assertEqual(len(server.pages), 27)
+        self.assertEqual(server.rejected, 0)
+        self.assertGreater(elapsed, 1.5)
+        self.assertGreater(scheduler.metrics()["max_queue_depth"], 10)
+        self.assertGreater(scheduler.metrics()["max_wait_seconds"], 1.5)
+
+    async def test_retry_after_honoured(self):
+        with FakeNotionServer(rate_limit=10, retry_after=0.5) as server:
+            # the scheduler is configured faster than the server allows
+            scheduler = NotionRequestScheduler(requests_per_second=50, burst=20)
+            doc_storage = NotionDocumentsStorage(
+                "token", "parent", StubFileStorage(), base_url=server.url, scheduler=scheduler)
+            await asyncio.gather(*[doc_storage.save_text(name=f"note {i}", text="text") for i in range(25)])
+            await doc_storage.close()
+        self.assertEqual(len(server.pages), 25)
+        self.assertGreater(server.rejected, 0)
+        self.assertEqual(scheduler.metrics()["rate_limited"], server.rejected)
+
+    async def test_gives_up_after_max_retries(self):
+        with FakeNotionServer(rate_limit=0, retry_after=0.01) as server:
+            doc_storage = NotionDocumentsStorage(
+                "token", "parent", StubFileStorage(), base_url=server.url,
+                scheduler=NotionRequestScheduler(max_retries=2))
+            with self.assertRaises(APIResponseError):
+                await doc_storage.save_text(name="note", text="text")
+            await doc_storage.close()
+        self.assertEqual(server.rejected, 3)
+
+    async def test_bounded_queue(self):
+        scheduler = NotionRequestScheduler(requests_per_second=1, burst=1, max_queue=2)
+
+        async def request():
+            return "done"
+
+        results = await asyncio.gather(*[scheduler.run(request) for _ in range(4)], return_exceptions=True)
+        self.assertEqual(results[:3], ["done"] * 3)
+        self.assertIsInstance(results[3], NotionQueueFullError)
+
+    async def test_ambiguous_failures_retried_only_if_idempotent(self):
+        scheduler = NotionRequestScheduler(base_backoff_seconds=0.01)
+        gateway_error = HTTPResponseError(httpx.Response(502, request=httpx.Request("POST", "https://notion.test")))
+        for error in [gateway_error, RequestTimeoutError()]:
+            calls = []
+
+            async def request():
+                calls.append(None)
+                if len(calls) == 1:
+                    raise error
+                return "done"
+
+            with self.subTest(error=type(error).__name__):
+                self.assertEqual(await scheduler.run(request), "done")
+                calls.clear()
+                # the page may have been created, sending it again would duplicate it
+                with self.assertRaises(type(error)):
+                    await scheduler.run(request, idempotent=False)
+                self.assertEqual(len(calls), 1)
@@ -1,10 +1,14 @@
+import asyncio
 import os
+import time
 import unittest
 from pathlib import Path
 from dotenv import load_dotenv
 
 from document_storage import NotionDocumentsStorage
+from notion_scheduler import NotionRequestScheduler
 from file_storage import GoogleCloudStorage
+from test.fakes import FakeNotionServer, StubFileStorage
 
 
 class TestNotionDocumentStorage(unittest.IsolatedAsyncioTestCase):
@@ -24,3 +28,46 @@ class TestNotionDocumentStorage(unittest.IsolatedAsyncioTestCase):
 
     async def test_pdf(self):
         await self.doc_storage.save_file(file_path=Path(__file__).parent / 'data' / "test.pdf", name="test_pdf")
+
+
+class TestNotionDocumentStorageConcurrency(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_saves_overlap(self):
+        latency = 0.3
+        with FakeNotionServer(latency=latency) as server:
+            doc_storage = NotionDocumentsStorage("token", "parent", StubFileStorage(), base_url=server.url)
+            start = time.perf_counter()
+            await asyncio.gather(*[doc_storage.save_text(name=f"note {i}", text=f"text {i}") for i in range(5)])
+            elapsed = time.perf_counter() - start
+            await doc_storage.close()
+        self.assertEqual(len(server.pages), 5)
+        self.assertGreater(server.max_active_requests, 1)
+        self.assertLess(elapsed, 5 * latency)
+
+    async def test_long_text_appended_in_batches(self):
+        text = "\n\n".join(f"paragraph {i} " + "word " * 1000 for i in range(250))
+        with FakeNotionServer() as server:
+            doc_storage = NotionDocumentsStorage(
+                "token", "parent", StubFileStorage(), base_url=server.url,
+                scheduler=NotionRequestScheduler(requests_per_second=100, burst=100))
+            await doc_storage.save_file(name="long", file_path=Path("doc.pdf"), description=text)
+            await doc_storage.close()
+        page, = server.pages.values()
+        children = page["children"]
+        self.assertEqual(children[0]["type"], "file")
+        self.assertEqual(server.appends, 2)
+        paragraphs = ["".join(item["text"]["content"] for item in block["paragraph"]["rich_text"])
+                      for block in children[1:]]
+        self.assertEqual("\n\n".join(paragraphs), text)
+
+    async def test_failed_append_archives_page(self):
+        text = "\n\n".join(f"paragraph {i}" for i in range(150))
+        with FakeNotionServer() as server:
+            server.fail_appends_after = 0
+            doc_storage = NotionDocumentsStorage(
+                "token", "parent", StubFileStorage(), base_url=server.url,
+                scheduler=NotionRequestScheduler(max_retries=0))
+            with self.assertRaises(Exception):
+                await doc_storage.save_text(name="long", text=text)
+            await doc_storage.close()
+        page, = server.pages.values()
+        self.assertTrue(page["archived"])
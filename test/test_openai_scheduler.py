@@ -0,0 +1,146 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from openai import AsyncOpenAI
+
+from openai_scheduler import OpenAIRequestScheduler, BULK, INTERACTIVE, bulk_priority, estimate_image_tokens
+from recognisers import VisionGPTImageRecogniser, WhisperAudioRecogniser
+from test.fakes import FakeOpenAIServer, make_audio, make_photo
+
+
+class StubResponse:
+    def __init__(self, result: str, headers=None):
+        self.result = result
+        self.headers = headers or {}
+
+    def parse(self):
+        return self.result
+
+
+class TestOpenAIRequestScheduler(unittest.IsolatedAsyncioTestCase):
+    async def test_token_budget_paces_requests_interactive_first(self):
+        # 1 token per second, the first request takes the whole budget
+        scheduler = OpenAIRequestScheduler(tokens_per_minute=60)
+        sent = []
+
+        def request(name: str):
+            async def send():
+                sent.append((name, time.monotonic()))
+                return StubResponse(name)
+            return send
+
+        start = time.monotonic()
+        await scheduler.run(request("first"), "model", tokens=60)
+        with bulk_priority():
+            bulk = asyncio.create_task(scheduler.run(request("bulk"), "model", tokens=1))
+        await asyncio.sleep(0.1)
+        interactive = asyncio.create_task(scheduler.run(request("interactive"), "model", tokens=1))
+        self.assertEqual(await asyncio.gather(bulk, interactive), ["bulk", "interactive"])
+        self.assertEqual([name for name, _ in sent], ["first", "interactive", "bulk"])
+        self.assertGreater(sent[1][1] - start, 0.8)
+        self.assertGreater(sent[2][1] - start, 1.8)
+        self.assertEqual(scheduler.metrics()["estimated_tokens"], 62)
+
+    async def test_explicit_priority(self):
+        scheduler = OpenAIRequestScheduler(initial_concurrency=1)
+        sent = []
+        release = asyncio.Event()
+
+        def request(name: str):
+            async def send():
+                sent.append(name)
+                await release.wait()
+                return StubResponse(name)
+            return send
+
+        first = asyncio.create_task(scheduler.run(request("first"), "model", tokens=1))
+        await asyncio.sleep(0.01)
+        later = [asyncio.create_task(scheduler.run(request(name), "model", tokens=1, priority=priority))
+                 for name, priority in [("bulk", BULK), ("interactive", INTERACTIVE)]]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(first, *later)
+        self.assertEqual(sent, ["first", "interactive", "bulk"])
+
+    async def test_cancelled_waiter_does_not_block_later_requests(self):
+        scheduler = OpenAIRequestScheduler()
+
+        async def request():
+            return StubResponse("done")
+
+        # the first request is cancelled while it waits for the lock of the queue
+        async with scheduler._budget("model").condition:
+            cancelled = asyncio.create_task(scheduler.run(request, "model", tokens=1))
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            await asyncio.gather(cancelled, return_exceptions=True)
+        self.assertEqual(await asyncio.wait_for(scheduler.run(request, "model", tokens=1), 1.0), "done")
+
+    async def test_rate_limited_requests_retried_with_less_concurrency(self):
+        with FakeOpenAIServer(latency=0.05, rate_limit=4, retry_after=0.3) as server, \
+                tempfile.TemporaryDirectory() as tmp_dir:
+            image_path = Path(tmp_dir) / "photo.jpg"
+            make_photo(image_path, 640, 480)
+            client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+            scheduler = OpenAIRequestScheduler(tokens_per_minute=10 ** 6, initial_concurrency=8)
+            recogniser = VisionGPTImageRecogniser(client, scheduler=scheduler)
+            results = await asyncio.gather(*[recogniser.recognise(image_path) for _ in range(12)])
+        self.assertEqual(results, ["image description"] * 12)
+        self.assertGreater(server.rejected, 0)
+        self.assertEqual(scheduler.metrics()["rate_limited"], server.rejected)
+        self.assertLess(scheduler.budgets[recogniser.model].concurrency, 8)
+
+    async def test_budgets_follow_rate_limit_headers(self):
+        headers = {
+            "x-ratelimit-limit-requests": "100", "x-ratelimit-remaining-requests": "99",
+            "x-ratelimit-limit-tokens": "40000", "x-ratelimit-remaining-tokens": "30000",
+        }
+        with FakeOpenAIServer(rate_limit_headers=headers) as server, tempfile.TemporaryDirectory() as tmp_dir:
+            image_path = Path(tmp_dir) / "photo.jpg"
+            make_photo(image_path, 1024, 768)
+            client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+            scheduler = OpenAIRequestScheduler()
+            recogniser = VisionGPTImageRecogniser(client, scheduler=scheduler)
+            await recogniser.recognise(image_path)
+        metrics = scheduler.metrics()
+        self.assertEqual(scheduler.budgets[recogniser.model].requests_per_minute, 100)
+        self.assertEqual(scheduler.budgets[recogniser.model].tokens_per_minute, 40000)
+        # the prompt, the tiles of the image and the longest answer are reserved, the reported usage is spent
+        self.assertGreater(metrics["estimated_tokens"], recogniser.max_tokens + estimate_image_tokens(1024, 768))
+        self.assertEqual(metrics["used_tokens"], 2)
+
+    async def test_models_have_separate_budgets(self):
+        # 1 token per second, the first request takes the whole budget of its model
+        scheduler = OpenAIRequestScheduler(tokens_per_minute=60)
+
+        async def request():
+            return StubResponse("done")
+
+        await scheduler.run(request, "vision", tokens=60)
+        start = time.monotonic()
+        await asyncio.wait_for(asyncio.gather(
+            scheduler.run(request, "other vision", tokens=60), scheduler.run(request, "vision")), 0.5)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    async def test_transcriptions_limited_by_requests_only(self):
+        headers = {"x-ratelimit-limit-requests": "50", "x-ratelimit-remaining-requests": "49"}
+        with FakeOpenAIServer(rate_limit_headers=headers) as server, tempfile.TemporaryDirectory() as tmp_dir:
+            audio_path = Path(tmp_dir) / "voice.ogg"
+            make_audio(audio_path, tones=2, tone_seconds=1)
+            client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+            scheduler = OpenAIRequestScheduler()
+            recogniser = WhisperAudioRecogniser(client, scheduler=scheduler)
+            result = await recogniser.recognise(audio_path)
+        self.assertEqual(result.strip(), "transcript of voice.ogg")
+        self.assertEqual(scheduler.metrics()["requests"], 1)
+        self.assertEqual(scheduler.metrics()["estimated_tokens"], 0)
+        self.assertEqual(list(scheduler.budgets), [recogniser.model])
+        self.assertEqual(scheduler.budgets[recogniser.model].requests_per_minute, 50)
+
+    def test_image_token_estimate(self):
+        # examples from the OpenAI vision pricing documentation
+        self.assertEqual(estimate_image_tokens(1024, 1024), 765)
+        self.assertEqual(estimate_image_tokens(2048, 4096), 1105)
@@ -1,9 +1,22 @@
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 
 from recognisers import WhisperAudioRecogniser, VisionGPTImageRecogniser, SoundOnlyVideoRecogniser, \
-    PDFPlumberFileRecogniser, WebPageRecogniser
+    PDFPlumberFileRecogniser, WebPageRecogniser, FileRecogniser
+from openai import AsyncOpenAI
+
+from test.fakes import make_pdf, FakeWebServer, FakeOpenAIServer, make_audio, make_video, make_screenshot
 
 
 class TestFileRecognisers(unittest.IsolatedAsyncioTestCase):
@@ -33,11 +46,198 @@ class TestFileRecognisers(unittest.IsolatedAsyncioTestCase):
         print(result)
 
 
+class SlowStubImageRecogniser(FileRecogniser):
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+
+    async def recognise(self, file_path: Path) -> str:
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(random.uniform(0.01, 0.05))
+        self.active -= 1
+        return f"image {file_path.stem}"
+
+
+class TestPDFPlumberFileRecogniserOffline(unittest.IsolatedAsyncioTestCase):
+    async def test_images_recognised_concurrently_in_order(self):
+        image_recogniser = SlowStubImageRecogniser()
+        recogniser = PDFPlumberFileRecogniser(image_recogniser, max_concurrent_images=3)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_path = Path(tmp_dir) / "doc.pdf"
+            make_pdf(pdf_path, page_count=3, lines_per_page=2, images_per_page=2, with_table=True)
+            result = await recogniser.recognise(pdf_path)
+        self.assertEqual(image_recogniser.max_active, 3)
+        positions = [result.index(f"image {page}_{image}") for page in range(3) for image in range(2)]
+        self.assertEqual(positions, sorted(positions))
+        self.assertIn("Page 2 line 1", result)
+        self.assertIn("| r2c0 | r2c1 | r2c2 |", result)
+
+    async def test_process_pool_matches_thread_extraction(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_path = Path(tmp_dir) / "doc.pdf"
+            make_pdf(pdf_path, page_count=5, lines_per_page=3, images_per_page=1, with_table=True)
+            expected = await PDFPlumberFileRecogniser(SlowStubImageRecogniser()).recognise(pdf_path)
+            with ProcessPoolExecutor(max_workers=2) as pool:
+                recogniser = PDFPlumberFileRecogniser(SlowStubImageRecogniser(), process_pool=pool, pages_per_chunk=2)
+                result = await recogniser.recognise(pdf_path)
+        self.assertEqual(result, expected)
+
+    async def test_parts_are_pages(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_path = Path(tmp_dir) / "doc.pdf"
+            make_pdf(pdf_path, page_count=5, lines_per_page=3, images_per_page=1)
+            recogniser = PDFPlumberFileRecogniser(SlowStubImageRecogniser())
+            parts = [part async for part in recogniser.recognise_parts(pdf_path)]
+            result = await recogniser.recognise(pdf_path)
+        self.assertEqual(len(parts), 5)
+        self.assertTrue(parts[0].startswith("PDF document: doc.pdf\nPage: 0\n"))
+        self.assertTrue(parts[4].startswith("\n\nPage: 4\n"))
+        self.assertEqual("".join(parts), result)
+
+
 class TestURLRecogniser(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
         load_dotenv()
 
-    async def test_scrapy_url_recogniser(self):
+    async def test_web_page_recogniser(self):
         recogniser = WebPageRecogniser()
         result = await recogniser.recognise("https://github.com/dimitree54/tg_lila_bot")
         print(result)
+
+
+class TestWhisperAudioRecogniserOffline(unittest.IsolatedAsyncioTestCase):
+    async def test_long_audio_chunked_in_order(self):
+        with FakeOpenAIServer(jitter=0.2) as server, tempfile.TemporaryDirectory() as tmp_dir:
+            audio_path = Path(tmp_dir) / "long.mp3"
+            make_audio(audio_path, tones=6)
+            client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+            max_chunk_bytes = audio_path.stat().st_size // 3
+            recogniser = WhisperAudioRecogniser(client, max_chunk_bytes=max_chunk_bytes, max_concurrent_chunks=2)
+            result = await recogniser.recognise(audio_path)
+            uploads = [body for method, path, body in server.requests]
+        lines = result.splitlines()
+        self.assertGreaterEqual(len(lines), 3)
+        self.assertEqual(lines, [f"transcript of chunk_{index:03d}.mp3" for index in range(len(lines))])
+        self.assertTrue(all(len(body) < max_chunk_bytes + 1024 for body in uploads))
+        self.assertLessEqual(server.max_active_requests, 2)
+
+    async def test_long_audio_parts_are_chunks(self):
+        with FakeOpenAIServer(jitter=0.2) as server, tempfile.TemporaryDirectory() as tmp_dir:
+            audio_path = Path(tmp_dir) / "long.mp3"
+            make_audio(audio_path, tones=6)
+            client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+            recogniser = WhisperAudioRecogniser(client, max_chunk_bytes=audio_path.stat().st_size // 3)
+            parts = [part async for part in recogniser.recognise_parts(audio_path)]
+        self.assertGreaterEqual(len(parts), 3)
+        self.assertEqual(parts, ["transcript of chunk_000.mp3"] + [
+            f"\ntranscript of chunk_{index:03d}.mp3" for index in range(1, len(parts))])
+
+    async def test_small_audio_sent_whole(self):
+        with FakeOpenAIServer() as server, tempfile.TemporaryDirectory() as tmp_dir:
+            audio_path = Path(tmp_dir) / "short.mp3"
+            make_audio(audio_path, tones=1)
+            client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+            result = await WhisperAudioRecogniser(client).recognise(audio_path)
+        self.assertEqual(result.strip(), "transcript of short.mp3")
+
+    async def test_timestamps(self):
+        with FakeOpenAIServer() as server, tempfile.TemporaryDirectory() as tmp_dir:
+            audio_path = Path(tmp_dir) / "long.mp3"
+            make_audio(audio_path, tones=4)
+            client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+            recogniser = WhisperAudioRecogniser(client, max_chunk_bytes=audio_path.stat().st_size // 2, timestamps=True)
+            result = await recogniser.recognise(audio_path)
+        self.assertTrue(result.startswith("[00:00:00] transcript of chunk_000.mp3\n[00:00:0"))
+
+
+class TestVisionGPTImageRecogniserOffline(unittest.IsolatedAsyncioTestCase):
+    async def test_tiles_sent_with_mime_type(self):
+        with FakeOpenAIServer() as server, tempfile.TemporaryDirectory() as tmp_dir:
+            screenshot_path = Path(tmp_dir) / "screenshot.png"
+            make_screenshot(screenshot_path, 1080, 5000)
+            client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+            result = await VisionGPTImageRecogniser(client).recognise(screenshot_path)
+            request = json.loads(server.requests[0][2])
+        self.assertEqual(result, "image description")
+        image_urls = [part["image_url"] for part in request["messages"][1]["content"]]
+        self.assertEqual(len(image_urls), 3)
+        self.assertTrue(all(url.startswith("data:image/png;base64,") for url in image_urls))
+
+
+class TestSoundOnlyVideoRecogniserOffline(unittest.IsolatedAsyncioTestCase):
+    async def test_audio_track_transcribed(self):
+        with FakeOpenAIServer() as server, tempfile.TemporaryDirectory() as tmp_dir:
+            video_path = Path(tmp_dir) / "video.mp4"
+            make_video(video_path)
+            client = AsyncOpenAI(base_url=f"{server.url}/v1", api_key="test", max_retries=0)
+            result = await SoundOnlyVideoRecogniser(WhisperAudioRecogniser(client)).recognise(video_path)
+        self.assertEqual(result.strip(), "transcript of video.m4a")
+
+
+class TestWebPageRecogniserOffline(unittest.IsolatedAsyncioTestCase):
+    async def test_page_text_extracted(self):
+        with FakeWebServer() as server:
+            recogniser = WebPageRecogniser()
+            result = await recogniser.recognise(f"{server.url}/page/3")
+            await recogniser.close()
+        self.assertEqual(result, "paragraph 0\nparagraph 1\nparagraph 2")
+
+    async def test_large_page_truncated(self):
+        with FakeWebServer() as server:
+            recogniser = WebPageRecogniser(max_bytes=64 * 1024)
+            result = await recogniser.recognise(f"{server.url}/page/200000")
+            await recogniser.close()
+        self.assertTrue(result.startswith("paragraph 0\n"))
+        self.assertNotIn("paragraph 199999", result)
+
+    async def test_binary_url_has_no_text(self):
+        with FakeWebServer() as server:
+            recogniser = WebPageRecogniser()
+            result = await recogniser.recognise(f"{server.url}/image/100000")
+            await recogniser.close()
+        self.assertEqual(result, "")
+
+    async def test_many_urls_concurrently(self):
+        latency = 0.3
+        with FakeWebServer(latency=latency) as server:
+            recogniser = WebPageRecogniser()
+            start = time.perf_counter()
+            results = await asyncio.gather(*[recogniser.recognise(f"{server.url}/page/{i}") for i in range(1, 11)])
+            elapsed = time.perf_counter() - start
+            await recogniser.close()
+        self.assertEqual([len(result.splitlines()) for result in results], list(range(1, 11)))
+        self.assertLess(elapsed, 5 * latency)
+
+    async def test_connections_per_host_limited(self):
+        with FakeWebServer(latency=0.2) as server:
+            recogniser = WebPageRecogniser(max_connections_per_host=2)
+            results = await asyncio.gather(*[recogniser.recognise(f"{server.url}/page/{i}") for i in range(1, 7)])
+            await recogniser.close()
+        self.assertEqual([len(result.splitlines()) for result in results], list(range(1, 7)))
+        self.assertEqual(server.max_active_requests, 2)
+
+    async def test_repeated_calls_in_one_process(self):
+        with FakeWebServer() as server:
+            recogniser = WebPageRecogniser()
+            first = await recogniser.recognise(f"{server.url}/page/1")
+            second = await recogniser.recognise(f"{server.url}/page/1")
+            await recogniser.close()
+        self.assertEqual(first, second)
+
+
+class TestLazyBackends(unittest.TestCase):
+    def test_heavy_backends_not_imported_at_startup(self):
+        code = ("import sys, main; "
+                "print(','.join(m for m in ['openai', 'pdfplumber', 'lxml', 'PIL', 'google.cloud.storage'] if m in sys.modules))")
+        result = subprocess.run(
+            [sys.executable, "-c", code], cwd=Path(__file__).parent.parent, check=True, capture_output=True, text=True)
+        self.assertEqual(result.stdout.strip(), "")
+
+    @mock.patch.dict(os.environ, {"OPENAI_API_KEY": "test"})
+    def test_recognisers_share_one_client(self):
+        audio_recogniser = WhisperAudioRecogniser()
+        image_recogniser = VisionGPTImageRecogniser()
+        self.assertIs(audio_recogniser.client, image_recogniser.client)
+        own_client = AsyncOpenAI(api_key="test")
+        self.assertIs(VisionGPTImageRecogniser(own_client).client, own_client)
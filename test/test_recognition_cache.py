@@ -0,0 +1,115 @@
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Optional
+
+from recognition_cache import RecognitionCache
+from recognisers import CachingFileRecogniser, CachingURLRecogniser, FileRecogniser, URLRecogniser
+
+
+class CountingFileRecogniser(FileRecogniser):
+    def __init__(self, identity: str = "counting"):
+        self._identity = identity
+        self.calls = 0
+
+    @property
+    def identity(self) -> str:
+        return self._identity
+
+    async def recognise(self, file_path: Path) -> str:
+        self.calls += 1
+        return f"{self._identity} recognised {file_path.read_bytes().decode()}"
+
+
+class EmptyAnswerRecogniser(FileRecogniser):
+    """Like the vision model answering without content."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def recognise(self, file_path: Path) -> Optional[str]:
+        self.calls += 1
+        return None
+
+
+class CountingURLRecogniser(URLRecogniser):
+    def __init__(self):
+        self.calls = 0
+
+    async def recognise(self, url: str) -> str:
+        self.calls += 1
+        return f"content of {url}"
+
+
+class TestRecognitionCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+        self.cache = RecognitionCache(self.tmp_path / "cache.sqlite")
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def _write(self, name: str, content: str) -> Path:
+        path = self.tmp_path / name
+        path.write_text(content)
+        return path
+
+    async def test_same_content_recognised_once(self):
+        recogniser = CountingFileRecogniser()
+        caching_recogniser = CachingFileRecogniser(recogniser, self.cache)
+        first = await caching_recogniser.recognise(self._write("a.png", "photo"))
+        second = await caching_recogniser.recognise(self._write("forwarded.png", "photo"))
+        self.assertEqual(first, second)
+        self.assertEqual(recogniser.calls, 1)
+        await caching_recogniser.recognise(self._write("other.png", "another photo"))
+        self.assertEqual(recogniser.calls, 2)
+
+    async def test_empty_answer_not_cached(self):
+        recogniser = EmptyAnswerRecogniser()
+        caching_recogniser = CachingFileRecogniser(recogniser, self.cache)
+        path = self._write("a.png", "photo")
+        self.assertEqual(await caching_recogniser.recognise(path), "")
+        self.assertEqual("".join([part async for part in caching_recogniser.recognise_parts(path)]), "")
+        self.assertEqual(recogniser.calls, 2)
+
+    async def test_key_includes_recogniser_identity(self):
+        path = self._write("a.png", "photo")
+        first = await CachingFileRecogniser(CountingFileRecogniser("model-a"), self.cache).recognise(path)
+        second = await CachingFileRecogniser(CountingFileRecogniser("model-b"), self.cache).recognise(path)
+        self.assertNotEqual(first, second)
+
+    async def test_size_eviction(self):
+        cache = RecognitionCache(self.tmp_path / "small.sqlite", max_size_bytes=10)
+        await cache.set("first", "12345678")
+        await cache.set("second", "12345678")
+        self.assertIsNone(await cache.get("first"))
+        self.assertEqual(await cache.get("second"), "12345678")
+        cache.close()
+
+    async def test_age_eviction(self):
+        cache = RecognitionCache(self.tmp_path / "young.sqlite", max_age_seconds=0.1)
+        await cache.set("key", "value")
+        self.assertEqual(await cache.get("key"), "value")
+        await asyncio.sleep(0.2)
+        self.assertIsNone(await cache.get("key"))
+        cache.close()
+
+    async def test_concurrent_requests_for_one_url_fetched_once(self):
+        recogniser = CountingURLRecogniser()
+        caching_recogniser = CachingURLRecogniser(recogniser, self.cache)
+        results = await asyncio.gather(*[caching_recogniser.recognise("https://example.com") for _ in range(3)])
+        self.assertEqual(results, ["content of https://example.com"] * 3)
+        self.assertEqual(recogniser.calls, 1)
+
+    async def test_url_ttl(self):
+        recogniser = CountingURLRecogniser()
+        caching_recogniser = CachingURLRecogniser(recogniser, self.cache, ttl_seconds=0.1)
+        await caching_recogniser.recognise("https://example.com")
+        await caching_recogniser.recognise("https://example.com")
+        self.assertEqual(recogniser.calls, 1)
+        await asyncio.sleep(0.2)
+        await caching_recogniser.recognise("https://example.com")
+        self.assertEqual(recogniser.calls, 2)
@@ -0,0 +1,63 @@
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+
+from search_index import SearchIndex
+
+
+class TestSearchIndex(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index_path = Path(self.tmp_dir.name) / "search.sqlite"
+        self.index = SearchIndex(self.index_path, batch_size=3, flush_interval_seconds=0.1)
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp_dir.cleanup()
+
+    async def test_best_match_first_with_snippet(self):
+        self.index.add("1", "groceries", "https://notes.test/1", "buy milk and bread")
+        self.index.add("2", "milk", "https://notes.test/2", "milk milk milk, the cheapest milk in town")
+        results = await self.index.search("milk")
+        self.assertEqual([result.document_id for result in results], ["2", "1"])
+        self.assertIn("«milk»", results[1].snippet)
+        self.assertEqual(results[1].url, "https://notes.test/1")
+
+    async def test_words_matched_across_pieces(self):
+        self.index.add("1", "voice note", "https://notes.test/1", "first part about the garden")
+        await self.index.flush()
+        self.index.add("1", None, "https://notes.test/1", "second part about the roses")
+        results = await self.index.search("garden roses")
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].name, "voice note")
+
+    async def test_written_in_batches_without_search(self):
+        for index in range(3):
+            self.index.add(str(index), "note", "https://notes.test", f"text {index}")
+        self.index.add("3", "note", "https://notes.test", "text 3")
+        await asyncio.sleep(0.3)
+        reader = SearchIndex(self.index_path)
+        self.assertEqual(len(await reader.search("text", limit=10)), 4)
+        reader.close()
+
+    async def test_removed_document_not_found(self):
+        self.index.add("1", "note", "https://notes.test/1", "secret")
+        await self.index.remove("1")
+        self.assertEqual(await self.index.search("secret"), [])
+
+    async def test_query_syntax_is_not_interpreted(self):
+        self.index.add("1", "note", "https://notes.test/1", "what is NEAR(this) - or \"that\"?")
+        self.assertEqual(len(await self.index.search('NEAR(this) "that')), 1)
+        self.assertEqual(await self.index.search("  "), [])
+
+    async def test_failed_batch_rolled_back_and_reported(self):
+        self.index.add("1", "note", "https://notes.test/1", "written first")
+        # a url which cannot be stored fails the batch after the first document was written
+        self.index.add("2", "note", object(), "fails")
+        with self.assertLogs(level="ERROR"):
+            await asyncio.sleep(0.3)
+        self.index.add("1", "note", "https://notes.test/1", "written again")
+        results = await self.index.search("written")
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].snippet.count("«written»"), 1)
@@ -0,0 +1,93 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from task_queue import SQLiteTaskQueue
+
+
+class TestSQLiteTaskQueue(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.queue = SQLiteTaskQueue(Path(self.tmp_dir.name) / "tasks.sqlite", max_attempts=2, retry_delay_seconds=0)
+
+    def tearDown(self):
+        self.queue.close()
+        self.tmp_dir.cleanup()
+
+    async def test_tasks_handed_out_in_order_until_acked(self):
+        await self.queue.put("text", {"text": "first"})
+        await self.queue.put("text", {"text": "second"})
+        first = await self.queue.get()
+        second = await self.queue.get()
+        self.assertEqual([first.payload["text"], second.payload["text"]], ["first", "second"])
+        self.assertIsNone(await self.queue.claim())
+        await self.queue.ack(first)
+        await self.queue.ack(second)
+        self.assertEqual(self.queue.pending_count(), 0)
+
+    async def test_held_task_waits_for_release(self):
+        task_id = await self.queue.put("text", {"text": "held"}, held=True)
+        self.assertIsNone(await self.queue.claim())
+        await self.queue.release(task_id, reply_message_id=7)
+        task = await self.queue.claim()
+        self.assertEqual(task.reply_message_id, 7)
+
+    async def test_failed_task_retried_until_max_attempts(self):
+        await self.queue.put("file", {"file_id": "broken"})
+        task = await self.queue.get()
+        self.assertTrue(await self.queue.fail(task, "error"))
+        task = await self.queue.get()
+        self.assertEqual(task.attempts, 2)
+        self.assertFalse(await self.queue.fail(task, "error"))
+        self.assertIsNone(await self.queue.claim())
+
+    async def test_permanent_failure_not_retried(self):
+        await self.queue.put("file", {"file_id": "unsupported"})
+        task = await self.queue.get()
+        self.assertFalse(await self.queue.fail(task, "error", retry=False))
+        self.assertIsNone(await self.queue.claim())
+
+    async def test_group_handed_out_together_after_delay(self):
+        for index in range(3):
+            task_id = await self.queue.put(
+                "album", {"index": index}, held=True, group_key="album", delay_seconds=0.2)
+            await self.queue.release(task_id)
+        await self.queue.put("text", {"text": "after"})
+        text_task = await self.queue.claim()
+        self.assertEqual(text_task.kind, "text")
+        await self.queue.ack(text_task)
+        self.assertIsNone(await self.queue.claim())
+        start = time.monotonic()
+        task = await self.queue.get(poll_interval=5)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([task.payload["index"]] + [grouped.payload["index"] for grouped in task.group], [0, 1, 2])
+        self.assertFalse(await self.queue.group_exists("album"))
+        self.assertTrue(await self.queue.fail(task, "error"))
+        task = await self.queue.get()
+        self.assertEqual(len(task.ids), 3)
+        await self.queue.ack(task)
+        self.assertEqual(self.queue.pending_count(), 0)
+
+    async def test_owners_scheduled_fairly_within_limits(self):
+        queue = SQLiteTaskQueue(
+            Path(self.tmp_dir.name) / "owners.sqlite", max_running_per_owner=2, owner_limits={"video": 1})
+
+        async def put(owner: str, index: int):
+            await queue.put("file", {"owner": owner, "index": index}, owner=owner)
+
+        for index in range(3):
+            await put("bulk", index)
+        await put("video", 0)
+        await put("video", 1)
+        await put("notes", 0)
+        claimed = [await queue.claim() for _ in range(5)]
+        # oldest first among owners with the fewest running tasks, at most two of bulk and one of video
+        self.assertEqual(
+            [(task.payload["owner"], task.payload["index"]) for task in claimed[:4]],
+            [("bulk", 0), ("video", 0), ("notes", 0), ("bulk", 1)])
+        self.assertIsNone(claimed[4])
+        await queue.ack(claimed[1])
+        task = await queue.get(poll_interval=5)
+        self.assertEqual((task.payload["owner"], task.payload["index"]), ("video", 1))
+        queue.close()
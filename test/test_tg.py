@@ -0,0 +1,289 @@
+import asyncio
+import json
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+from pathlib import Path
+
+import httpx
+from telegram import Update
+
+from search_index import SearchIndex
+from task_queue import SQLiteTaskQueue
+from test.fakes import FakeTelegramServer, RecordingDocumentsStorage, make_update
+from tg import BotUser, TelegramBot
+
+
+class TestTelegramBot(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.queue_path = Path(self.tmp_dir.name) / "tasks.sqlite"
+        self.server = FakeTelegramServer().__enter__()
+        self.doc_storage = RecordingDocumentsStorage()
+        self.bots = []
+
+    async def asyncTearDown(self):
+        for bot in self.bots:
+            await bot.application.post_stop(bot.application)
+            await bot.application.shutdown()
+            bot.task_queue.close()
+        self.server.__exit__(None, None, None)
+        self.tmp_dir.cleanup()
+
+    async def _start_bot(self, **options) -> TelegramBot:
+        bot = TelegramBot(
+            token="123:test", user_id=1, doc_storage=self.doc_storage,
+            task_queue=SQLiteTaskQueue(self.queue_path, retry_delay_seconds=0.01),
+            base_url=self.server.base_url, base_file_url=self.server.base_file_url, **options,
+        )
+        await bot.application.initialize()
+        await bot.application.post_init(bot.application)
+        self.bots.append(bot)
+        return bot
+
+    async def _process(self, bot: TelegramBot, update: dict):
+        await bot.application.process_update(Update.de_json(update, bot.application.bot))
+
+    async def _wait_saved(self, count: int):
+        for _ in range(200):
+            if len(self.doc_storage.saved) >= count and len(self.server.edited_messages) >= count:
+                return
+            await asyncio.sleep(0.02)
+        self.fail("messages were not saved")
+
+    async def test_text_acknowledged_then_saved(self):
+        bot = await self._start_bot()
+        await self._process(bot, make_update(1, text="hello"))
+        self.assertEqual(self.server.sent_messages[0]["text"], "Saving...")
+        await self._wait_saved(1)
+        self.assertEqual(self.doc_storage.saved[0]["text"], "hello")
+        self.assertTrue(self.server.edited_messages[0]["text"].startswith("Document text message from"))
+
+    async def test_photo_downloaded_and_saved(self):
+        self.server.add_file("photo", "photos/file_1.jpg", b"jpeg bytes")
+        bot = await self._start_bot()
+        photo = [{"file_id": "photo", "file_unique_id": "photo", "width": 10, "height": 10}]
+        await self._process(bot, make_update(1, photo=photo, caption="a caption"))
+        await self._wait_saved(1)
+        self.assertEqual(self.doc_storage.saved[0]["kind"], "image")
+        self.assertEqual(self.doc_storage.saved[0]["data"], b"jpeg bytes")
+        self.assertEqual(self.doc_storage.saved[0]["text"], "a caption")
+
+    async def test_small_downloads_kept_in_memory(self):
+        self.server.add_file("small", "photos/file_1.jpg", b"jpeg bytes")
+        self.server.add_file("large", "photos/file_2.jpg", b"jpeg bytes" * 10)
+        memory_dir = Path(self.tmp_dir.name) / "shm"
+        memory_dir.mkdir()
+        bot = await self._start_bot(max_memory_file_bytes=50)
+        with mock.patch("utils.MEMORY_DIRECTORY", memory_dir):
+            for update_id, file_id in enumerate(["small", "large"], start=1):
+                photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 10, "height": 10}]
+                await self._process(bot, make_update(update_id, photo=photo))
+                await self._wait_saved(update_id)
+        self.assertEqual(self.doc_storage.saved[0]["path"].parents[1], memory_dir)
+        self.assertNotIn(memory_dir, self.doc_storage.saved[1]["path"].parents)
+        self.assertEqual(list(memory_dir.iterdir()), [])
+
+    async def test_album_saved_as_one_document(self):
+        self.server.add_file("photo", "photos/file_1.jpg", b"jpeg bytes")
+        bot = await self._start_bot()
+        bot.album_window_seconds = 0.2
+        photo = [{"file_id": "photo", "file_unique_id": "photo", "width": 10, "height": 10}]
+        await self._process(bot, make_update(1, photo=photo, caption="a caption", media_group_id="1"))
+        await self._process(bot, make_update(2, photo=photo, media_group_id="1"))
+        await self._process(bot, make_update(3, photo=photo, media_group_id="1"))
+        await self._wait_saved(1)
+        self.assertEqual([message["text"] for message in self.server.sent_messages], ["Saving..."])
+        self.assertEqual(len(self.doc_storage.saved), 1)
+        self.assertEqual(self.doc_storage.saved[0]["kind"], "album")
+        self.assertEqual(self.doc_storage.saved[0]["data"], [b"jpeg bytes"] * 3)
+        self.assertEqual(self.doc_storage.saved[0]["descriptions"], ["a caption", None, None])
+        self.assertTrue(self.server.edited_messages[0]["text"].startswith("Album album from"))
+
+    async def test_text_burst_saved_as_one_document_then_appended(self):
+        bot = await self._start_bot()
+        bot.text_window_seconds = 0.3
+        for update_id in range(1, 4):
+            await self._process(bot, make_update(update_id, text=f"note {update_id}"))
+        await self._wait_saved(1)
+        self.assertEqual(len(self.doc_storage.saved), 1)
+        self.assertEqual(self.doc_storage.saved[0]["text"], "note 1\n\nnote 2\n\nnote 3")
+        await self._process(bot, make_update(4, text="note 4"))
+        await self._process(bot, make_update(5, text="note 5"))
+        for _ in range(100):
+            if self.doc_storage.saved[0]["appended"]:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual(len(self.doc_storage.saved), 1)
+        self.assertEqual(self.doc_storage.saved[0]["appended"], ["note 4\n\nnote 5"])
+        self.assertEqual([message["text"] for message in self.server.sent_messages], ["Saving...", "Saving..."])
+
+    async def test_links_saved_with_the_text(self):
+        bot = await self._start_bot()
+        text = "see example.com/a and this page, https://b.test/x and example.com/a again"
+        entities = [
+            {"type": "url", "offset": 4, "length": len("example.com/a")},
+            {"type": "text_link", "offset": text.index("this page"), "length": len("this page"), "url": "https://c.test/"},
+            {"type": "url", "offset": text.index("https"), "length": len("https://b.test/x")},
+            {"type": "url", "offset": text.rindex("example"), "length": len("example.com/a")},
+        ]
+        await self._process(bot, make_update(1, text=text, entities=entities))
+        await self._wait_saved(1)
+        saved = self.doc_storage.saved[0]
+        self.assertEqual(saved["kind"], "links")
+        self.assertEqual(saved["text"], text)
+        self.assertEqual(saved["links"], ["http://example.com/a", "https://c.test/", "https://b.test/x"])
+        self.assertTrue(self.server.edited_messages[0]["text"].endswith("with 3 links saved"))
+
+    async def test_only_web_links_saved(self):
+        bot = await self._start_bot()
+        text = "write me, open example.com/?next=https://b.test/ or localhost:8080/x"
+        entities = [
+            {"type": "text_link", "offset": 0, "length": len("write me"), "url": "mailto:me@example.com"},
+            {"type": "url", "offset": text.index("example"), "length": len("example.com/?next=https://b.test/")},
+            {"type": "url", "offset": text.index("localhost"), "length": len("localhost:8080/x")},
+        ]
+        await self._process(bot, make_update(1, text=text, entities=entities))
+        await self._wait_saved(1)
+        saved = self.doc_storage.saved[0]
+        self.assertEqual(saved["text"], text)
+        self.assertEqual(saved["links"], ["http://example.com/?next=https://b.test/", "http://localhost:8080/x"])
+
+    async def test_search_command_answers_from_index(self):
+        bot = await self._start_bot()
+        search_index = bot.users[1].search_index = SearchIndex(Path(self.tmp_dir.name) / "search.sqlite")
+        search_index.add("page", "shopping list", "https://notion.test/page", "buy oat milk")
+        command = "/search milk"
+        await self._process(bot, make_update(
+            1, text=command, entities=[{"type": "bot_command", "offset": 0, "length": len("/search")}]))
+        search_index.close()
+        self.assertEqual(self.server.sent_messages[0]["text"], "1. shopping list\nbuy oat «milk»\nhttps://notion.test/page")
+        self.assertEqual(bot.task_queue.pending_count(), 0)
+
+    async def test_recorded_updates_posted_to_webhook_handled_concurrently(self):
+        self.server.add_file("photo", "photos/file_1.jpg", b"jpeg bytes")
+        self.server.latency = 0.2
+        updates = json.loads((Path(__file__).parent / "data" / "webhook_updates.json").read_text())
+        bot = await self._start_bot(concurrent_updates=8, album_window_seconds=0.3)
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        await bot.application.start()
+        await bot.application.updater.start_webhook(
+            listen="127.0.0.1", port=port, url_path="telegram",
+            webhook_url=f"http://127.0.0.1:{port}/telegram", secret_token="secret")
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+                rejected = await client.post("/telegram", json=updates[0])
+                self.assertEqual(rejected.status_code, 403)
+                start = time.monotonic()
+                responses = await asyncio.gather(*[
+                    client.post("/telegram", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "secret"})
+                    for update in updates
+                ])
+                self.assertEqual([response.status_code for response in responses], [200] * len(updates))
+                for _ in range(200):
+                    if len(self.server.sent_messages) >= 3:
+                        break
+                    await asyncio.sleep(0.02)
+                acknowledged_in = time.monotonic() - start
+                await self._wait_saved(3)
+        finally:
+            await bot.application.updater.stop()
+            await bot.application.stop()
+        # three "Saving..." replies, one per message and album, sent at once rather than one after another
+        self.assertEqual(len(self.server.sent_messages), 3)
+        self.assertLess(acknowledged_in, 2 * 0.2 + 0.2)
+        saved = sorted(self.doc_storage.saved, key=lambda document: document["kind"])
+        self.assertEqual([document["kind"] for document in saved], ["album", "text", "text"])
+        self.assertEqual(saved[0]["descriptions"], ["whiteboard after the meeting", None, None])
+        self.assertEqual({document["text"] for document in saved[1:]}, {"buy oat milk", "call the plumber"})
+
+    async def test_users_saved_to_their_own_storage(self):
+        other_storage = RecordingDocumentsStorage()
+        bot = await self._start_bot(users={1: BotUser(self.doc_storage), 2: BotUser(other_storage)})
+        await self._process(bot, make_update(1, user_id=1, text="mine"))
+        await self._process(bot, make_update(2, user_id=2, text="theirs"))
+        await self._process(bot, make_update(3, user_id=3, text="stranger"))
+        await self._wait_saved(1)
+        for _ in range(100):
+            if other_storage.saved:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual([document["text"] for document in self.doc_storage.saved], ["mine"])
+        self.assertEqual([document["text"] for document in other_storage.saved], ["theirs"])
+        self.assertEqual(len(self.server.sent_messages), 2)
+
+    async def test_text_bursts_of_users_in_a_group_chat_kept_apart(self):
+        other_storage = RecordingDocumentsStorage()
+        bot = await self._start_bot(
+            users={1: BotUser(self.doc_storage), 2: BotUser(other_storage)}, text_window_seconds=0.2)
+        for update_id, user_id, text in [(1, 1, "alice private"), (2, 2, "bob private"), (3, 1, "alice again")]:
+            update = make_update(update_id, user_id=user_id, text=text)
+            update["message"]["chat"] = {"id": -100, "type": "group"}
+            await self._process(bot, update)
+        await self._wait_saved(1)
+        for _ in range(100):
+            if other_storage.saved:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual([document["text"] for document in self.doc_storage.saved], ["alice private\n\nalice again"])
+        self.assertEqual([document["text"] for document in other_storage.saved], ["bob private"])
+        # a later note of bob is appended to his own document
+        update = make_update(4, user_id=2, text="bob later")
+        update["message"]["chat"] = {"id": -100, "type": "group"}
+        await self._process(bot, update)
+        for _ in range(100):
+            if other_storage.saved[0]["appended"]:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual(other_storage.saved[0]["appended"], ["bob later"])
+        self.assertEqual(self.doc_storage.saved[0]["appended"], [])
+
+    async def test_permanent_error_reported_without_retries(self):
+        bot = await self._start_bot()
+        with mock.patch.object(self.doc_storage, "save_text", side_effect=ValueError("cannot save")) as save_text:
+            await self._process(bot, make_update(1, text="hello"))
+            for _ in range(100):
+                if self.server.edited_messages:
+                    break
+                await asyncio.sleep(0.02)
+        self.assertEqual(save_text.call_count, 1)
+        self.assertTrue(self.server.edited_messages[0]["text"].startswith("Error: cannot save"))
+
+    async def test_worker_survives_queue_errors(self):
+        bot = await self._start_bot(workers=1)
+        errors = [RuntimeError("disk full")]
+        ack = bot.task_queue.ack
+
+        async def failing_ack(task):
+            if errors:
+                raise errors.pop()
+            await ack(task)
+
+        with mock.patch.object(bot.task_queue, "ack", failing_ack), self.assertLogs(level="ERROR"):
+            await self._process(bot, make_update(1, text="first"))
+            await self._wait_saved(1)
+            await self._process(bot, make_update(2, text="second"))
+            await self._wait_saved(2)
+        self.assertEqual([saved["text"] for saved in self.doc_storage.saved], ["first", "second"])
+
+    async def test_other_users_ignored(self):
+        bot = await self._start_bot()
+        await self._process(bot, make_update(1, user_id=2, text="hello"))
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.server.sent_messages, [])
+        self.assertEqual(bot.task_queue.pending_count(), 0)
+
+    async def test_interrupted_task_resumed_after_restart(self):
+        queue = SQLiteTaskQueue(self.queue_path)
+        task_id = await queue.put("text", {"text": "lost?", "chat_id": 1, "message_id": 1, "timestamp": "now"}, held=True)
+        await queue.release(task_id, reply_message_id=2)
+        await queue.claim()  # the process dies while saving
+        queue.close()
+        await self._start_bot()
+        await self._wait_saved(1)
+        self.assertEqual(self.doc_storage.saved[0]["text"], "lost?")
+        self.assertEqual(self.server.edited_messages[0]["message_id"], 2)
@@ -1,75 +1,354 @@
-import tempfile
+import asyncio
+import logging
+import time
 import traceback
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
-from pydub import AudioSegment
-from telegram import Update
-from telegram.ext import ApplicationBuilder, MessageHandler, CallbackContext, filters
+from notion_client.errors import HTTPResponseError
+from telegram import File, Message, MessageEntity, Update
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, CallbackContext, filters
 
 from document_storage import DocumentsStorage
+from instrumentation import observe_wait, stage
+from search_index import SearchIndex
+from task_queue import SQLiteTaskQueue, Task
+from utils import gather_or_cancel, temporary_directory
 
 
-def ogg_to_mp3(ogg_path, mp3_path):
-    audio = AudioSegment.from_ogg(ogg_path)
-    audio.export(mp3_path, format="mp3")
+def _retryable(error: Exception) -> bool:
+    """Errors another attempt would repeat (a file the bot cannot handle, a request Notion rejects)
+    are reported to the user at once."""
+    if isinstance(error, ValueError):
+        return False
+    if isinstance(error, HTTPResponseError):
+        return error.status in (409, 429) or error.status >= 500
+    return True
+
+
+@dataclass
+class BotUser:
+    """Where the messages of one Telegram user are saved and searched."""
+    doc_storage: DocumentsStorage
+    search_index: Optional[SearchIndex] = None
 
 
 class TelegramBot:
-    def __init__(self, token: str, user_id: int,doc_storage: DocumentsStorage):
-        self.application = ApplicationBuilder().token(token=token).build()
+    def __init__(
+            self,
+            token: str,
+            user_id: Optional[int],
+            doc_storage: Optional[DocumentsStorage],
+            task_queue: SQLiteTaskQueue,
+            workers: int = 4,
+            base_url: Optional[str] = None,
+            base_file_url: Optional[str] = None,
+            album_window_seconds: float = 1.0,
+            text_window_seconds: float = 0.0,
+            search_index: Optional[SearchIndex] = None,
+            concurrent_updates: int = 1,
+            users: Optional[Dict[int, BotUser]] = None,
+            max_memory_file_bytes: Optional[int] = None,
+    ):
+        """Handlers only persist incoming messages to task_queue and acknowledge them,
+        `workers` background tasks save them to doc_storage.
+        base_url and base_file_url allow using a self-hosted Bot API server.
+        Telegram delivers an album as separate messages, files arriving within album_window_seconds
+        of the first one are saved together as one document.
+        Likewise text messages arriving within text_window_seconds of the first one are saved as one
+        document, or appended to the previous text document if it was saved within that window.
+        Links in text messages are saved in a new document together with the text of the linked pages.
+        /search answers from search_index without calling Notion.
+        Up to concurrent_updates updates are handled at once, messages of one chat are still queued
+        in the order they arrived.
+        Several people can share the bot with `users` instead of user_id, doc_storage and search_index,
+        their tasks are queued with the user as the owner, so they are scheduled fairly.
+        Downloads of up to max_memory_file_bytes are kept in memory (see utils.temporary_directory)."""
+        builder = ApplicationBuilder().token(token=token).post_init(self._start_workers).post_stop(self._stop_workers)
+        if concurrent_updates > 1:
+            builder = builder.concurrent_updates(concurrent_updates)
+        if base_url:
+            builder = builder.base_url(base_url)
+        if base_file_url:
+            builder = builder.base_file_url(base_file_url)
+        self.application = builder.build()
+        # before the text handler, which would save commands as notes
+        self.application.add_handler(CommandHandler("search", self.search_handler))
         self.application.add_handler(MessageHandler(filters.TEXT, self.text_handler))
         self.application.add_handler(MessageHandler(filters.ATTACHMENT, self.file_handler))
-        self.doc_storage = doc_storage
-        self.user_id = user_id
+        self.users = users if users is not None else {user_id: BotUser(doc_storage, search_index)}
+        self.task_queue = task_queue
+        self.workers = workers
+        self.album_window_seconds = album_window_seconds
+        self.text_window_seconds = text_window_seconds
+        self.max_memory_file_bytes = max_memory_file_bytes
+        # the last text document of every user in every chat: document id, name and when it was saved
+        self._last_text_documents: Dict[Tuple[int, int], Tuple[str, str, float]] = {}
+        self._worker_tasks: List[asyncio.Task] = []
+        # users have few chats, so the locks are kept for the lifetime of the bot
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
 
     def run_polling(self):
         print("Bot is running...")
         self.application.run_polling()
 
+    def run_webhook(self, listen: str, port: int, webhook_url: str, secret_token: Optional[str] = None):
+        """Receives updates at webhook_url, which must be routed to listen:port, e.g. by a TLS-terminating proxy.
+        Requests without the secret_token header are rejected."""
+        print("Bot is running...")
+        self.application.run_webhook(
+            listen=listen,
+            port=port,
+            url_path=urlparse(webhook_url).path.lstrip("/"),
+            webhook_url=webhook_url,
+            secret_token=secret_token,
+        )
+
+    async def _start_workers(self, application: Application):
+        recovered = await self.task_queue.recover()
+        if recovered:
+            logging.info(f"Resuming {recovered} interrupted tasks")
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _stop_workers(self, application: Application):
+        for worker_task in self._worker_tasks:
+            worker_task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def _window_seconds(self, kind: str) -> float:
+        return self.text_window_seconds if kind == "text" else self.album_window_seconds
+
+    async def _enqueue(self, update: Update, kind: str, payload: dict, group_key: Optional[str] = None):
+        payload = {
+            **payload,
+            "chat_id": update.message.chat_id,
+            "message_id": update.message.message_id,
+            "user_id": update.message.from_user.id,
+            "timestamp": datetime.now().strftime('%d-%m-%Y %H:%M:%S'),
+            "received_at": time.time(),
+        }
+        # the task is persisted before acknowledging, but handed to workers only after the
+        # acknowledgement exists, so that workers can always edit it
+        with stage("telegram.handler"):
+            # concurrent handlers take the lock in the order of updates, so tasks of a chat are queued
+            # in order and the first message of a group is the one acknowledged
+            async with self._chat_locks.setdefault(update.message.chat_id, asyncio.Lock()):
+                # only the first message of a group is acknowledged, the group is saved and reported at once
+                acknowledge = group_key is None or not await self.task_queue.group_exists(group_key)
+                task_id = await self.task_queue.put(
+                    kind, payload, held=True, group_key=group_key,
+                    delay_seconds=self._window_seconds(kind) if group_key is not None else 0.0,
+                    owner=str(update.message.from_user.id),
+                )
+            reply_message_id = None
+            try:
+                if acknowledge:
+                    reply = await update.message.reply_text("Saving...")
+                    reply_message_id = reply.message_id
+            finally:
+                await self.task_queue.release(task_id, reply_message_id)
+
+    @staticmethod
+    def _urls(message: Message) -> List[str]:
+        """Links of the message in order, without repeats: typed URLs and links behind text."""
+        urls = []
+        for entity, text in message.parse_entities([MessageEntity.URL, MessageEntity.TEXT_LINK]).items():
+            url = entity.url if entity.type == MessageEntity.TEXT_LINK else text
+            scheme = urlparse(url).scheme.lower()
+            # Telegram recognises typed links without a scheme, like example.com/page or localhost:8080
+            if not scheme or entity.type == MessageEntity.URL and not url.lower().startswith(scheme + "://"):
+                url = "http://" + url
+                scheme = "http"
+            # other links (mailto:, tg://) stay in the text only, there is no page to bookmark or fetch
+            if scheme not in ("http", "https"):
+                continue
+            if url not in urls:
+                urls.append(url)
+        return urls
+
     async def text_handler(self, update: Update, context: CallbackContext) -> None:  # noqa
         try:
-            if update.message.from_user.id != self.user_id:
+            if update.message.from_user.id not in self.users:
                 return
-            name = f"text message from {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}"
-            await self.doc_storage.save_text(name=name, text=update.message.text)
-            await update.message.reply_text(f"Document {name} saved")
+            # a burst of notes (or a long message split by Telegram) becomes one document, in group chats
+            # the notes of every user go to their own storage
+            group_key = (f"text:{update.message.chat_id}:{update.message.from_user.id}"
+                         if self.text_window_seconds > 0 else None)
+            payload = {"text": update.message.text, "urls": self._urls(update.message)}
+            await self._enqueue(update, "text", payload, group_key)
         except Exception as e:
             # send error text and stacktrace to user
             await update.message.reply_text(f"Error: {e}\n\n{traceback.format_exc()}")
 
-    async def file_handler(self, update: Update, context: CallbackContext) -> None:
+    async def search_handler(self, update: Update, context: CallbackContext) -> None:
         try:
-            if update.message.from_user.id != self.user_id:
+            if update.message.from_user.id not in self.users:
+                return
+            search_index = self.users[update.message.from_user.id].search_index
+            if search_index is None:
+                await update.message.reply_text("Search is not configured")
+                return
+            query = " ".join(context.args)
+            if not query:
+                await update.message.reply_text("Usage: /search <words>")
+                return
+            with stage("telegram.search"):
+                results = await search_index.search(query)
+            if not results:
+                await update.message.reply_text(f"Nothing found for {query}")
+                return
+            text = "\n\n".join(
+                f"{index}. {result.name}\n{result.snippet}\n{result.url}" for index, result in enumerate(results, 1))
+            await update.message.reply_text(text[:4096], disable_web_page_preview=True)
+        except Exception as e:
+            # send error text and stacktrace to user
+            await update.message.reply_text(f"Error: {e}\n\n{traceback.format_exc()}")
+
+    async def file_handler(self, update: Update, context: CallbackContext) -> None:  # noqa
+        try:
+            if update.message.from_user.id not in self.users:
                 return
             attachments = update.message.effective_attachment
             if isinstance(attachments, tuple):
                 attachment = attachments[-1]
             else:
                 attachment = attachments
-            document = await context.bot.get_file(attachment.file_id)
-            file_ext = Path(document.file_path).suffix
-            with tempfile.NamedTemporaryFile(delete=True, suffix=file_ext) as file:
-                await document.download_to_drive(file.name)
-                description = update.message.caption if update.message.caption else None
-                if file_ext in [".oga", ".ogg"]:
-                    with tempfile.NamedTemporaryFile(delete=True, suffix=file_ext) as mp3_file:
-                        ogg_to_mp3(file.name, mp3_file.name)
-                        name = f"audio from {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}"
-                        await self.doc_storage.save_audio(name=name, audio_path=Path(file.name), description=description)
-                elif file_ext in [".mp3", ".wav"]:
-                    name = f"audio from {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}"
-                    await self.doc_storage.save_audio(name=name, audio_path=Path(file.name), description=description)
-                elif file_ext in [".mp4", ".mov"]:
-                    name = f"video from {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}"
-                    await self.doc_storage.save_video(name=name, video_path=Path(file.name), description=description)
-                elif file_ext in [".jpg", ".png", ".jpeg", ".gif", ".webp"]:
-                    name = f"image from {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}"
-                    await self.doc_storage.save_image(name=name, image_path=Path(file.name), description=description)
-                else:
-                    name = f"file from {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}"
-                    await self.doc_storage.save_file(name=name, file_path=Path(file.name), description=description)
-                await update.message.reply_text(f"File {name} saved")
+            payload = {"file_id": attachment.file_id, "caption": update.message.caption}
+            if update.message.media_group_id:
+                group_key = f"album:{update.message.chat_id}:{update.message.media_group_id}"
+                await self._enqueue(update, "album", payload, group_key)
+            else:
+                await self._enqueue(update, "file", payload)
         except Exception as e:
             # send error text and stacktrace to user
             await update.message.reply_text(f"Error: {e}\n\n{traceback.format_exc()}")
+
+    def _user(self, task: Task) -> BotUser:
+        # tasks queued before user_id was recorded come from private chats, where the chat id is the user id
+        return self.users[task.payload.get("user_id", task.payload["chat_id"])]
+
+    async def _save_text(self, tasks: List[Task]) -> str:
+        doc_storage = self._user(tasks[0]).doc_storage
+        author = (tasks[0].payload["chat_id"], tasks[0].payload.get("user_id", tasks[0].payload["chat_id"]))
+        text = "\n\n".join(task.payload["text"] for task in tasks)
+        # tasks queued before links were detected have no urls
+        urls = list(dict.fromkeys(url for task in tasks for url in task.payload.get("urls", [])))
+        last_document = self._last_text_documents.get(author)
+        # tasks queued before received_at was recorded start a new document
+        received_at = min(task.payload.get("received_at", 0.0) for task in tasks)
+        # linked pages are bookmarked in a new document, they cannot be appended as text
+        if not urls and last_document is not None and last_document[2] >= received_at - self.text_window_seconds:
+            document_id, name, _ = last_document
+            await doc_storage.append_text(document_id, text)
+            self._last_text_documents[author] = (document_id, name, time.time())
+            return f"Document {name} updated"
+        name = f"text message from {tasks[0].payload['timestamp']}"
+        if urls:
+            document_id = await doc_storage.save_links(name=name, text=text, links=[(url, None) for url in urls])
+        else:
+            document_id = await doc_storage.save_text(name=name, text=text)
+        if self.text_window_seconds > 0:
+            self._last_text_documents[author] = (document_id, name, time.time())
+        if urls:
+            return f"Document {name} with {len(urls)} {'link' if len(urls) == 1 else 'links'} saved"
+        return f"Document {name} saved"
+
+    async def _download(self, document: File, directory: Path, stem: str) -> Path:
+        file_path = directory / f"{stem}{Path(document.file_path).suffix}"
+        with stage("telegram.download") as download:
+            await document.download_to_drive(file_path)
+            download.add_bytes(file_path.stat().st_size)
+        return file_path
+
+    async def _save_file(self, task: Task) -> str:
+        doc_storage = self._user(task).doc_storage
+        timestamp = task.payload["timestamp"]
+        description = task.payload["caption"] if task.payload["caption"] else None
+        document = await self.application.bot.get_file(task.payload["file_id"])
+        with temporary_directory(document.file_size, self.max_memory_file_bytes) as directory:
+            file_path = await self._download(document, Path(directory), "file")
+            file_ext = file_path.suffix
+            # voice notes (.oga opus) are transcribed as they are, other formats are converted by the recogniser
+            if file_ext in [".oga", ".ogg", ".mp3", ".wav", ".m4a"]:
+                name = f"audio from {timestamp}"
+                await doc_storage.save_audio(name=name, audio_path=file_path, description=description)
+            elif file_ext in [".mp4", ".mov"]:
+                name = f"video from {timestamp}"
+                await doc_storage.save_video(name=name, video_path=file_path, description=description)
+            elif file_ext in [".jpg", ".png", ".jpeg", ".gif", ".webp"]:
+                name = f"image from {timestamp}"
+                await doc_storage.save_image(name=name, image_path=file_path, description=description)
+            else:
+                name = f"file from {timestamp}"
+                await doc_storage.save_file(name=name, file_path=file_path, description=description)
+        return f"File {name} saved"
+
+    async def _save_album(self, tasks: List[Task]) -> str:
+        doc_storage = self._user(tasks[0]).doc_storage
+        name = f"album from {tasks[0].payload['timestamp']}"
+        documents = await gather_or_cancel(*[self.application.bot.get_file(task.payload["file_id"]) for task in tasks])
+        sizes = [document.file_size for document in documents]
+        with temporary_directory(None if None in sizes else sum(sizes), self.max_memory_file_bytes) as directory:
+            file_paths = await gather_or_cancel(*[
+                self._download(document, Path(directory), str(index)) for index, document in enumerate(documents)
+            ])
+            await doc_storage.save_album(name=name, items=[
+                (file_path, task.payload["caption"] if task.payload["caption"] else None)
+                for file_path, task in zip(file_paths, tasks)
+            ])
+        return f"Album {name} with {len(tasks)} files saved"
+
+    async def _reply(self, task: Task, text: str):
+        # a group is reported in the acknowledgement of its first message
+        task = next((grouped for grouped in [task] + task.group if grouped.reply_message_id is not None), task)
+        try:
+            if task.reply_message_id is not None:
+                await self.application.bot.edit_message_text(
+                    text, chat_id=task.payload["chat_id"], message_id=task.reply_message_id)
+            else:
+                await self.application.bot.send_message(
+                    task.payload["chat_id"], text, reply_to_message_id=task.payload["message_id"])
+        except Exception:  # noqa
+            logging.exception(f"Could not reply to task {task.id}")
+
+    async def _worker(self):
+        while True:
+            try:
+                task = await self.task_queue.get()
+            except Exception:  # noqa
+                # a worker which dies silently shrinks the pool
+                logging.exception("Could not get a task from the queue")
+                await asyncio.sleep(1.0)
+                continue
+            observe_wait("tasks", time.time() - task.available_at)
+            try:
+                with stage(f"save.{task.kind}"):
+                    # with concurrent updates (or webhook requests) a group may have been queued out of order
+                    tasks = sorted([task] + task.group, key=lambda grouped: grouped.payload["message_id"])
+                    if task.kind == "text":
+                        result = await self._save_text(tasks)
+                    elif task.kind == "album":
+                        result = await self._save_album(tasks)
+                    else:
+                        result = await self._save_file(task)
+            except Exception as e:
+                error = f"Error: {e}\n\n{traceback.format_exc()}"
+                try:
+                    retry = await self.task_queue.fail(task, error, _retryable(e))
+                except Exception:  # noqa
+                    # the task stays running and is handed out again by recover() after a restart
+                    logging.exception(f"Could not record the failure of task {task.id}")
+                    continue
+                if not retry:
+                    # send error text and stacktrace to user
+                    await self._reply(task, error[:4096])
+                continue
+            await self._reply(task, result)
+            try:
+                await self.task_queue.ack(task)
+            except Exception:  # noqa
+                logging.exception(f"Could not acknowledge task {task.id}")
@@ -0,0 +1,25 @@
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+
+@dataclass
+class UserConfig:
+    """Where the messages of one Telegram user are saved, and how many of them are processed at once."""
+    telegram_user_id: int
+    notion_token: str
+    notion_parent_document: str
+    storage_prefix: str = ""
+    max_running_tasks: Optional[int] = None
+
+
+def load_users(config_path: Path) -> Dict[int, UserConfig]:
+    """Reads a JSON list of users, e.g.
+    [{"telegram_user_id": 1, "notion_token": "secret_...", "notion_parent_document": "...", "storage_prefix": "alice/"}]
+    """
+    users = [UserConfig(**user) for user in json.loads(config_path.read_text())]
+    by_id = {user.telegram_user_id: user for user in users}
+    if len(by_id) != len(users):
+        raise ValueError(f"{config_path} lists a Telegram user more than once")
+    return by_id
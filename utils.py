@@ -0,0 +1,70 @@
+import asyncio
+import hashlib
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Iterable, List, Optional, Tuple
+
+# files up to this size are kept in memory-backed storage when there is one, larger ones go to disk
+MAX_MEMORY_FILE_BYTES = 20 * 1024 * 1024
+MEMORY_DIRECTORY = Path("/dev/shm")
+
+# the recognition cache and the file storage both hash the file of a message, it is read once
+_HASHES_KEPT = 64
+_hashes: "OrderedDict[Tuple, str]" = OrderedDict()
+_hashes_lock = threading.Lock()
+
+
+def hash_file(file_path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """sha256 of the file content, read in chunks so the whole file is never held in memory.
+    The hash of a recently hashed file is reused until the file is changed or replaced."""
+    stat = Path(file_path).stat()
+    key = (str(file_path), stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        if key in _hashes:
+            _hashes.move_to_end(key)
+            return _hashes[key]
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    with _hashes_lock:
+        _hashes[key] = digest.hexdigest()
+        if len(_hashes) > _HASHES_KEPT:
+            _hashes.popitem(last=False)
+    return digest.hexdigest()
+
+
+def temporary_directory(expected_bytes: Optional[int], max_memory_bytes: Optional[int] = None) -> tempfile.TemporaryDirectory:
+    """A TemporaryDirectory for files of about expected_bytes. Small files are written to MEMORY_DIRECTORY
+    (tmpfs) and never reach the disk, files over max_memory_bytes (MAX_MEMORY_FILE_BYTES by default),
+    of unknown size, or which would use more than a quarter of the free memory go to the default temporary directory."""
+    if max_memory_bytes is None:
+        max_memory_bytes = MAX_MEMORY_FILE_BYTES
+    if expected_bytes is not None and expected_bytes <= max_memory_bytes and MEMORY_DIRECTORY.is_dir():
+        try:
+            if shutil.disk_usage(MEMORY_DIRECTORY).free >= 4 * expected_bytes:
+                return tempfile.TemporaryDirectory(dir=MEMORY_DIRECTORY)
+        except OSError:
+            pass
+    return tempfile.TemporaryDirectory()
+
+
+async def cancel_and_wait(futures: Iterable[asyncio.Future]):
+    """Cancels futures and waits until they stop, e.g. before removing the files they work on."""
+    futures = list(futures)
+    for future in futures:
+        future.cancel()
+    await asyncio.gather(*futures, return_exceptions=True)
+
+
+async def gather_or_cancel(*aws: Awaitable) -> List:
+    """Like asyncio.gather, but when one awaitable fails the others are cancelled before the error is raised."""
+    futures = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*futures)
+    except BaseException:
+        await cancel_and_wait(futures)
+        raise